@@ -0,0 +1,154 @@
+#
+# Lock hold times from the events of relation_lock_trace.py.
+#
+#   $ python3 lock_profile.py locks.jsonl [more.jsonl ...]
+#
+# Each relation_close is paired with the latest unpaired relation_open of
+# the same relation in the same backend.  A close with a lock mode releases
+# the lock taken by the open; a close with NoLock leaves it held until the
+# end of the transaction, as does an open that is never closed.  The holds
+# are summed up into a duration histogram per lock mode, the longest holds
+# with the stack that took them, and the locks held until the end of a
+# transaction per relation.
+#
+import sys
+import json
+import bisect
+import argparse
+import collections
+
+
+Hold = collections.namedtuple("Hold", [
+    "pid", "oid", "relname", "lockmode", "start", "end", "released_by",
+    "stack",
+])
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = [1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1, 10]
+BUCKET_LABELS = ["<10us", "<100us", "<1ms", "<10ms", "<100ms", "<1s",
+                 "<10s", ">=10s"]
+
+
+def read_events(paths):
+    """
+    The events of all files, ordered by time
+    """
+    events = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    events.append(json.loads(line))
+    events.sort(key=lambda e: e["ts"])
+    return events
+
+
+def pair_holds(events):
+    """
+    Holds of the locks taken by relation_open.  Holds still open when the
+    events end have end None.
+    """
+    holds = []
+    # pid -> oid -> open events not closed yet, latest last
+    opened = collections.defaultdict(lambda: collections.defaultdict(list))
+    # pid -> holds closed with NoLock, waiting for the end of the xact
+    kept = collections.defaultdict(list)
+
+    def hold(e, end, released_by):
+        holds.append(Hold(e["pid"], e["oid"], e["relname"], e["lockmode"],
+                          e["ts"], end, released_by, e.get("stack")))
+
+    for e in events:
+        pid = e["pid"]
+        if e["event"] == "open":
+            opened[pid][e["oid"]].append(e)
+        elif e["event"] == "close":
+            stack = opened[pid].get(e["oid"])
+            if not stack:
+                # opened before the trace started
+                continue
+            o = stack.pop()
+            if o["lockmode"] == "NoLock":
+                continue
+            if e["lockmode"] == "NoLock":
+                kept[pid].append(o)
+            else:
+                hold(o, e["ts"], "close")
+        elif e["event"] == "xact_end":
+            for o in kept.pop(pid, []):
+                hold(o, e["ts"], e["how"])
+            for stack in opened.pop(pid, {}).values():
+                for o in stack:
+                    if o["lockmode"] != "NoLock":
+                        hold(o, e["ts"], e["how"])
+
+    # still held when the events end
+    for o in [o for pending in kept.values() for o in pending] + \
+            [o for oids in opened.values() for pending in oids.values()
+             for o in pending]:
+        if o["lockmode"] != "NoLock":
+            hold(o, None, None)
+    return holds
+
+
+def histogram(holds):
+    """
+    lockmode -> counts of hold durations per bucket
+    """
+    counts = collections.defaultdict(lambda: [0] * len(BUCKET_LABELS))
+    for h in holds:
+        if h.end is not None:
+            counts[h.lockmode][bisect.bisect_right(BUCKETS,
+                                                   h.end - h.start)] += 1
+    return counts
+
+
+def print_profile(holds, top):
+    done = [h for h in holds if h.end is not None]
+    print(f"{len(done)} lock holds, {len(holds) - len(done)} still held "
+          f"when the trace ended")
+
+    print(f"\n{'lockmode':<26}" +
+          "".join(f"{label:>8}" for label in BUCKET_LABELS))
+    for mode, counts in sorted(histogram(done).items()):
+        print(f"{mode:<26}" + "".join(f"{n:>8}" for n in counts))
+
+    print(f"\n{'seconds':>10} {'pid':>8} {'released':<9} lock")
+    longest = sorted(done, key=lambda h: h.end - h.start, reverse=True)
+    for h in longest[:top]:
+        print(f"{h.end - h.start:>10.6f} {h.pid:>8} {h.released_by:<9} "
+              f"{h.lockmode} on {h.relname}")
+        if h.stack:
+            print("    taken at " + " < ".join(h.stack[:6]))
+
+    at_end = collections.Counter(
+        (h.relname, h.lockmode) for h in done if h.released_by != "close")
+    if at_end:
+        print(f"\n{'count':>8}  held until the end of the transaction")
+        for (relname, mode), n in at_end.most_common(top):
+            print(f"{n:>8}  {mode} on {relname}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Lock hold times from relation_lock_trace.py events')
+    parser.add_argument('events', nargs='+', help='JSON lines event files')
+    parser.add_argument('-m', '--lockmode', nargs='+',
+                        help='only these lock modes')
+    parser.add_argument('-r', '--relname', nargs='+',
+                        help='only these relations')
+    parser.add_argument('-t', '--top', type=int, default=20,
+                        help='number of holds and relations listed, '
+                             'default: 20')
+    args = parser.parse_args(argv)
+
+    holds = pair_holds(read_events(args.events))
+    if args.lockmode:
+        holds = [h for h in holds if h.lockmode in args.lockmode]
+    if args.relname:
+        holds = [h for h in holds if h.relname in args.relname]
+    print_profile(holds, args.top)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+#
+# Trace the relation locks of many backends at once and merge their events
+# into one timeline.
+#
+#   $ python3 lock_timeline.py trace -d 60 12345 12346 12347
+#   $ python3 lock_timeline.py trace -P $(head -1 $PGDATA/postmaster.pid)
+#   $ python3 lock_timeline.py merge lock-traces/*.jsonl -o timeline.txt
+#
+# trace runs one gdb per backend in parallel, each sourcing
+# relation_lock_trace.py and writing <outdir>/<pid>.jsonl, until the
+# duration is over, all backends exited or Ctrl-C.  Every gdb is then
+# interrupted, stops tracing and detaches, and the event files are merged.
+#
+# The timeline has one line per event, ordered by time across backends.
+# Each open lists the locks other backends held on the same relation while
+# it slept for its lock, marking those whose mode conflicts with it, so a
+# convoy shows up as a run of opens waiting on the same holder and a
+# deadlock as backends waiting on each other.  The longest waits and their
+# blockers are summed up at the end.
+#
+import os
+import sys
+import time
+import bisect
+import signal
+import argparse
+import subprocess
+import collections
+
+from lock_profile import read_events, pair_holds
+
+
+# lock.c LockConflicts: the modes each mode conflicts with
+LOCK_CONFLICTS = {
+    "AccessShareLock": {"AccessExclusiveLock"},
+    "RowShareLock": {"ExclusiveLock", "AccessExclusiveLock"},
+    "RowExclusiveLock": {"ShareLock", "ShareRowExclusiveLock",
+                         "ExclusiveLock", "AccessExclusiveLock"},
+    "ShareUpdateExclusiveLock": {"ShareUpdateExclusiveLock", "ShareLock",
+                                 "ShareRowExclusiveLock", "ExclusiveLock",
+                                 "AccessExclusiveLock"},
+    "ShareLock": {"RowExclusiveLock", "ShareUpdateExclusiveLock",
+                  "ShareRowExclusiveLock", "ExclusiveLock",
+                  "AccessExclusiveLock"},
+    "ShareRowExclusiveLock": {"RowExclusiveLock", "ShareUpdateExclusiveLock",
+                              "ShareLock", "ShareRowExclusiveLock",
+                              "ExclusiveLock", "AccessExclusiveLock"},
+    "ExclusiveLock": {"RowShareLock", "RowExclusiveLock",
+                      "ShareUpdateExclusiveLock", "ShareLock",
+                      "ShareRowExclusiveLock", "ExclusiveLock",
+                      "AccessExclusiveLock"},
+    "AccessExclusiveLock": {"AccessShareLock", "RowShareLock",
+                            "RowExclusiveLock", "ShareUpdateExclusiveLock",
+                            "ShareLock", "ShareRowExclusiveLock",
+                            "ExclusiveLock", "AccessExclusiveLock"},
+}
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "relation_lock_trace.py")
+
+
+def conflicts(mode, other):
+    return other in LOCK_CONFLICTS.get(mode, ())
+
+
+def postmaster_children(postmaster):
+    out = subprocess.run(["pgrep", "-P", str(postmaster)],
+                         capture_output=True, text=True).stdout
+    return sorted(int(pid) for pid in out.split())
+
+
+def gdb_command(gdb, pid, path, stack):
+    return [
+        gdb, "-nx", "-batch", "-p", str(pid),
+        "-ex", "set pagination off",
+        # the backend's own signals must not end the `continue`, and the
+        # SIGINT that does must not reach the backend as a query cancel
+        "-ex", "handle all nostop noprint pass",
+        "-ex", "handle SIGINT stop print nopass",
+        "-ex", f"source {SCRIPT}",
+        "-ex", f"trace-relation-locks start -o {path} -s {stack}",
+        "-ex", "continue",
+        "-ex", "trace-relation-locks stop",
+        "-ex", "detach",
+    ]
+
+
+def trace_backends(pids, outdir, stack, duration, gdb="gdb"):
+    """
+    Trace pids with one gdb each until duration seconds passed (None for
+    no limit), all of them exited or Ctrl-C.  Returns the event files.
+    """
+    running = []
+    for pid in pids:
+        path = os.path.join(outdir, f"{pid}.jsonl")
+        # EventWriter appends
+        if os.path.exists(path):
+            os.remove(path)
+        log = open(os.path.join(outdir, f"{pid}.log"), "w")
+        # a session of its own, so that Ctrl-C only reaches this driver
+        proc = subprocess.Popen(gdb_command(gdb, pid, path, stack),
+                                stdin=subprocess.DEVNULL, stdout=log,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True)
+        running.append((pid, path, proc, log))
+    print(f"tracing {len(running)} backends, Ctrl-C to stop",
+          file=sys.stderr)
+
+    deadline = time.monotonic() + duration if duration else None
+    try:
+        while any(proc.poll() is None for _, _, proc, _ in running):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+
+    for _, _, proc, _ in running:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+    paths = []
+    for pid, path, proc, log in running:
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        log.close()
+        if os.path.exists(path):
+            paths.append(path)
+        else:
+            print(f"{pid}: no events, see {log.name}", file=sys.stderr)
+    return paths
+
+
+def index_holds(holds):
+    """
+    oid -> (start times, holds) sorted by start
+    """
+    by_oid = collections.defaultdict(list)
+    for h in holds:
+        by_oid[h.oid].append(h)
+    index = {}
+    for oid, hs in by_oid.items():
+        hs.sort(key=lambda h: h.start)
+        index[oid] = ([h.start for h in hs], hs)
+    return index
+
+
+def held_by_others(index, e):
+    """
+    Holds of other backends on the relation of open event e that overlap
+    its wait, the time it slept for the lock right before it returned
+    """
+    if e["oid"] not in index:
+        return []
+    starts, holds = index[e["oid"]]
+    called = e["ts"] - e.get("wait", 0)
+    return [h for h in holds[:bisect.bisect_right(starts, e["ts"])]
+            if h.pid != e["pid"] and (h.end is None or h.end > called)]
+
+
+def describe(e, index):
+    if e["event"] == "xact_end":
+        return e["how"]
+    if e["event"] == "close":
+        if e["lockmode"] == "NoLock":
+            return f"close {e['relname']}, lock kept"
+        return f"release {e['lockmode']} on {e['relname']}"
+    text = f"open {e['lockmode']} on {e['relname']}"
+    if e.get("wait"):
+        text += f", waited {e['wait']:.6f}s"
+    others = []
+    for h in held_by_others(index, e):
+        mark = "!" if conflicts(e["lockmode"], h.lockmode) else ""
+        others.append(f"{h.pid} {h.lockmode}{mark}")
+    if others:
+        text += "; held by " + ", ".join(others)
+    return text
+
+
+def write_timeline(events, out, min_wait, top):
+    holds = pair_holds(events)
+    index = index_holds(holds)
+    t0 = events[0]["ts"] if events else 0
+    waits = []
+    for e in events:
+        out.write(f"{e['ts'] - t0:>12.6f} {e['pid']:>8} "
+                  f"{describe(e, index)}\n")
+        if e["event"] == "open" and e.get("wait", 0) >= min_wait:
+            blockers = [h for h in held_by_others(index, e)
+                        if conflicts(e["lockmode"], h.lockmode)]
+            waits.append((e, blockers))
+
+    out.write(f"\n{len(events)} events of "
+              f"{len(set(e['pid'] for e in events))} backends, "
+              f"{len(waits)} opens waited {min_wait * 1000:g}ms or more\n")
+    if not waits:
+        return
+    out.write(f"\n{'waited':>10} {'at':>12} {'pid':>8} lock, blocked by\n")
+    waits.sort(key=lambda w: w[0]["wait"], reverse=True)
+    for e, blockers in waits[:top]:
+        blocked_by = ", ".join(f"{h.pid} {h.lockmode}" for h in blockers)
+        out.write(f"{e['wait']:>10.6f} {e['ts'] - t0:>12.6f} "
+                  f"{e['pid']:>8} {e['lockmode']} on {e['relname']}"
+                  + (f", {blocked_by}" if blocked_by else "") + "\n")
+    blocking = collections.Counter(
+        (h.pid, h.lockmode, h.relname) for _, blockers in waits
+        for h in blockers)
+    if blocking:
+        out.write(f"\n{'blocked':>8} {'pid':>8} holding\n")
+        for (pid, mode, relname), n in blocking.most_common(top):
+            out.write(f"{n:>8} {pid:>8} {mode} on {relname}\n")
+
+
+def merge(paths, output, min_wait, top):
+    events = read_events(paths)
+    with open(output, "w") as out:
+        write_timeline(events, out, min_wait, top)
+    print(f"{len(events)} events of {len(paths)} files merged into {output}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Merge the relation locks of many backends by time')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    trace = commands.add_parser(
+        'trace', help='trace backends in parallel, then merge')
+    trace.add_argument('pids', nargs='*', type=int, metavar='pid',
+                       help='backend pids')
+    trace.add_argument('-P', '--postmaster', type=int, metavar='pid',
+                       help='trace all children of this postmaster')
+    trace.add_argument('-d', '--duration', type=float, metavar='seconds',
+                       help='stop after this long, default: Ctrl-C')
+    trace.add_argument('-o', '--outdir', default='lock-traces',
+                       help='directory of the event files and the '
+                            'timeline, default: lock-traces')
+    trace.add_argument('-s', '--stack', type=int, default=0,
+                       metavar='depth',
+                       help='add this many frames of the stack to each '
+                            'event')
+    trace.add_argument('--gdb', default='gdb', help='gdb to run')
+
+    merged = commands.add_parser(
+        'merge', help='merge event files of relation_lock_trace.py')
+    merged.add_argument('events', nargs='+', help='JSON lines event files')
+    merged.add_argument('-o', '--output', default='timeline.txt',
+                        help='timeline file, default: timeline.txt')
+
+    for p in (trace, merged):
+        p.add_argument('-w', '--min-wait', type=float, default=1,
+                       metavar='ms',
+                       help='list opens that waited this long, default: 1')
+        p.add_argument('-t', '--top', type=int, default=20,
+                       help='number of waits and blockers listed, '
+                            'default: 20')
+    args = parser.parse_args(argv)
+
+    if args.command == 'merge':
+        merge(args.events, args.output, args.min_wait / 1000, args.top)
+        return
+
+    pids = list(args.pids)
+    if args.postmaster:
+        pids += postmaster_children(args.postmaster)
+    if not pids:
+        trace.error("no backend pids given")
+    os.makedirs(args.outdir, exist_ok=True)
+    paths = trace_backends(pids, args.outdir, args.stack, args.duration,
+                           args.gdb)
+    merge(paths, os.path.join(args.outdir, "timeline.txt"),
+          args.min_wait / 1000, args.top)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+#
+# Trace the relation locks taken and released by a backend, without leaving
+# gdb: relation names are read from the Relation in the backend's memory,
+# and the events are buffered and written as JSON lines.
+#
+#   (gdb) source relation_lock_trace.py
+#   (gdb) trace-relation-locks start -o locks.jsonl
+#   (gdb) continue
+#   ...
+#   (gdb) trace-relation-locks stop
+#
+# An event is {"ts": unix time, "pid": backend pid, "event": "open" or
+# "close", "oid", "relname", "lockmode"}, with the function names of the
+# calling stack in "stack" if asked for.  An open also has in "wait" the
+# seconds the backend slept in ProcSleep for a lock while relation_open
+# ran, 0 if it got its lock right away.  The end of a transaction, which
+# releases the locks still held, is {"ts", "pid", "event": "xact_end",
+# "how": "commit", "abort" or "prepare"}.
+# lock_profile.py pairs them up, lock_timeline.py merges many backends.
+#
+# relation_open only has the Relation when it returns, and a stop() method
+# cannot create breakpoints, so the `ret` instructions of relation_open are
+# found by disassembling it once and get breakpoints of their own, and so
+# do those of ProcSleep.  The wait is timed around ProcSleep rather than
+# relation_open, whose run time is mostly that of the debugger stopping
+# the backend for nested opens, the stack, and the stop() methods.
+#
+import gdb
+import json
+import time
+import argparse
+import shlex
+
+
+# lockdefs.h
+LOCKMODE_NAMES = [
+    "NoLock",
+    "AccessShareLock",
+    "RowShareLock",
+    "RowExclusiveLock",
+    "ShareUpdateExclusiveLock",
+    "ShareLock",
+    "ShareRowExclusiveLock",
+    "ExclusiveLock",
+    "AccessExclusiveLock",
+]
+
+# register of the return value
+RETURN_REGISTERS = {
+    "i386:x86-64": "$rax",
+    "aarch64": "$x0",
+}
+
+
+def lockmode_name(lockmode):
+    if 0 <= lockmode < len(LOCKMODE_NAMES):
+        return LOCKMODE_NAMES[lockmode]
+    return str(lockmode)
+
+
+def function_range(name):
+    """
+    Start and end address of the code of function name
+    """
+    symbol = gdb.lookup_global_symbol(name)
+    if symbol is None:
+        symbol = gdb.lookup_static_symbol(name)
+    assert symbol is not None, f"function {name} not found"
+    start = int(symbol.value().address)
+    block = gdb.block_for_pc(start)
+    while block is not None and block.function is None:
+        block = block.superblock
+    assert block is not None, f"no debug info for {name}"
+    return start, block.end
+
+
+def caller_sp(frame):
+    """
+    sp of the caller of frame.  It is the same at the breakpoint of a
+    function, which stops after the prologue moved sp, and at its return
+    instructions, so it pairs a call with its return.
+    """
+    return int(frame.older().read_register("sp"))
+
+
+def return_addresses(name):
+    """
+    Addresses of the return instructions of function name
+    """
+    start, end = function_range(name)
+    arch = gdb.selected_inferior().architecture()
+    addrs = []
+    for insn in arch.disassemble(start, end - 1):
+        mnemonic = insn["asm"].split()
+        if "ret" in mnemonic or "retq" in mnemonic:
+            addrs.append(insn["addr"])
+    return addrs
+
+
+class EventWriter:
+    """
+    Buffer events and append them to a JSON lines file every `batch` events
+    """
+
+    def __init__(self, path, batch=1000):
+        self.path = path
+        self.file = open(path, "a")
+        self.batch = batch
+        self.events = []
+        self.nevents = 0
+
+    def write(self, event):
+        self.events.append(json.dumps(event))
+        self.nevents += 1
+        if len(self.events) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.events:
+            self.file.write("\n".join(self.events) + "\n")
+            self.file.flush()
+            self.events.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class RelationLockTracer:
+    def __init__(self, writer, stack_depth):
+        self.writer = writer
+        self.stack_depth = stack_depth
+        self.pid = gdb.selected_inferior().pid
+        self.relation_type = gdb.lookup_type("Relation")
+        arch = gdb.selected_inferior().architecture().name()
+        assert arch in RETURN_REGISTERS, f"{arch} is not supported"
+        self.return_register = RETURN_REGISTERS[arch]
+        # oid -> relname
+        self.relnames = {}
+        # relation_open calls that did not return yet, innermost last, as
+        # [caller sp, lockmode, stack, seconds slept in ProcSleep]
+        self.pending = []
+        # caller sp and start time of the ProcSleep calls in progress
+        self.sleeping = []
+        self.breakpoints = [
+            RelationOpenBreakpoint(self),
+            RelationCloseBreakpoint(self),
+        ]
+        for addr in return_addresses("relation_open"):
+            self.breakpoints.append(RelationOpenReturnBreakpoint(self, addr))
+        self.breakpoints.append(ProcSleepBreakpoint(self))
+        for addr in return_addresses("ProcSleep"):
+            self.breakpoints.append(ProcSleepReturnBreakpoint(self, addr))
+        for function, how in XactEndBreakpoint.FUNCTIONS:
+            self.breakpoints.append(XactEndBreakpoint(self, function, how))
+
+    def stack(self):
+        if not self.stack_depth:
+            return None
+        names = []
+        frame = gdb.newest_frame()
+        while frame is not None and len(names) < self.stack_depth:
+            names.append(frame.name() or f"{frame.pc():#x}")
+            frame = frame.older()
+        return names
+
+    def relation(self, relation):
+        """
+        oid and name of a Relation, the name read once per oid
+        """
+        oid = int(relation["rd_id"])
+        relname = self.relnames.get(oid)
+        if relname is None:
+            relname = relation["rd_rel"]["relname"]["data"].string()
+            self.relnames[oid] = relname
+        return oid, relname
+
+    def xact_end(self, how):
+        self.writer.write({"ts": time.time(), "pid": self.pid,
+                           "event": "xact_end", "how": how})
+
+    def event(self, name, oid, relname, lockmode, stack, **extra):
+        event = {"ts": time.time(), "pid": self.pid, "event": name,
+                 "oid": oid, "relname": relname,
+                 "lockmode": lockmode_name(lockmode), **extra}
+        if stack is not None:
+            event["stack"] = stack
+        self.writer.write(event)
+
+    def open_called(self, frame):
+        sp = caller_sp(frame)
+        self.pending.append([sp, int(frame.read_var("lockmode")),
+                             self.stack(), 0.0])
+
+    def open_returned(self, frame):
+        sp = caller_sp(frame)
+        # calls left by an ERROR are dropped here
+        while self.pending and self.pending[-1][0] < sp:
+            self.pending.pop()
+        if not self.pending or self.pending[-1][0] != sp:
+            return
+        _, lockmode, stack, slept = self.pending.pop()
+        relation = gdb.parse_and_eval(self.return_register) \
+            .cast(self.relation_type)
+        oid, relname = self.relation(relation)
+        self.event("open", oid, relname, lockmode, stack,
+                   wait=round(slept, 6))
+
+    def sleep_called(self, frame):
+        # the clock starts when this stop is over and ends when the return
+        # stops, leaving out the time spent in the debugger
+        self.sleeping.append((caller_sp(frame), time.time()))
+
+    def sleep_returned(self, frame):
+        returned = time.time()
+        sp = caller_sp(frame)
+        while self.sleeping and self.sleeping[-1][0] < sp:
+            self.sleeping.pop()
+        if not self.sleeping or self.sleeping[-1][0] != sp:
+            return
+        _, started = self.sleeping.pop()
+        # a lock taken by relation_open, or by something it called
+        if self.pending:
+            self.pending[-1][3] += returned - started
+
+    def close_called(self, frame):
+        relation = frame.read_var("relation")
+        oid, relname = self.relation(relation)
+        self.event("close", oid, relname, int(frame.read_var("lockmode")),
+                   self.stack())
+
+    def stop(self):
+        for bp in self.breakpoints:
+            bp.delete()
+        self.writer.close()
+
+
+class RelationOpenBreakpoint(gdb.Breakpoint):
+    def __init__(self, tracer):
+        super().__init__("relation_open", internal=True)
+        self.tracer = tracer
+
+    def stop(self):
+        self.tracer.open_called(gdb.selected_frame())
+        return False
+
+
+class RelationOpenReturnBreakpoint(gdb.Breakpoint):
+    def __init__(self, tracer, addr):
+        super().__init__(f"*{addr:#x}", internal=True)
+        self.tracer = tracer
+
+    def stop(self):
+        self.tracer.open_returned(gdb.selected_frame())
+        return False
+
+
+class ProcSleepBreakpoint(gdb.Breakpoint):
+    def __init__(self, tracer):
+        super().__init__("ProcSleep", internal=True)
+        self.tracer = tracer
+
+    def stop(self):
+        self.tracer.sleep_called(gdb.selected_frame())
+        return False
+
+
+class ProcSleepReturnBreakpoint(gdb.Breakpoint):
+    def __init__(self, tracer, addr):
+        super().__init__(f"*{addr:#x}", internal=True)
+        self.tracer = tracer
+
+    def stop(self):
+        self.tracer.sleep_returned(gdb.selected_frame())
+        return False
+
+
+class RelationCloseBreakpoint(gdb.Breakpoint):
+    def __init__(self, tracer):
+        super().__init__("relation_close", internal=True)
+        self.tracer = tracer
+
+    def stop(self):
+        self.tracer.close_called(gdb.selected_frame())
+        return False
+
+
+class XactEndBreakpoint(gdb.Breakpoint):
+    FUNCTIONS = [
+        ("CommitTransaction", "commit"),
+        ("AbortTransaction", "abort"),
+        ("PrepareTransaction", "prepare"),
+    ]
+
+    def __init__(self, tracer, function, how):
+        super().__init__(function, internal=True)
+        self.tracer = tracer
+        self.how = how
+
+    def stop(self):
+        self.tracer.xact_end(self.how)
+        return False
+
+
+_tracer = None
+
+
+class TraceRelationLocks(gdb.Command):
+    """
+    trace-relation-locks start [-o FILE] [-s DEPTH]: trace relation_open
+    and relation_close into a JSON lines file.
+    trace-relation-locks stop: remove the breakpoints and flush the file.
+    """
+
+    def __init__(self):
+        super().__init__("trace-relation-locks", gdb.COMMAND_USER)
+
+    def invoke(self, argument, from_tty):
+        global _tracer
+        parser = argparse.ArgumentParser(prog="trace-relation-locks")
+        parser.add_argument('action', nargs='?', default='start',
+                            choices=['start', 'stop'])
+        parser.add_argument('-o', '--output', default='relation_locks.jsonl',
+                            help='events file, default: relation_locks.jsonl')
+        parser.add_argument('-s', '--stack', type=int, default=0,
+                            metavar='depth',
+                            help='add this many frames of the stack to '
+                                 'each event')
+        args = parser.parse_args(shlex.split(argument))
+
+        if _tracer is not None:
+            _tracer.stop()
+            print(f"{_tracer.writer.nevents} events written to "
+                  f"{_tracer.writer.path}")
+            _tracer = None
+        if args.action == 'start':
+            _tracer = RelationLockTracer(EventWriter(args.output), args.stack)
+            print(f"tracing relation locks of {_tracer.pid} "
+                  f"to {args.output}")
+
+
+def _flush_on_exit(event):
+    if _tracer is not None:
+        _tracer.writer.flush()
+
+
+TraceRelationLocks()
+gdb.events.exited.connect(_flush_on_exit)
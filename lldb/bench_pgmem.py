@@ -0,0 +1,559 @@
+#
+# Benchmark the pgmem walkers on synthetic memory images, without lldb or a
+# live postgres.
+#
+#   $ python3 bench_pgmem.py
+#   $ python3 bench_pgmem.py wide freelist -r 5 -o bench.json
+#   $ python3 bench_pgmem.py -b bench.json
+#
+# Each scenario lays out memory contexts of a known shape, with their
+# blocks and freelists, in a MemoryImage served by fake_lldb, and counts
+# the totals pgmem has to find in it.  The walk is then timed through
+# collect_snapshot() like pgmem_cores.py does, and the wall time, the
+# ReadMemory calls and the bytes read are reported.  A scenario fails if
+# its totals differ from the ground truth, and with --baseline, a -o file
+# of an earlier run, if it got slower or reads more than it did.
+#
+import os
+import sys
+import json
+import time
+import array
+import random
+import argparse
+import tempfile
+import collections
+
+import fake_lldb
+from fake_lldb import MemoryImage, SBTarget, scalar_type, pointer_type, \
+    array_type, enum_type, struct_type
+
+
+BOOL = scalar_type("bool", 1, fake_lldb.eBasicTypeBool)
+CHAR = scalar_type("char", 1, fake_lldb.eBasicTypeChar)
+INT = scalar_type("int", 4, fake_lldb.eBasicTypeInt)
+INT32 = scalar_type("int32", 4, fake_lldb.eBasicTypeInt)
+UINT32 = scalar_type("uint32", 4, fake_lldb.eBasicTypeUnsignedInt)
+UINT64 = scalar_type("uint64", 8, fake_lldb.eBasicTypeUnsignedLong)
+SIZE = scalar_type("Size", 8, fake_lldb.eBasicTypeUnsignedLong)
+VOIDP = pointer_type(scalar_type("void", 1, fake_lldb.eBasicTypeOther))
+CHARP = pointer_type(CHAR)
+
+NODE_TAGS = {
+    450: "T_AllocSetContext",
+    451: "T_GenerationContext",
+    452: "T_SlabContext",
+    453: "T_BumpContext",
+}
+NODE_TAG = enum_type("NodeTag", NODE_TAGS)
+TAG_VALUES = {name: value for value, name in NODE_TAGS.items()}
+
+DLIST_NODE = struct_type("dlist_node", [("prev", VOIDP), ("next", VOIDP)])
+DLIST_HEAD = struct_type("dlist_head", [("head", DLIST_NODE)])
+DCLIST_HEAD = struct_type("dclist_head", [("dlist", DLIST_HEAD),
+                                          ("count", UINT32)])
+MEMORY_CONTEXT = struct_type("MemoryContextData", [
+    ("type", NODE_TAG), ("isReset", BOOL), ("allowInCritSection", BOOL),
+    ("mem_allocated", SIZE), ("methods", VOIDP), ("parent", VOIDP),
+    ("firstchild", VOIDP), ("prevchild", VOIDP), ("nextchild", VOIDP),
+    ("name", CHARP), ("ident", CHARP), ("reset_cbs", VOIDP)])
+ALLOC_SET = struct_type("AllocSetContext", [
+    ("header", MEMORY_CONTEXT), ("blocks", VOIDP),
+    ("freelist", array_type(VOIDP, 11)), ("initBlockSize", UINT32),
+    ("maxBlockSize", UINT32), ("nextBlockSize", UINT32),
+    ("allocChunkLimit", UINT32), ("freeListIndex", INT)])
+ALLOC_BLOCK = struct_type("AllocBlockData", [
+    ("aset", VOIDP), ("prev", VOIDP), ("next", VOIDP), ("freeptr", VOIDP),
+    ("endptr", VOIDP)])
+MEMORY_CHUNK = struct_type("MemoryChunk", [("hdrmask", UINT64)])
+FREE_LIST_LINK = struct_type("AllocFreeListLink", [
+    ("next", pointer_type(MEMORY_CHUNK))])
+GENERATION = struct_type("GenerationContext", [
+    ("header", MEMORY_CONTEXT), ("initBlockSize", UINT32),
+    ("maxBlockSize", UINT32), ("nextBlockSize", UINT32),
+    ("allocChunkLimit", UINT32), ("block", VOIDP), ("freeblock", VOIDP),
+    ("blocks", DLIST_HEAD)])
+GENERATION_BLOCK = struct_type("GenerationBlock", [
+    ("node", DLIST_NODE), ("context", VOIDP), ("blksize", SIZE),
+    ("nchunks", INT), ("nfree", INT), ("freeptr", VOIDP), ("endptr", VOIDP)])
+SLAB = struct_type("SlabContext", [
+    ("header", MEMORY_CONTEXT), ("chunkSize", UINT32),
+    ("fullChunkSize", UINT32), ("blockSize", UINT32),
+    ("chunksPerBlock", INT32), ("curBlocklistIndex", INT32),
+    ("blocklist_shift", INT32), ("emptyblocks", DCLIST_HEAD),
+    ("blocklist", array_type(DLIST_HEAD, 3))])
+SLAB_BLOCK = struct_type("SlabBlock", [
+    ("slab", VOIDP), ("nfree", INT32), ("nunused", INT32),
+    ("freehead", VOIDP), ("unused", VOIDP), ("node", DLIST_NODE)])
+BUMP = struct_type("BumpContext", [
+    ("header", MEMORY_CONTEXT), ("initBlockSize", UINT32),
+    ("maxBlockSize", UINT32), ("nextBlockSize", UINT32),
+    ("allocChunkLimit", UINT32), ("blocks", DLIST_HEAD)])
+BUMP_BLOCK = struct_type("BumpBlock", [
+    ("node", DLIST_NODE), ("freeptr", VOIDP), ("endptr", VOIDP)])
+
+TYPES = [BOOL, CHAR, NODE_TAG, DLIST_NODE, DLIST_HEAD, DCLIST_HEAD,
+         MEMORY_CONTEXT, ALLOC_SET, ALLOC_BLOCK, MEMORY_CHUNK, FREE_LIST_LINK,
+         GENERATION, GENERATION_BLOCK, SLAB, SLAB_BLOCK, BUMP, BUMP_BLOCK]
+
+CONTEXT_TYPES = {
+    "T_AllocSetContext": ALLOC_SET,
+    "T_GenerationContext": GENERATION,
+    "T_SlabContext": SLAB,
+    "T_BumpContext": BUMP,
+}
+
+COUNTERS = ["nblocks", "freechunks", "totalspace", "freespace"]
+
+
+def offsetof(typ, path):
+    offset = 0
+    for name in path.split("."):
+        for i in range(typ.GetNumberOfFields()):
+            field = typ.GetFieldAtIndex(i)
+            if field.GetName() == name:
+                offset += field.GetOffsetInBytes()
+                typ = field.GetType()
+                break
+        else:
+            raise KeyError(f"{typ.GetName()} has no field {name}")
+    return offset
+
+
+def maxalign(size):
+    return (size + 7) & ~7
+
+
+class SyntheticBackend:
+    """
+    Memory contexts of a backend laid out in a MemoryImage, with the
+    totals AllocSetStats() and friends should report for them in expected
+    """
+
+    def __init__(self, seed=0):
+        self.image = MemoryImage()
+        self.rng = random.Random(seed)
+        self.expected = collections.Counter()
+        self.contexts = 0
+        # the names are static strings, shared by the contexts
+        self._names = {}
+
+    def _name(self, name):
+        addr = self._names.get(name)
+        if addr is None:
+            addr = self._names[name] = self.image.cstring(name)
+        return addr
+
+    def _dlist_init(self, head):
+        self.image.put(head, "QQ", head, head)
+
+    def _dlist_push_head(self, head, node):
+        first = self.image.get(head + 8, "Q")[0]
+        self.image.put(node, "QQ", head, first)
+        self.image.put(first, "Q", node)
+        self.image.put(head + 8, "Q", node)
+
+    def context(self, kind, parent, name, ident=None, **params):
+        typ = CONTEXT_TYPES[kind]
+        addr = self.image.alloc(typ.GetByteSize())
+        image = self.image
+        image.put(addr, "I", TAG_VALUES[kind])
+        image.put(addr + offsetof(MEMORY_CONTEXT, "name"), "Q",
+                  self._name(name))
+        if ident:
+            image.put(addr + offsetof(MEMORY_CONTEXT, "ident"), "Q",
+                      image.cstring(ident))
+        if parent:
+            # MemoryContextCreate() pushes the new child at the front
+            first = image.get(parent + offsetof(MEMORY_CONTEXT, "firstchild"),
+                              "Q")[0]
+            image.put(addr + offsetof(MEMORY_CONTEXT, "parent"), "Q", parent)
+            image.put(addr + offsetof(MEMORY_CONTEXT, "nextchild"), "Q",
+                      first)
+            if first:
+                image.put(first + offsetof(MEMORY_CONTEXT, "prevchild"), "Q",
+                          addr)
+            image.put(parent + offsetof(MEMORY_CONTEXT, "firstchild"), "Q",
+                      addr)
+
+        if kind == "T_AllocSetContext":
+            self.expected["totalspace"] += maxalign(ALLOC_SET.GetByteSize())
+        elif kind == "T_GenerationContext":
+            self._dlist_init(addr + offsetof(GENERATION, "blocks"))
+            self.expected["totalspace"] += maxalign(GENERATION.GetByteSize())
+        elif kind == "T_BumpContext":
+            self._dlist_init(addr + offsetof(BUMP, "blocks"))
+        elif kind == "T_SlabContext":
+            chunk_size = params.get("chunk_size", 64)
+            block_size = params.get("block_size", 8192)
+            image.put(addr + offsetof(SLAB, "fullChunkSize"), "III",
+                      chunk_size + 8, block_size,
+                      block_size // (chunk_size + 8))
+            self._dlist_init(addr + offsetof(SLAB, "emptyblocks"))
+            for i in range(3):
+                self._dlist_init(addr + offsetof(SLAB, "blocklist")
+                                 + i * DLIST_HEAD.GetByteSize())
+            self.expected["totalspace"] += SLAB.GetByteSize()
+        self.contexts += 1
+        return addr
+
+    def aset_block(self, aset, size=8192, used=4096):
+        blk = self.image.alloc(size, backed=ALLOC_BLOCK.GetByteSize())
+        blocks = aset + offsetof(ALLOC_SET, "blocks")
+        first = self.image.get(blocks, "Q")[0]
+        self.image.put(blk, "QQQQQ", aset, 0, first, blk + used, blk + size)
+        if first:
+            self.image.put(first + offsetof(ALLOC_BLOCK, "prev"), "Q", blk)
+        self.image.put(blocks, "Q", blk)
+        self.expected["nblocks"] += 1
+        self.expected["totalspace"] += size
+        self.expected["freespace"] += size - used
+        return blk
+
+    def aset_freelist(self, aset, fidx, nchunks, shuffle=False):
+        """
+        Push nchunks free chunks on freelist[fidx], linked in address
+        order or, with shuffle, in random order
+        """
+        if not nchunks:
+            return
+        stride = MEMORY_CHUNK.GetByteSize() + (8 << fidx)
+        base = self.image.alloc(nchunks * stride)
+        slot = aset + offsetof(ALLOC_SET, "freelist") + 8 * fidx
+        head = self.image.get(slot, "Q")[0]
+        words = array.array("Q", bytes(nchunks * stride))
+        per_chunk = stride // 8
+        order = list(range(nchunks))
+        if shuffle:
+            self.rng.shuffle(order)
+        for i in order:
+            # the AllocFreeListLink right after the chunk header
+            words[i * per_chunk + 1] = head
+            head = base + i * stride
+        self.image.write(base, words.tobytes())
+        self.image.put(slot, "Q", head)
+        self.expected["freechunks"] += nchunks
+        self.expected["freespace"] += nchunks * stride
+
+    def generation_block(self, gen, size=8192, nchunks=64, nfree=8,
+                         used=4096):
+        blk = self.image.alloc(size, backed=GENERATION_BLOCK.GetByteSize())
+        self.image.put(blk + offsetof(GENERATION_BLOCK, "context"), "QQiiQQ",
+                       gen, size, nchunks, nfree, blk + used, blk + size)
+        self._dlist_push_head(gen + offsetof(GENERATION, "blocks"), blk)
+        self.expected["nblocks"] += 1
+        self.expected["totalspace"] += size
+        self.expected["freespace"] += size - used
+        self.expected["freechunks"] += nfree
+        return blk
+
+    def slab_block(self, slab, nfree):
+        """
+        A block with nfree free chunks, on the emptyblocks list if all of
+        them are
+        """
+        image = self.image
+        chunk, size, per_block = image.get(
+            slab + offsetof(SLAB, "fullChunkSize"), "III")
+        blk = image.alloc(size, backed=SLAB_BLOCK.GetByteSize())
+        image.put(blk, "Qi", slab, nfree)
+        node = blk + offsetof(SLAB_BLOCK, "node")
+        if nfree == per_block:
+            empty = slab + offsetof(SLAB, "emptyblocks")
+            self._dlist_push_head(empty, node)
+            count = empty + offsetof(DCLIST_HEAD, "count")
+            image.put(count, "I", image.get(count, "I")[0] + 1)
+            self.expected["totalspace"] += size
+            return blk
+        # blocklist[0] holds the full blocks, the others by fullness
+        index = 0 if nfree == 0 else 1 + (nfree * 2 > per_block)
+        self._dlist_push_head(slab + offsetof(SLAB, "blocklist")
+                              + index * DLIST_HEAD.GetByteSize(), node)
+        self.expected["nblocks"] += 1
+        self.expected["totalspace"] += size
+        self.expected["freespace"] += nfree * chunk
+        self.expected["freechunks"] += nfree
+        return blk
+
+    def bump_block(self, bump, size=8192, used=4096):
+        blk = self.image.alloc(size, backed=BUMP_BLOCK.GetByteSize())
+        self.image.put(blk + offsetof(BUMP_BLOCK, "freeptr"), "QQ",
+                       blk + used, blk + size)
+        self._dlist_push_head(bump + offsetof(BUMP, "blocks"), blk)
+        self.expected["nblocks"] += 1
+        self.expected["totalspace"] += size
+        self.expected["freespace"] += size - used
+        return blk
+
+    def populate(self, kind, context, blocks=2):
+        """
+        Give a context a few blocks and free chunks of its kind
+        """
+        if kind == "T_AllocSetContext":
+            for i in range(blocks):
+                self.aset_block(context, 8192 << i, 1024 + 512 * i)
+            self.aset_freelist(context, self.rng.randrange(4),
+                               self.rng.randrange(16))
+        elif kind == "T_GenerationContext":
+            for _ in range(blocks):
+                self.generation_block(context, nfree=self.rng.randrange(64))
+        elif kind == "T_SlabContext":
+            for _ in range(blocks):
+                self.slab_block(context, self.rng.randrange(114))
+        else:
+            for _ in range(blocks):
+                self.bump_block(context, used=self.rng.randrange(32, 8192))
+
+    def target(self):
+        target = SBTarget(self.image, TYPES, "bench-pgmem")
+        for name in ["TopMemoryContext", "CurrentMemoryContext"]:
+            slot = self.image.alloc(8)
+            self.image.put(slot, "Q", self.top)
+            target.globals[name] = (slot, pointer_type(MEMORY_CONTEXT))
+        return target
+
+    def top_context(self):
+        self.top = self.context("T_AllocSetContext", 0, "TopMemoryContext")
+        self.populate("T_AllocSetContext", self.top)
+        return self.top
+
+
+#
+# Scenarios: build a backend for a scale factor, return it with the pgmem
+# options of the walk
+#
+
+def scenario_wide(backend, scale):
+    """
+    10k AllocSets under TopMemoryContext, as with many cached plans
+    """
+    top = backend.top_context()
+    for i in range(10000 * scale):
+        cxt = backend.context("T_AllocSetContext", top, "CachedPlan",
+                              f"select {i}")
+        backend.populate("T_AllocSetContext", cxt)
+    return ""
+
+
+def scenario_deep(backend, scale):
+    """
+    A chain of 500 contexts, each the only child of the one before
+    """
+    parent = backend.top_context()
+    for i in range(500 * scale):
+        parent = backend.context("T_AllocSetContext", parent,
+                                 "ExprContext")
+        backend.populate("T_AllocSetContext", parent, blocks=1)
+    return ""
+
+
+def scenario_tree(backend, scale):
+    """
+    10k contexts of all kinds, eight children per context
+    """
+    kinds = list(CONTEXT_TYPES)
+    level = [backend.top_context()]
+    n = 10000 * scale
+    while n > 0:
+        children = []
+        for parent in level:
+            for _ in range(min(8, n)):
+                kind = kinds[backend.contexts % len(kinds)]
+                cxt = backend.context(kind, parent, kind[2:-7])
+                backend.populate(kind, cxt)
+                children.append(cxt)
+                n -= 1
+        level = children
+    return ""
+
+
+def scenario_freelist(backend, scale, shuffle=False):
+    """
+    One AllocSet with 2M free chunks in its small freelists
+    """
+    top = backend.top_context()
+    cxt = backend.context("T_AllocSetContext", top, "ExecutorState")
+    backend.aset_block(cxt, 8 << 20, 8 << 20)
+    for fidx, nchunks in enumerate([1000000, 600000, 400000]):
+        backend.aset_freelist(cxt, fidx, nchunks * scale, shuffle)
+    return "-c 0"
+
+
+def scenario_freelist_shuffled(backend, scale):
+    """
+    Like freelist, the chunks linked in random order
+    """
+    return scenario_freelist(backend, scale, shuffle=True)
+
+
+def scenario_generation(backend, scale):
+    """
+    One Generation context with 100k blocks
+    """
+    top = backend.top_context()
+    cxt = backend.context("T_GenerationContext", top, "ReorderBuffer")
+    for _ in range(100000 * scale):
+        backend.generation_block(cxt, nfree=backend.rng.randrange(64))
+    return ""
+
+
+def scenario_sampled(backend, scale):
+    """
+    wide with a budget of 1000 contexts, the rest estimated from samples
+    """
+    scenario_wide(backend, scale)
+    return "--budget-nodes 1000 --seed 1"
+
+
+def scenario_sampled_tree(backend, scale):
+    """
+    tree with a budget of 50 contexts: the sampling itself must stay
+    bounded where every context has fewer children than --sample-size
+    """
+    scenario_tree(backend, scale)
+    return "--budget-nodes 50 --seed 1"
+
+
+SCENARIOS = {
+    name[len("scenario_"):]: fn for name, fn in globals().items()
+    if name.startswith("scenario_")
+}
+
+
+def check(backend, records, totals, sampled):
+    """
+    Differences between the walk and the ground truth
+    """
+    errors = []
+    if sampled:
+        truth = backend.expected["totalspace"]
+        if len(records) >= backend.contexts:
+            errors.append("walked every context")
+        if not totals.estimated:
+            errors.append("not estimated")
+        elif abs(totals.totalspace - truth) > 1.5 * totals.interval():
+            errors.append(f"totalspace {totals.totalspace} "
+                          f"±{totals.interval():.0f} misses {truth}")
+        return errors
+    if len(records) != backend.contexts:
+        errors.append(f"{len(records)} contexts, not {backend.contexts}")
+    for counter in COUNTERS:
+        value = getattr(totals, counter)
+        if value != backend.expected[counter]:
+            errors.append(f"{counter} {value}, not "
+                          f"{backend.expected[counter]}")
+    if totals.estimated:
+        errors.append("estimated")
+    return errors
+
+
+def run_scenario(walker, name, scale, repeats):
+    started = time.perf_counter()
+    backend = SyntheticBackend()
+    walk_args = SCENARIOS[name](backend, scale)
+    target = backend.target()
+    built = time.perf_counter() - started
+
+    best = None
+    for _ in range(repeats):
+        target.process.calls.clear()
+        walker.use_target(target)
+        started = time.perf_counter()
+        records, totals = walker.collect_snapshot(backend.top, walk_args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    calls = target.process.calls
+    return {
+        "scenario": name,
+        "contexts": backend.contexts,
+        "walked": len(records),
+        "seconds": round(best, 4),
+        "build_seconds": round(built, 2),
+        "reads": calls["ReadMemory"],
+        "cstrings": calls["ReadCStringFromMemory"],
+        "bytes": calls["bytes"],
+        "totalspace": totals.totalspace,
+        "errors": check(backend, records, totals, "--budget" in walk_args),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """
+    How result regressed against the baseline result of its scenario
+    """
+    regressions = []
+    if result["seconds"] > baseline["seconds"] * (1 + tolerance):
+        regressions.append(f"slower than {baseline['seconds']}s")
+    for counter in ["reads", "cstrings", "bytes"]:
+        if result[counter] > baseline[counter]:
+            regressions.append(f"more {counter} than {baseline[counter]}")
+    return regressions
+
+
+def import_walker(cache_dir):
+    """
+    pg_memcxt_stats on top of fake_lldb, its type layouts cached in
+    cache_dir
+    """
+    os.environ["LLDB_SNIPPETS_CACHE"] = cache_dir
+    sys.modules["lldb"] = fake_lldb
+    import pg_memcxt_stats
+    return pg_memcxt_stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pgmem walkers on synthetic memory images')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='scenarios to run, default: all of '
+                             + ', '.join(SCENARIOS))
+    parser.add_argument('-s', '--scale', type=int, default=1,
+                        help='multiply the size of the scenarios')
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='walks per scenario, the fastest is reported, '
+                             'default: 3')
+    parser.add_argument('-o', '--output', metavar='bench.json',
+                        help='write the results here')
+    parser.add_argument('-b', '--baseline', metavar='bench.json',
+                        help='results of an earlier run to compare with')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='slowdown against the baseline taken as a '
+                             'regression, default: 0.2')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        walker = import_walker(cache_dir)
+        print(f"{'scenario':<18} {'contexts':>9} {'seconds':>9} "
+              f"{'reads':>9} {'cstrings':>9} {'MB read':>9}")
+        results = []
+        failed = 0
+        for name in args.scenarios or SCENARIOS:
+            r = run_scenario(walker, name, args.scale, args.repeats)
+            results.append(r)
+            problems = r["errors"]
+            if name in baseline:
+                problems = problems + compare(r, baseline[name],
+                                              args.tolerance)
+            failed += bool(problems)
+            print(f"{name:<18} {r['contexts']:>9} {r['seconds']:>9.3f} "
+                  f"{r['reads']:>9} {r['cstrings']:>9} "
+                  f"{r['bytes'] / (1 << 20):>9.1f}"
+                  + (" FAIL: " + "; ".join(problems) if problems else ""))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"scale": args.scale, "results": results}, f, indent=1)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,276 @@
 # put this script under your {workspaceFolder}
 # in code-lldb debug terminal, execute:
 # command script import debug.py
+#
+# dumparray writes the elements of an array to a file, e.g. a
+# Vec<DeltaEntry>, a slice, a C array, or count elements behind a pointer:
+#
+#   (lldb) dumparray all_keys
+#   (lldb) dumparray -j -o keys.jsonl all_keys
+#   (lldb) dumparray -t DeltaEntry -c 632 entries_ptr
+#
+# The buffer is read with a few large ReadMemory calls and the elements are
+# decoded with the flattened layout of the element type, which is cached
+# per build-id like the pgmem layouts, instead of evaluating a `p` per
+# element.
 import lldb
+import json
+import time
+import shlex
+import struct
+import argparse
 
-# this file will be under your {workspaceFolder}
-with open("./lldb_output.txt", "w") as f:
-    # Run an LLDB command and capture its output
-    interpreter = lldb.debugger.GetCommandInterpreter()
-    # redirect lldb command output to this object
-    result = lldb.SBCommandReturnObject()
-
-    for i in range(632):
-        # your lldb command
-        # this command will print one element in Vec<DeltaEntry>
-        cmd = f'p *({i} + (pageserver::tenant::storage_layer::delta_layer::DeltaEntry *)(unsigned char *)all_keys.buf.inner.ptr.pointer.pointer)'
-        interpreter.HandleCommand(cmd, result)
-
-        if result.Succeeded():
-            f.write(result.GetOutput())
-        else:
-            f.write("Command failed: " + result.GetError())
+from type_layout import TypeLayoutCache
+
+
+# the type layouts of the target dumped last
+_layouts = None
+
+
+def _type_layouts(target):
+    global _layouts
+    if _layouts is None or _layouts.target != target:
+        _layouts = TypeLayoutCache(target)
+    return _layouts
+
+
+class ElementDecoder:
+    """
+    Decode array elements of one type into lists of values, one per
+    path in paths.  The leaves that do not overlap are unpacked with one
+    struct per element, the others (union members, bitfields) one by one.
+    """
+
+    def __init__(self, leaves, size, byteorder):
+        # (path, index of the first value, number of values or None,
+        # conversion of the values or None)
+        self.fields = []
+        self.extras = []
+        # fields that are single values taken as they are
+        self.plain = []
+        fmt = byteorder
+        end = 0
+        nvalues_before = 0
+        for path, offset, f, count, enums, leaf_size, kind in leaves:
+            path = path or "value"
+            if kind == "bits":
+                self.extras.append((path, offset, None, count, leaf_size,
+                                    None))
+                continue
+            if f is None or kind == "char":
+                code = f"{leaf_size * max(count, 1)}s"
+                nvalues = None
+            else:
+                code = f"{count}{f}" if count else f
+                nvalues = count or None
+            convert = None
+            if kind or enums or code.endswith("s"):
+                convert = _converter(kind, enums)
+            if offset < end:
+                self.extras.append((path, offset,
+                                    struct.Struct(byteorder + code), 0, 0,
+                                    convert))
+                continue
+            if offset > end:
+                fmt += f"{offset - end}x"
+            if nvalues is None and convert is None:
+                self.plain.append(len(self.fields))
+            self.fields.append((path, nvalues_before, nvalues, convert))
+            nvalues_before += nvalues or 1
+            fmt += code
+            end = offset + struct.calcsize(code)
+        if size > end:
+            fmt += f"{size - end}x"
+        self.struct = struct.Struct(fmt)
+        self.byteorder = "little" if byteorder == "<" else "big"
+        self.paths = [f[0] for f in self.fields] + [e[0] for e in self.extras]
+        self.text = "[{}] {{" + ", ".join(
+            path.replace("{", "{{").replace("}", "}}") + " = {!r}"
+            for path in self.paths) + "}}"
+
+    def decode(self, buf, offset):
+        values = self.struct.unpack_from(buf, offset)
+        if len(self.plain) == len(self.fields) and not self.extras:
+            return values
+        element = []
+        for path, i, nvalues, convert in self.fields:
+            if nvalues is not None:
+                value = list(values[i:i + nvalues])
+                if convert is not None:
+                    value = [convert(v) for v in value]
+            elif convert is not None:
+                value = convert(values[i])
+            else:
+                value = values[i]
+            element.append(value)
+        for path, at, s, shift, width, convert in self.extras:
+            if s is not None:
+                value = s.unpack_from(buf, offset + at)
+                if len(value) > 1:
+                    value = list(value)
+                    if convert is not None:
+                        value = [convert(v) for v in value]
+                elif convert is not None:
+                    value = convert(value[0])
+                else:
+                    value = value[0]
+                element.append(value)
+                continue
+            nbytes = (shift + width + 7) // 8
+            word = int.from_bytes(buf[offset + at:offset + at + nbytes],
+                                  self.byteorder)
+            element.append((word >> shift) & ((1 << width) - 1))
+        return element
+
+
+def _converter(kind, enums):
+    """
+    Function from a raw unpacked value to the value written
+    """
+    if kind == "char":
+        return lambda v: v.split(b"\0", 1)[0].decode(errors="replace")
+    if kind == "pointer":
+        return hex
+    if enums:
+        names = {int(value): name for value, name in enums.items()}
+        return lambda v: names.get(v, v)
+    return bytes.hex
+
+
+def _first_pointer(value):
+    for i in range(value.GetNumChildren()):
+        child = value.GetChildAtIndex(i)
+        if child.GetType().GetCanonicalType().IsPointerType():
+            return child
+        child = _first_pointer(child)
+        if child is not None:
+            return child
+    return None
+
+
+def resolve_array(value, elem, count):
+    """
+    Address, element type and length of the array value stands for.
+    elem and count override what is found in value.
+    """
+    typ = value.GetType().GetCanonicalType()
+    if typ.IsArrayType():
+        elem = elem or typ.GetArrayElementType()
+        return (value.GetLoadAddress(), elem,
+                count or typ.GetByteSize() // elem.GetByteSize())
+    if typ.IsPointerType():
+        if not count:
+            raise ValueError("give the number of elements of a pointer "
+                             "with -c")
+        return (value.GetValueAsUnsigned(), elem or typ.GetPointeeType(),
+                count)
+    if value.IsSynthetic() and value.GetNumChildren():
+        # Vec, slice, std::vector ... with a formatter
+        first = value.GetChildAtIndex(0)
+        return (first.GetLoadAddress(), elem or first.GetType(),
+                count or value.GetNumChildren())
+
+    # Rust Vec and slices without formatters: a length and a pointer
+    value = value.GetNonSyntheticValue()
+    length = value.GetChildMemberWithName("len")
+    if not length.IsValid():
+        length = value.GetChildMemberWithName("length")
+    data = value.GetChildMemberWithName("data_ptr")
+    if not data.IsValid():
+        data = _first_pointer(value)
+    if not length.IsValid() or data is None:
+        raise ValueError(f"{value.GetName()} is not an array, a pointer, "
+                         f"a Vec or a slice")
+    if elem is None:
+        elem = value.GetType().GetTemplateArgumentType(0)
+    if elem is None or not elem.IsValid():
+        # the pointer of a Vec is a *u8, a slice has the right one
+        elem = data.GetType().GetPointeeType()
+        if elem.GetByteSize() == 1 and data.GetName() != "data_ptr":
+            raise ValueError("give the element type with -t")
+    return (data.GetValueAsUnsigned(), elem,
+            count or length.GetValueAsUnsigned())
+
+
+def dump_array(target, addr, elem, count, out, as_json, chunk_bytes):
+    layouts = _type_layouts(target)
+    name = elem.GetName()
+    size = elem.GetByteSize()
+    decoder = ElementDecoder(layouts.leaves(name, elem), size,
+                             layouts.byteorder)
+    layouts.flush()
+    process = target.GetProcess()
+    per_chunk = max(1, chunk_bytes // size)
+    for first in range(0, count, per_chunk):
+        n = min(per_chunk, count - first)
+        error = lldb.SBError()
+        buf = process.ReadMemory(addr + first * size, n * size, error)
+        if not error.Success():
+            raise RuntimeError(f"cannot read {n} {name} at "
+                               f"{addr + first * size:#x}: "
+                               f"{error.GetCString()}")
+        lines = []
+        for i in range(n):
+            element = decoder.decode(buf, i * size)
+            index = first + i
+            if as_json:
+                record = {"index": index}
+                record.update(zip(decoder.paths, element))
+                lines.append(json.dumps(record))
+            else:
+                lines.append(decoder.text.format(index, *element))
+        out.write("\n".join(lines) + "\n")
+
+
+def dumparray(debugger, command, result, internal_dict):
+    parser = argparse.ArgumentParser(
+        prog="dumparray",
+        description='Write the elements of an array, Vec, slice or pointer '
+                    'to a file')
+    parser.add_argument('expr', nargs='+',
+                        help='variable path or expression of the array')
+    parser.add_argument('-t', '--type', metavar='element',
+                        help='element type, default: from the array')
+    parser.add_argument('-c', '--count', type=int,
+                        help='number of elements, default: the length of '
+                             'the array')
+    parser.add_argument('-j', '--json', action='store_true',
+                        help='write JSON lines')
+    parser.add_argument('-o', '--output',
+                        help='default: lldb_output.txt, '
+                             'or lldb_output.jsonl with -j')
+    parser.add_argument('-b', '--chunk-mb', type=int, default=16,
+                        help='read this many MB at a time, default: 16')
+    args = parser.parse_args(shlex.split(command))
+    expr = " ".join(args.expr)
+    output = args.output or ("lldb_output.jsonl" if args.json
+                             else "lldb_output.txt")
+
+    target = debugger.GetSelectedTarget()
+    frame = target.GetProcess().GetSelectedThread().GetSelectedFrame()
+    value = frame.GetValueForVariablePath(expr)
+    if not value.IsValid():
+        value = frame.EvaluateExpression(expr)
+    if not value.IsValid() or value.GetError().Fail():
+        print(f"expression `{expr}` is not valid: "
+              f"{value.GetError().GetCString()}")
+        return
+    elem = _type_layouts(target).sbtype(args.type) if args.type else None
+
+    started = time.time()
+    try:
+        addr, elem, count = resolve_array(value, elem, args.count)
+        with open(output, "w") as out:
+            dump_array(target, addr, elem, count, out, args.json,
+                       args.chunk_mb << 20)
+    except (ValueError, RuntimeError) as e:
+        print(e)
+        return
+    print(f"{count} {elem.GetName()} at {addr:#x} written to {output} "
+          f"in {time.time() - started:.1f}s")
+
+
+def __lldb_init_module(debugger, internal_dict):
+    debugger.HandleCommand("command script add -f debug.dumparray dumparray")
+    print("new commands installed and ready for use:")
+    print("    \033[1;32mdumparray\033[0m")
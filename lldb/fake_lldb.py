@@ -0,0 +1,446 @@
+#
+# Stand-in for the parts of the lldb module the pgmem walkers use, serving
+# a synthetic process memory image.  bench_pgmem.py installs it as `lldb`
+# before importing pg_memcxt_stats:
+#
+#   sys.modules["lldb"] = fake_lldb
+#
+# Types are built in Python with their C layout worked out by struct_type(),
+# memory is a MemoryImage, and every SB call that reaches the "process" is
+# counted in SBProcess.calls so the cost of a walk can be compared without
+# a debugger.
+#
+import bisect
+import struct
+import collections
+
+
+LLDB_INVALID_ADDRESS = 0xffffffffffffffff
+
+eByteOrderBig = 1
+eByteOrderLittle = 4
+
+eStateStopped = 5
+eStateRunning = 6
+
+eFunctionNameTypeFull = 1 << 3
+
+eBasicTypeInvalid = 0
+eBasicTypeChar = 2
+eBasicTypeSignedChar = 3
+eBasicTypeUnsignedChar = 4
+eBasicTypeShort = 8
+eBasicTypeUnsignedShort = 9
+eBasicTypeInt = 10
+eBasicTypeUnsignedInt = 11
+eBasicTypeLong = 12
+eBasicTypeUnsignedLong = 13
+eBasicTypeLongLong = 14
+eBasicTypeUnsignedLongLong = 15
+eBasicTypeBool = 20
+eBasicTypeFloat = 26
+eBasicTypeDouble = 27
+eBasicTypeOther = 32
+
+eTypeClassArray = 1 << 1
+eTypeClassBuiltin = 1 << 3
+eTypeClassEnumeration = 1 << 4
+eTypeClassPointer = 1 << 11
+eTypeClassStruct = 1 << 13
+
+# set by lldb when a script is imported into a session, never here
+debugger = None
+
+
+class SBError:
+    def __init__(self):
+        self._error = None
+
+    def Success(self):
+        return self._error is None
+
+    def Fail(self):
+        return self._error is not None
+
+    def GetCString(self):
+        return self._error
+
+    def SetErrorString(self, error):
+        self._error = error
+
+
+class SBTypeMember:
+    def __init__(self, name, offset, typ):
+        self._name = name
+        self._offset = offset
+        self._type = typ
+
+    def GetName(self):
+        return self._name
+
+    def GetOffsetInBytes(self):
+        return self._offset
+
+    def GetType(self):
+        return self._type
+
+    def IsBitfield(self):
+        return False
+
+
+class SBTypeEnumMember:
+    def __init__(self, name, value):
+        self._name = name
+        self._value = value
+
+    def GetName(self):
+        return self._name
+
+    def GetValueAsUnsigned(self):
+        return self._value
+
+
+class SBTypeEnumMemberList:
+    def __init__(self, members):
+        self._members = members
+
+    def GetSize(self):
+        return len(self._members)
+
+    def GetTypeEnumMemberAtIndex(self, i):
+        return self._members[i]
+
+
+class SBType:
+    def __init__(self, name, size, align=None, cls=eTypeClassBuiltin,
+                 basic=eBasicTypeOther, fields=(), element=None,
+                 enumerators=None):
+        self._name = name
+        self._size = size
+        self.align = align or size or 1
+        self._class = cls
+        self._basic = basic
+        self._fields = list(fields)
+        self._element = element
+        self._enumerators = enumerators or {}
+
+    def IsValid(self):
+        return True
+
+    def GetName(self):
+        return self._name
+
+    def GetByteSize(self):
+        return self._size
+
+    def GetCanonicalType(self):
+        return self
+
+    def GetTypeClass(self):
+        return self._class
+
+    def GetBasicType(self):
+        return self._basic
+
+    def IsPointerType(self):
+        return self._class == eTypeClassPointer
+
+    def IsArrayType(self):
+        return self._class == eTypeClassArray
+
+    def GetArrayElementType(self):
+        return self._element
+
+    def GetPointeeType(self):
+        return self._element
+
+    def GetPointerType(self):
+        return pointer_type(self)
+
+    def GetNumberOfFields(self):
+        return len(self._fields)
+
+    def GetFieldAtIndex(self, i):
+        return self._fields[i]
+
+    def GetEnumMembers(self):
+        return SBTypeEnumMemberList([
+            SBTypeEnumMember(name, value)
+            for value, name in self._enumerators.items()])
+
+    def GetTemplateArgumentType(self, i):
+        return None
+
+
+def scalar_type(name, size, basic):
+    return SBType(name, size, basic=basic)
+
+
+def pointer_type(typ):
+    return SBType(f"{typ.GetName()} *", 8, cls=eTypeClassPointer,
+                  element=typ)
+
+
+def array_type(typ, count):
+    return SBType(f"{typ.GetName()}[{count}]", typ.GetByteSize() * count,
+                  align=typ.align, cls=eTypeClassArray, element=typ)
+
+
+def enum_type(name, enumerators):
+    return SBType(name, 4, cls=eTypeClassEnumeration,
+                  enumerators=enumerators)
+
+
+def struct_type(name, fields):
+    """
+    A struct of [(name, SBType)] laid out as a C compiler on x86_64 would
+    """
+    members = []
+    offset = 0
+    align = 1
+    for field, typ in fields:
+        offset = (offset + typ.align - 1) // typ.align * typ.align
+        members.append(SBTypeMember(field, offset, typ))
+        offset += typ.GetByteSize()
+        align = max(align, typ.align)
+    size = (offset + align - 1) // align * align
+    return SBType(name, size, align=align, cls=eTypeClassStruct,
+                  fields=members)
+
+
+class MemoryImage:
+    """
+    Sparse little-endian address space.  alloc() reserves a range of
+    addresses, of which only the first `backed` bytes are stored, so the
+    data of a block can be left out while its header is read as usual.
+    Reads of addresses that are reserved but not stored return zeros.
+    """
+
+    def __init__(self, base=0x10000):
+        self.base = base
+        self.top = base
+        # start address and contents of the stored ranges, sorted
+        self._starts = []
+        self._segments = []
+
+    def alloc(self, size, backed=None, align=16):
+        start = (self.top + align - 1) & ~(align - 1)
+        self.top = start + size
+        backed = size if backed is None else backed
+        if backed:
+            last = self._segments[-1] if self._segments else None
+            if last is not None and self._starts[-1] + len(last) == start:
+                last.extend(bytes(backed))
+            else:
+                self._starts.append(start)
+                self._segments.append(bytearray(backed))
+        return start
+
+    def _segment(self, addr):
+        i = bisect.bisect_right(self._starts, addr) - 1
+        if i < 0:
+            raise IndexError(f"{addr:#x} is not stored")
+        segment = self._segments[i]
+        offset = addr - self._starts[i]
+        if offset >= len(segment):
+            raise IndexError(f"{addr:#x} is not stored")
+        return segment, offset
+
+    def write(self, addr, data):
+        segment, offset = self._segment(addr)
+        segment[offset:offset + len(data)] = data
+
+    def put(self, addr, fmt, *values):
+        segment, offset = self._segment(addr)
+        struct.pack_into("<" + fmt, segment, offset, *values)
+
+    def get(self, addr, fmt):
+        return struct.unpack_from("<" + fmt, self.read(
+            addr, struct.calcsize("<" + fmt)))
+
+    def read(self, addr, size):
+        """
+        size bytes at addr, None outside of the reserved addresses
+        """
+        if addr < self.base or addr + size > self.top:
+            return None
+        i = bisect.bisect_right(self._starts, addr) - 1
+        if i >= 0:
+            offset = addr - self._starts[i]
+            segment = self._segments[i]
+            if offset + size <= len(segment):
+                return bytes(segment[offset:offset + size])
+        data = bytearray(size)
+        i = max(i, 0)
+        while i < len(self._starts) and self._starts[i] < addr + size:
+            start = self._starts[i]
+            segment = self._segments[i]
+            lo = max(start, addr)
+            hi = min(start + len(segment), addr + size)
+            if lo < hi:
+                data[lo - addr:hi - addr] = segment[lo - start:hi - start]
+            i += 1
+        return bytes(data)
+
+    def cstring(self, s):
+        data = s.encode() + b"\0"
+        addr = self.alloc(len(data), align=1)
+        self.write(addr, data)
+        return addr
+
+    def stored_bytes(self):
+        return sum(len(segment) for segment in self._segments)
+
+
+class SBValue:
+    def __init__(self, typ=None, value=0, addr=LLDB_INVALID_ADDRESS,
+                 name=None):
+        self._type = typ
+        self._value = value
+        self._addr = addr
+        self._name = name
+
+    def IsValid(self):
+        return self._type is not None
+
+    def GetError(self):
+        error = SBError()
+        if self._type is None:
+            error.SetErrorString(f"{self._name} not found")
+        return error
+
+    def GetName(self):
+        return self._name
+
+    def GetType(self):
+        return self._type
+
+    def GetValueAsUnsigned(self, fail_value=0):
+        return self._value if self._type is not None else fail_value
+
+    def GetLoadAddress(self):
+        return self._addr
+
+
+class SBProcess:
+    unique_ids = 0
+
+    def __init__(self, image, pid=4242):
+        self.image = image
+        self.pid = pid
+        SBProcess.unique_ids += 1
+        self.unique_id = SBProcess.unique_ids
+        self.stop_id = 1
+        self.calls = collections.Counter()
+
+    def IsValid(self):
+        return True
+
+    def GetProcessID(self):
+        return self.pid
+
+    def GetUniqueID(self):
+        return self.unique_id
+
+    def GetState(self):
+        return eStateStopped
+
+    def GetStopID(self, include_expression_stops=False):
+        return self.stop_id
+
+    def ReadMemory(self, addr, size, error):
+        self.calls["ReadMemory"] += 1
+        self.calls["bytes"] += size
+        data = self.image.read(addr, size)
+        if data is None:
+            error.SetErrorString(f"memory read failed for {addr:#x}")
+        return data
+
+    def ReadCStringFromMemory(self, addr, max_size, error):
+        self.calls["ReadCStringFromMemory"] += 1
+        data = self.image.read(addr, 1)
+        if data is None:
+            error.SetErrorString(f"memory read failed for {addr:#x}")
+            return None
+        chars = bytearray()
+        while len(chars) < max_size and data and data != b"\0":
+            chars += data
+            data = self.image.read(addr + len(chars), 1)
+        self.calls["bytes"] += len(chars) + 1
+        return chars.decode(errors="replace")
+
+    def ReadPointerFromMemory(self, addr, error):
+        data = self.ReadMemory(addr, 8, error)
+        return struct.unpack("<Q", data)[0] if data else 0
+
+
+class SBFileSpec:
+    def __init__(self, fullpath):
+        self.fullpath = fullpath
+
+
+class SBModule:
+    def __init__(self, uuid):
+        self._uuid = uuid
+
+    def IsValid(self):
+        return True
+
+    def GetUUIDString(self):
+        return self._uuid
+
+
+class SBTarget:
+    """
+    A target of one process, with the types and globals given
+    """
+
+    def __init__(self, image, types, uuid):
+        self.process = SBProcess(image)
+        self.types = {typ.GetName(): typ for typ in types}
+        self.module = SBModule(uuid)
+        # name -> (address, SBType) of the global variables
+        self.globals = {}
+
+    def IsValid(self):
+        return True
+
+    def GetProcess(self):
+        return self.process
+
+    def GetByteOrder(self):
+        return eByteOrderLittle
+
+    def GetAddressByteSize(self):
+        return 8
+
+    def GetExecutable(self):
+        return SBFileSpec("postgres")
+
+    def FindModule(self, spec):
+        return self.module
+
+    def FindFirstType(self, name):
+        self.process.calls["FindFirstType"] += 1
+        return self.types.get(name) or SBType(name, 0)
+
+    def FindFirstGlobalVariable(self, name):
+        self.process.calls["FindFirstGlobalVariable"] += 1
+        if name not in self.globals:
+            return SBValue(name=name)
+        addr, typ = self.globals[name]
+        value = self.process.image.get(addr, "Q")[0]
+        return SBValue(typ, value, addr, name)
+
+
+class _Unused:
+    """
+    SB classes the walkers only name in annotations
+    """
+
+
+for _name in ["SBAddress", "SBBreakpoint", "SBBreakpointLocation",
+              "SBCommandReturnObject", "SBDebugger", "SBExecutionContext",
+              "SBFrame", "SBStream", "SBStringList",
+              "SBStructuredData", "SBSymbolContext", "SBThread"]:
+    globals()[_name] = type(_name, (_Unused,), {})
@@ -3,20 +3,38 @@ import sys
 import argparse
 import shlex
 import os
-import shutil
+import csv
 import json
+import time
+import math
+import bisect
+import fnmatch
+import heapq
+import random
+import re
+import struct
+import contextlib
+import statistics
+import collections
+
+from type_layout import TypeLayoutCache
+from pgmem_snapshot import ContextRecord, read_snapshot, write_snapshot, \
+    diff_snapshots, format_diff
 
 
 # C macros in PostgreSQL
 ALLOCSET_NUM_FREELISTS = 11
 ALLOC_MINBITS = 3
+SLAB_BLOCKLIST_COUNT = 3
 
 
-lldb_target = lldb.debugger.GetSelectedTarget()
+# the target inspected by the running command, see use_target()
+lldb_target = None
 CONTEXT_KINDS = [
     "T_AllocSetContext",
     "T_SlabContext",
     "T_GenerationContext",
+    "T_BumpContext",
 ]
 
 
@@ -30,21 +48,63 @@ class MemoryContextCounters:
         self.totalspace = 0
         # The unused portion of totalspace
         self.freespace = 0
+        # Whether some of the counts are estimates, not exact
+        self.estimated = False
+        # Variance of the estimated totalspace
+        self.variance = 0.0
 
     def __str__(self):
         return "\
-Grand total: {} bytes in {} blocks; {} free ({} chunks); {} used" \
+Grand total: {} bytes in {} blocks; {} free ({} chunks); {} used{}" \
     .format(
             self.totalspace,
             self.nblocks,
             self.freespace,
             self.freechunks,
             self.totalspace - self.freespace,
+            self.estimate_string(),
         )
 
+    def stats_string(self):
+        return "{} total in {} blocks; {} free ({} chunks); {} used{}" \
+            .format(self.totalspace, self.nblocks, self.freespace,
+                    self.freechunks, self.totalspace - self.freespace,
+                    self.estimate_string())
+
+    def interval(self):
+        """
+        Half width of the 95% confidence interval of totalspace
+        """
+        return round(1.96 * math.sqrt(self.variance))
+
+    def estimate_string(self):
+        if not self.estimated:
+            return ""
+        if self.variance:
+            return f" (estimated, total \u00b1{self.interval()} bytes)"
+        return " (estimated)"
+
+    def add(self, other):
+        self.nblocks += other.nblocks
+        self.freechunks += other.freechunks
+        self.totalspace += other.totalspace
+        self.freespace += other.freespace
+        self.estimated = self.estimated or other.estimated
+        self.variance += other.variance
+
+
+_type_layouts = None
+
+
+def type_layouts():
+    global _type_layouts
+    if _type_layouts is None:
+        _type_layouts = _state.layouts = TypeLayoutCache(lldb_target)
+    return _type_layouts
+
 
 def sizeof(typname):
-    return lldb_target.FindFirstType(typname).GetByteSize()
+    return type_layouts().sizeof(typname)
 
 
 # Determine the size of the chunk based on the freelist index
@@ -52,96 +112,841 @@ def GetChunkSizeFromFreeListIdx(fidx):
     return 1 << ALLOC_MINBITS << fidx
 
 
+class MemoryReadError(Exception):
+    def __init__(self, addr, size, reason):
+        super().__init__(
+            f"failed to read {size} bytes at {addr:#x}: {reason}")
+        self.addr = addr
+
+
+def read_memory(addr, size):
+    if _budget is not None:
+        _budget.nbytes += size
+    if _profile is not None:
+        _profile.count("ReadMemory", size)
+    error = lldb.SBError()
+    data = lldb_target.GetProcess().ReadMemory(addr, size, error)
+    if not error.Success():
+        raise MemoryReadError(addr, size, error.GetCString())
+    return data
+
+
+# C strings are mostly static names, so read each address only once per walk
+_cstrings = {}
+
+
+_page_cache = None
+
+
+def page_cache():
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = PageCache()
+    return _page_cache
+
+
+def reset_walk_caches():
+    """
+    Forget what earlier walks read, the target may have run since then
+    """
+    _cstrings.clear()
+    if _page_cache is not None:
+        _page_cache.clear()
+
+
+def read_cstring(addr):
+    if addr == 0:
+        return ""
+    s = _cstrings.get(addr)
+    if s is None:
+        error = lldb.SBError()
+        s = lldb_target.GetProcess().ReadCStringFromMemory(addr, 1024, error)
+        if not error.Success():
+            s = ""
+        if _budget is not None:
+            _budget.nbytes += len(s) + 1
+        if _profile is not None:
+            _profile.count("ReadCStringFromMemory", len(s) + 1)
+        _cstrings[addr] = s
+    return s
+
+
+class PageCache:
+    """
+    Read target memory a page at a time, keeping the most recently used
+    pages, so that following links between nearby nodes costs a dict
+    lookup instead of a memory read per node.
+
+    Links that jump around, like a freelist in random order, would read a
+    page per pointer.  So read_pointer() counts the pointers on pages it
+    used recently, and after each window of WINDOW pointers in which fewer
+    than MIN_HIT_RATE of them were, it reads just the pointers, remembering
+    the pages they are on without reading them, until a window hits again.
+    """
+
+    WINDOW = 256
+    MIN_HIT_RATE = 0.5
+
+    def __init__(self, page_size=4096, max_pages=256):
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self._pages = collections.OrderedDict()
+        layouts = type_layouts()
+        self._pointer = struct.Struct(
+            layouts.byteorder + ("Q" if layouts.pointer_size == 8 else "I"))
+        self._lookups = 0
+        self._hits = 0
+        self.direct = False
+
+    def clear(self):
+        self._pages.clear()
+        self._lookups = self._hits = 0
+        self.direct = False
+
+    def _count(self, page):
+        self._lookups += 1
+        if page in self._pages:
+            self._hits += 1
+        if self._lookups == self.WINDOW:
+            self.direct = self._hits < self.WINDOW * self.MIN_HIT_RATE
+            self._lookups = self._hits = 0
+
+    def _remember(self, page):
+        if page in self._pages:
+            self._pages.move_to_end(page)
+        else:
+            # None: used, but not read
+            self._pages[page] = None
+            if len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+
+    def _page(self, page):
+        data = self._pages.get(page)
+        if data is not None:
+            self._pages.move_to_end(page)
+            return data
+        try:
+            data = read_memory(page, self.page_size)
+        except MemoryReadError:
+            # partially mapped page, the caller reads just what it needs
+            return None
+        self._pages[page] = data
+        self._pages.move_to_end(page)
+        if len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+        return data
+
+    def read(self, addr, size):
+        page = addr & ~(self.page_size - 1)
+        offset = addr - page
+        if offset + size <= self.page_size:
+            data = self._page(page)
+            if data is not None:
+                return data[offset:offset + size]
+        return read_memory(addr, size)
+
+    def read_pointer(self, addr):
+        page = addr & ~(self.page_size - 1)
+        offset = addr - page
+        if offset + self._pointer.size <= self.page_size:
+            self._count(page)
+            if self.direct:
+                self._remember(page)
+            else:
+                data = self._page(page)
+                if data is not None:
+                    return self._pointer.unpack_from(data, offset)[0]
+        return self._pointer.unpack(read_memory(addr, self._pointer.size))[0]
+
+
+class PointerChaser:
+    """
+    Count the nodes of a NULL terminated singly linked list by following
+    the pointer at `link_offset` of each node through a PageCache.
+
+    The walk stops after `cap` nodes (0 means no cap), and a corrupted
+    list that loops is detected with Brent's algorithm, in which case only
+    the distinct nodes are counted.  A link into unmapped memory ends the
+    list.  count() returns the number of nodes and None, "capped", "cycle"
+    or "unreadable", and calls visit with the address of each node it
+    passes if given.
+    """
+
+    def __init__(self, pages: PageCache, link_offset, cap=0):
+        self.pages = pages
+        self.link_offset = link_offset
+        self.cap = cap
+
+    def _next(self, addr):
+        return self.pages.read_pointer(addr + self.link_offset)
+
+    def count(self, head, visit=None):
+        n = 0
+        power = lam = 1
+        tortoise = addr = head
+        while addr:
+            if self.cap and n >= self.cap:
+                return n, "capped"
+            try:
+                link = self._next(addr)
+            except MemoryReadError:
+                # a corrupted link before, addr is not a node
+                return n, "unreadable"
+            n += 1
+            if visit is not None:
+                visit(addr)
+            addr = link
+            if addr == tortoise:
+                return self._distinct(head, lam), "cycle"
+            if power == lam:
+                tortoise = addr
+                power *= 2
+                lam = 0
+            lam += 1
+        return n, None
+
+    def _distinct(self, head, lam):
+        """
+        Number of distinct nodes of a list whose loop is lam nodes long
+        """
+        hare = head
+        for _ in range(lam):
+            hare = self._next(hare)
+        tortoise = head
+        mu = 0
+        while tortoise != hare:
+            tortoise = self._next(tortoise)
+            hare = self._next(hare)
+            mu += 1
+        return mu + lam
+
+
+class WalkBudget:
+    """
+    Limits of one walk: wall-clock seconds, contexts visited and bytes read
+    from the target, 0 meaning no limit.  Once one of them is used up, the
+    walk samples the children it has not visited yet instead of walking all
+    of them, see SampleSiblings().  The sampling is bounded in turn: within
+    a sampled subtree only NESTED_SAMPLE_SIZE children are sampled per
+    context, sampled subtrees nest at most sample_depth deep, and after
+    sample_nodes more contexts a sampled context is not descended into any
+    more.
+    """
+
+    NESTED_SAMPLE_SIZE = 2
+
+    def __init__(self, seconds=0, nodes=0, nbytes=0, sample_size=30, seed=0,
+                 sample_nodes=0, sample_depth=8):
+        self.deadline = time.perf_counter() + seconds if seconds else 0
+        self.max_nodes = nodes
+        self.max_bytes = nbytes
+        self.sample_size = sample_size
+        self.sample_nodes = sample_nodes or 10 * sample_size
+        self.sample_depth = sample_depth
+        self.rng = random.Random(seed)
+        self.nodes = 0
+        self.nbytes = 0
+        self.exhausted = False
+        # contexts visited when the budget was used up
+        self.exhausted_nodes = 0
+        # sampled subtrees being walked, one inside the other
+        self.depth = 0
+        # sampled contexts whose subtree was left out
+        self.cut = 0
+
+    def check(self):
+        if not self.exhausted:
+            self.exhausted = bool(
+                (self.deadline and time.perf_counter() > self.deadline) or
+                (self.max_nodes and self.nodes >= self.max_nodes) or
+                (self.max_bytes and self.nbytes >= self.max_bytes))
+            self.exhausted_nodes = self.nodes
+        return self.exhausted
+
+    def may_descend(self):
+        """
+        Whether the subtree of a sampled context may still be walked
+        """
+        return self.depth < self.sample_depth and \
+            self.nodes - self.exhausted_nodes < self.sample_nodes
+
+    def current_sample_size(self):
+        if self.depth:
+            return min(self.sample_size, self.NESTED_SAMPLE_SIZE)
+        return self.sample_size
+
+
+# the budget of the walk in progress, None if it is unlimited
+_budget = None
+
+
+def start_walk_budget():
+    global _budget
+    _budget = None
+    if Args.budget_ms or Args.budget_nodes or Args.budget_bytes:
+        _budget = WalkBudget(Args.budget_ms / 1000, Args.budget_nodes,
+                             Args.budget_bytes, Args.sample_size, Args.seed,
+                             Args.sample_nodes, Args.sample_depth)
+    return _budget
+
+
+def end_walk_budget():
+    global _budget
+    budget, _budget = _budget, None
+    return budget
+
+
+class CommandProfile:
+    """
+    Where the time of a command goes, for --profile: seconds, debugger API
+    calls and bytes read per phase.  Phases nest, and each is charged only
+    what happens outside of the phases it encloses.  The cost of decoding
+    each context kind is a phase of its own, and the contexts that cost
+    the most are kept with their name.
+    """
+
+    def __init__(self, ntop=10):
+        now = time.perf_counter()
+        self.started = now
+        # seconds the target was stopped, if not the whole command
+        self.stopped = None
+        self.seconds = collections.Counter()
+        self.entered = collections.Counter()
+        self.nbytes = collections.Counter()
+        self.calls = collections.defaultdict(collections.Counter)
+        self.total_bytes = 0
+        # (seconds, bytes, kind, name, addr) of the costliest contexts
+        self.contexts = []
+        self.ntop = ntop
+        # [phase, when its own time started being counted]
+        self._stack = [["other", now]]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        now = time.perf_counter()
+        outer = self._stack[-1]
+        self.seconds[outer[0]] += now - outer[1]
+        self._stack.append([name, now])
+        self.entered[name] += 1
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.seconds[name] += now - self._stack.pop()[1]
+            self._stack[-1][1] = now
+
+    def count(self, api, nbytes=0):
+        phase = self._stack[-1][0]
+        self.calls[phase][api] += 1
+        self.nbytes[phase] += nbytes
+        self.total_bytes += nbytes
+
+    def context(self, memcxt, seconds, nbytes):
+        self.contexts.append((seconds, nbytes, memcxt.typcxt, memcxt.name,
+                              memcxt.addr))
+        if len(self.contexts) > 8 * self.ntop:
+            self.contexts = heapq.nlargest(self.ntop, self.contexts)
+
+    def report(self):
+        now = time.perf_counter()
+        outer = self._stack[-1]
+        self.seconds[outer[0]] += now - outer[1]
+        outer[1] = now
+        total = now - self.started
+        stopped = total if self.stopped is None else self.stopped
+        print(f"profile: {total * 1000:.1f} ms, the target stopped for "
+              f"{stopped * 1000:.1f} ms, {self.total_bytes} bytes read")
+        print(f"{'phase':<24} {'count':>8} {'ms':>10} {'bytes':>12}  "
+              f"debugger calls")
+        for name, seconds in self.seconds.most_common():
+            calls = ", ".join(f"{api} {n}" for api, n in
+                              self.calls[name].most_common())
+            print(f"{name:<24} {self.entered[name]:>8} "
+                  f"{seconds * 1000:>10.2f} {self.nbytes[name]:>12}  "
+                  f"{calls}")
+        if self.contexts:
+            print(f"\n{'ms':>10} {'bytes':>12}  costliest contexts")
+            for seconds, nbytes, kind, name, addr in \
+                    heapq.nlargest(self.ntop, self.contexts):
+                print(f"{seconds * 1000:>10.2f} {nbytes:>12}  "
+                      f"{name} ({kind}, {addr:#x})")
+
+
+# the profile of the command in progress, None unless --profile
+_profile = None
+
+
+def start_profile(enabled):
+    global _profile
+    _profile = CommandProfile() if enabled else None
+    if _profile is not None and lldb_target is not None:
+        type_layouts().on_lookup = \
+            lambda name: _profile.count("FindFirstType")
+    return _profile
+
+
+def end_profile():
+    global _profile
+    profile, _profile = _profile, None
+    if _type_layouts is not None:
+        _type_layouts.on_lookup = None
+    if profile is not None:
+        profile.report()
+    return profile
+
+
+_no_phase = contextlib.nullcontext()
+
+
+def profile_phase(name):
+    return _profile.phase(name) if _profile is not None else _no_phase
+
+
+class StructDecoder:
+    """
+    Decode some fields of a C struct with a single memory read.
+
+    The field offsets are worked out once from the debug info and turned
+    into a precompiled struct.Struct, so decoding a node costs one
+    SBProcess.ReadMemory call instead of one SBValue per field.
+
+    A field is a member name, a dotted path into nested members such as
+    "node.next", or the name of an array member, which decodes into a
+    tuple.  Enum fields decode into their enumerator names.
+    """
+
+    def __init__(self, typname, fields):
+        layouts = type_layouts()
+        self.typname = typname
+        self.size = layouts.sizeof(typname)
+        self._layouts = layouts
+
+        members = sorted(((layouts.member(typname, path), path)
+                          for path in fields), key=lambda m: m[0][0])
+        fmt = layouts.byteorder
+        pos = 0
+        self._fields = []
+        for (offset, scalar, count, enums, size), path in members:
+            if offset > pos:
+                fmt += f"{offset - pos}x"
+            fmt += f"{count}{scalar}" if count else scalar
+            pos = offset + size * max(count, 1)
+            if enums is not None:
+                enums = {int(value): name for value, name in enums.items()}
+            self._fields.append((path, count, enums))
+        self._struct = struct.Struct(fmt)
+        self._flat = all(count == 0 and enums is None
+                         for _, count, enums in self._fields)
+
+        names = [path.replace(".", "_") for path in fields]
+        self._order = [[path for path, _, _ in self._fields].index(path)
+                       for path in fields]
+        self.Node = collections.namedtuple(typname + "Node", names)
+
+    def offsetof(self, path):
+        """
+        Offset of the member path, e.g. `offsetof("blocks.head")`
+        """
+        return self._layouts.offsetof(self.typname, path)
+
+    def unpack(self, data, offset=0):
+        raw = self._struct.unpack_from(data, offset)
+        if self._flat:
+            values = raw
+        else:
+            values = []
+            i = 0
+            for _, count, enums in self._fields:
+                if count:
+                    values.append(raw[i:i + count])
+                    i += count
+                else:
+                    value = raw[i]
+                    if enums is not None:
+                        value = enums.get(value, value)
+                    values.append(value)
+                    i += 1
+        return self.Node(*[values[i] for i in self._order])
+
+    def decode(self, addr):
+        return self.unpack(read_memory(addr, self._struct.size))
+
+
+class LazyDecoder:
+    """
+    StructDecoder built on first use, so it is bound to the target
+    being inspected rather than to whatever existed at import time.
+    """
+    instances = []
+
+    def __init__(self, typname, fields):
+        self.typname = typname
+        self.fields = fields
+        self._decoder = None
+        LazyDecoder.instances.append(self)
+
+    @classmethod
+    def reset_all(cls):
+        for decoder in cls.instances:
+            decoder._decoder = None
+
+    def __getattr__(self, name):
+        if self._decoder is None:
+            self._decoder = StructDecoder(self.typname, self.fields)
+        return getattr(self._decoder, name)
+
+
 class MemoryContext:
-    def __init__(self, memcxt: lldb.SBValue):
-        assert memcxt.GetType().IsPointerType(), "memcxt is not a pointer type"
-        self._c_memcxt = memcxt
-        # memory context type is an C enum name
-        self.typcxt = memcxt.GetChildMemberWithName("type").GetValue()
-        name = memcxt.GetChildMemberWithName("name").GetSummary()
-        self.name = name.strip("\"") if name else ""
-        ident = memcxt.GetChildMemberWithName("ident").GetSummary()
-        self.ident = ident.strip("\"") if ident else ""
-        self.methods = memcxt.GetChildMemberWithName("methods")
-        self.firstchild = memcxt.GetChildMemberWithName("firstchild")
-        self.nextchild = memcxt.GetChildMemberWithName("nextchild")
+    decoder = LazyDecoder("MemoryContextData", [
+        "type", "parent", "firstchild", "nextchild", "name", "ident",
+    ])
+
+    def __init__(self, addr):
+        self.addr = addr
+        with profile_phase("context headers"):
+            cxt = self.decoder.decode(addr)
+            # memory context type is an C enum name
+            self.typcxt = cxt.type
+            self.name = read_cstring(cxt.name)
+            self.ident = read_cstring(cxt.ident)
+        self.parent = cxt.parent
+        self.firstchild = cxt.firstchild
+        self.nextchild = cxt.nextchild
 
     def __eq__(self, other):
-        return self._c_memcxt.GetValueAsUnsigned() == \
-            other._c_memcxt.GetValueAsUnsigned()
+        return self.addr == other.addr
 
     def is_not_null(self):
-        return self._c_memcxt.GetValueAsUnsigned() != 0
+        return self.addr != 0
 
-    def CastAs(self, typname):
-        return cast_memcxt(self, typname)
+    def record(self, counters: "MemoryContextCounters"):
+        return ContextRecord(
+            self.addr, self.parent, self.name, self.ident, self.typcxt,
+            counters.nblocks, counters.freechunks, counters.totalspace,
+            counters.freespace)
 
 
-class GlobalMemoryContext:
-    current = MemoryContext(
-        lldb_target.FindFirstGlobalVariable("CurrentMemoryContext"))
+class TargetState:
+    """
+    What was found out about one target: its type layouts, and
+    CurrentMemoryContext and the TreeModel as of a stop id
+    """
 
+    def __init__(self):
+        self.layouts = None
+        self.current = None
+        self.model = None
 
-def cast_memcxt(value: MemoryContext, typname):
-    memcxt = value._c_memcxt
-    assert memcxt.GetType().IsPointerType(), "memcxt is not a pointer type"
-    return memcxt.Cast(lldb_target.FindFirstType(typname).GetPointerType())
+
+# target key -> TargetState, least recently used first
+_targets = collections.OrderedDict()
+_TARGETS_KEPT = 8
+_state = None
+
+
+def target_key(target: lldb.SBTarget):
+    """
+    Tells targets apart: the executable and the process, whose unique id
+    is not reused by lldb within a session, 0 for a target without one
+    """
+    return (target.GetExecutable().fullpath,
+            target.GetProcess().GetUniqueID())
+
+
+def use_target(target: lldb.SBTarget):
+    """
+    Inspect target from now on.  Commands call this with the target of
+    their execution context, scripts with the targets they create, e.g.
+    for a core.  The type layouts of a target are kept for the next time
+    it is used.
+    """
+    global lldb_target
+    global _type_layouts
+    global _page_cache
+    global _state
+    key = target_key(target)
+    state = _targets.pop(key, None)
+    if state is None:
+        state = TargetState()
+    _targets[key] = state
+    while len(_targets) > _TARGETS_KEPT:
+        _targets.popitem(last=False)
+    lldb_target = target
+    if state is _state:
+        return
+    _state = state
+    _type_layouts = state.layouts
+    _page_cache = None
+    _cstrings.clear()
+    LazyDecoder.reset_all()
+
+
+def current_memory_context():
+    """
+    Address of CurrentMemoryContext, read once per stop of the process
+    """
+    stop_id = lldb_target.GetProcess().GetStopID(True)
+    if _state.current is None or _state.current[0] != stop_id:
+        _state.current = (stop_id, lldb_target.FindFirstGlobalVariable(
+            "CurrentMemoryContext").GetValueAsUnsigned())
+    return _state.current[1]
+
+
+class TreeModel:
+    """
+    The contexts walked at one stop of the process: their headers, and
+    their counters and stats strings by address.  pgmem run again at the
+    same stop filters and renders these instead of reading the target.
+    """
+
+    def __init__(self, stop_id, options):
+        self.stop_id = stop_id
+        # the options that change the stats, -c and -F
+        self.options = options
+        self.contexts = {}
+        self.stats = {}
+        # contexts whose whole subtree is in the model, none of it sampled
+        self.complete = set()
+        # name -> addresses and ident -> addresses of the contexts, the
+        # address index being self.contexts
+        self.by_name = collections.defaultdict(list)
+        self.by_ident = collections.defaultdict(list)
+
+    def add(self, memcxt):
+        self.contexts[memcxt.addr] = memcxt
+        self.by_name[memcxt.name].append(memcxt.addr)
+        if memcxt.ident:
+            self.by_ident[memcxt.ident].append(memcxt.addr)
+
+    def path(self, addr, root):
+        """
+        The contexts from root down to the one at addr, None if it is not
+        below root
+        """
+        path = []
+        while addr:
+            memcxt = self.contexts.get(addr)
+            if memcxt is None:
+                return None
+            path.append(memcxt)
+            if addr == root:
+                return path[::-1]
+            addr = memcxt.parent
+        return None
+
+    def subtree_totals(self, addr, memo):
+        """
+        Counters of the context at addr and all contexts below it, and
+        their number.  memo keeps the subtrees summed up so far.
+        """
+        stack = [(addr, False)]
+        while stack:
+            at, children_done = stack.pop()
+            if at in memo:
+                continue
+            memcxt = self.contexts[at]
+            if not children_done:
+                stack.append((at, True))
+                child = memcxt.firstchild
+                while child:
+                    stack.append((child, False))
+                    child = self.contexts[child].nextchild
+                continue
+            totals = MemoryContextCounters()
+            totals.add(self.stats[at][0])
+            ncontexts = 1
+            child = memcxt.firstchild
+            while child:
+                child_totals, n = memo[child]
+                totals.add(child_totals)
+                ncontexts += n
+                child = self.contexts[child].nextchild
+            memo[at] = (totals, ncontexts)
+        return memo[addr]
+
+
+# the TreeModel the walk in progress reads and fills, None if it reads
+# everything from the target
+_model = None
+
+
+def start_tree_model(refresh=False):
+    """
+    Use the TreeModel of the current stop, a new one if the process ran,
+    memory was changed by an expression, or -c or -F changed
+    """
+    global _model
+    stop_id = lldb_target.GetProcess().GetStopID(True)
+    options = (Args.freelist_cap, Args.freelist_stats)
+    model = _state.model
+    if refresh or model is None or model.stop_id != stop_id or \
+            model.options != options:
+        model = _state.model = TreeModel(stop_id, options)
+    _model = model
+    return model
+
+
+def end_tree_model():
+    global _model
+    _model = None
+
+
+def context_at(addr):
+    if _model is None:
+        return MemoryContext(addr)
+    memcxt = _model.contexts.get(addr)
+    if memcxt is None:
+        memcxt = MemoryContext(addr)
+        _model.add(memcxt)
+    return memcxt
+
+
+def context_stats(memcxt):
+    """
+    Counters and stats string of memcxt, from the model if it has them
+    """
+    stats = _model.stats.get(memcxt.addr) if _model is not None else None
+    if stats is not None:
+        return stats
+    fn_stats = MEMORY_CONTEXT_STATS_IMPL[memcxt.typcxt]
+    counters = MemoryContextCounters()
+    strings = []
+
+    def keep(context, passthru, stats_string):
+        strings.append(stats_string)
+
+    if _profile is not None:
+        started, nbytes = time.perf_counter(), _profile.total_bytes
+        with _profile.phase(memcxt.typcxt):
+            fn_stats(memcxt, keep, 0, counters)
+        _profile.context(memcxt, time.perf_counter() - started,
+                         _profile.total_bytes - nbytes)
+    else:
+        fn_stats(memcxt, keep, 0, counters)
+    stats = (counters, strings[0])
+    if _model is not None:
+        _model.stats[memcxt.addr] = stats
+    return stats
+
+
+def collect_snapshot(root, raw_args=""):
+    """
+    Walk the tree below the context at address root without printing
+    anything, for scripts that run pgmem without an interactive session.
+    raw_args takes pgmem options such as "-c 10000".  Returns the
+    ContextRecords of the walked contexts and their grand totals.
+    """
+    global Snapshot
+    _handle_args(raw_args)
+    reset_walk_caches()
+    Snapshot = []
+    totals = MemoryContextCounters()
+    start_walk_budget()
+    try:
+        MemoryContextStatsInternal(
+            MemoryContext(root), 0, True, False, Args.max_children, totals)
+        return Snapshot, totals
+    finally:
+        end_walk_budget()
+        Snapshot = None
+        type_layouts().flush()
 
 
 class AllocSetContext:
-    def __init__(self, aset):
-        self._c_aset = aset
-        self.blocks = aset.GetChildMemberWithName("blocks")
-        freelist = aset.GetChildMemberWithName("freelist")
-        assert freelist.GetType().IsArrayType(), \
-            "freelist is not an array type"
-        self.freelist = [
-            MemoryChunk(freelist.GetChildAtIndex(i))
-            for i in range(ALLOCSET_NUM_FREELISTS)
-        ]
+    decoder = LazyDecoder("AllocSetContext", ["blocks", "freelist"])
+
+    def __init__(self, addr):
+        aset = self.decoder.decode(addr)
+        self.blocks = aset.blocks
+        # the first free MemoryChunk of each freelist
+        self.freelist = aset.freelist
 
 
 class AllocBlock:
-    def __init__(self, blk):
-        self._c_blk = blk
-        self.next = blk.GetChildMemberWithName("next")
-        self.endptr = blk.GetChildMemberWithName("endptr")
-        self.freeptr = blk.GetChildMemberWithName("freeptr")
+    decoder = LazyDecoder("AllocBlockData", ["next", "freeptr", "endptr"])
+
+    def __init__(self, addr):
+        self.addr = addr
+        blk = self.decoder.decode(addr)
+        self.next = blk.next
+        self.endptr = blk.endptr
+        self.freeptr = blk.freeptr
 
     def __len__(self):
-        start = self._c_blk.GetValueAsUnsigned()
-        end = self.endptr.GetValueAsUnsigned()
-        return end - start
+        return self.endptr - self.addr
 
     def available(self):
-        end = self.endptr.GetValueAsUnsigned()
-        free = self.freeptr.GetValueAsUnsigned()
-        return end - free
-
-
-class AllocFreeListLink:
-    def __init__(self, link):
-        self._c_link = link
-        self.next = link.GetChildMemberWithName("next")
-
+        return self.endptr - self.freeptr
 
-class MemoryChunk:
-    def __init__(self, chunk):
-        self._c_chunk = chunk
 
-    def is_not_null(self):
-        return self._c_chunk.GetValueAsUnsigned() != 0
+class MemoryContextReport:
+    """
+    pgmem -g: running counters of the walked contexts grouped by name,
+    ident or kind, and the largest contexts on a heap of at most top
+    """
 
-    def GetFreeListLink(self):
-        chkptr = self._c_chunk.GetValueAsUnsigned()
-        addr = lldb.SBAddress(chkptr + sizeof('MemoryChunk'), lldb_target)
-        link_type = lldb_target.FindFirstType('AllocFreeListLink')
-        link = lldb_target.CreateValueFromAddress("link", addr, link_type)
-        return AllocFreeListLink(link)
+    def __init__(self, group_by, top):
+        self.group_by = group_by
+        self.top = top
+        # key -> [number of contexts, MemoryContextCounters]
+        self.groups = {}
+        # (totalspace, addr, MemoryContext, MemoryContextCounters)
+        self.largest = []
+        self.ncontexts = 0
+
+    def key(self, memcxt):
+        if self.group_by == "kind":
+            return memcxt.typcxt
+        if self.group_by == "ident":
+            return memcxt.ident
+        return memcxt.name
+
+    def add(self, memcxt, counters):
+        self.ncontexts += 1
+        key = self.key(memcxt)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = [0, MemoryContextCounters()]
+        group[0] += 1
+        group[1].add(counters)
+        if self.top <= 0:
+            return
+        item = (counters.totalspace, memcxt.addr, memcxt, counters)
+        if len(self.largest) < self.top:
+            heapq.heappush(self.largest, item)
+        elif item[:2] > self.largest[0][:2]:
+            heapq.heapreplace(self.largest, item)
+
+    def print(self, with_addr):
+        groups = sorted(self.groups.items(),
+                        key=lambda g: g[1][1].totalspace, reverse=True)
+        print(f"{self.ncontexts} contexts in {len(groups)} groups "
+              f"by {self.group_by}")
+        print(f"{'count':>8} {'total':>12} {'blocks':>8} {'free':>12} "
+              f"{'chunks':>8} {'used':>12}  {self.group_by}")
+        for key, (count, c) in groups[:self.top]:
+            print(f"{count:>8} {c.totalspace:>12} {c.nblocks:>8} "
+                  f"{c.freespace:>12} {c.freechunks:>8} "
+                  f"{c.totalspace - c.freespace:>12}  "
+                  f"{key or '-'}{c.estimate_string()}")
+        if len(groups) > self.top:
+            print(f"{len(groups) - self.top} smaller groups not shown")
+        if not self.largest:
+            return
+        print(f"\n{'total':>12} {'free':>12} {'used':>12}  largest contexts")
+        for total, addr, memcxt, c in sorted(self.largest, reverse=True):
+            name = f"{addr:#x} {memcxt.name}" if with_addr else memcxt.name
+            ident = f": {memcxt.ident}" if memcxt.ident else ""
+            print(f"{total:>12} {c.freespace:>12} "
+                  f"{total - c.freespace:>12}  {name}{ident}"
+                  f"{c.estimate_string()}")
 
 
 Args = None
-Newdumpfile = None
+# ContextRecords of the walked contexts when taking a snapshot
+Snapshot = None
+# the report of pgmem -g in progress, None when printing the tree
+_report = None
 
 
 def _handle_args(raw_args):
@@ -162,9 +967,24 @@ def _handle_args(raw_args):
                         metavar='memory_context_name',
                         help='exclude memory context stats from dump')
     parser.add_argument('-d', '--diff', action='store_true',
-                        help='diff the stats with previous dump')
-    parser.add_argument('-m', '--max-children', type=int, default=100,
-                        help='max number of children to dump')
+                        help='save a snapshot and show the contexts that '
+                             'changed since the previous one, at most '
+                             '--max-children of them')
+    parser.add_argument('-s', '--snapshot', metavar='file',
+                        default='_pgmem.snapshot.json',
+                        help='snapshot file of --diff, '
+                             'default: _pgmem.snapshot.json')
+    parser.add_argument('-m', '--max-children', type=int,
+                        help='max number of children to dump, '
+                             'default: 100, no limit with -g')
+    parser.add_argument('-c', '--freelist-cap', type=int, default=1000000,
+                        metavar='chunks',
+                        help='stop walking an AllocSet freelist after this '
+                             'many chunks and mark the stats as estimated, '
+                             '0 for no cap, default: 1000000')
+    parser.add_argument('-F', '--freelist-stats', action='store_true',
+                        help='show the number of free chunks per AllocSet '
+                             'freelist')
     parser.add_argument('-a', '--all-contexts', action='store_true',
                         help='show all memory contexts')
     parser.add_argument('-r', '--with-addr', action='store_true',
@@ -173,21 +993,109 @@ def _handle_args(raw_args):
                         help='memory context name')
     parser.add_argument('-p', '--parent', metavar='level', type=int, default=0,
                         help='parent of current memory context')
+    parser.add_argument('-B', '--budget-ms', metavar='ms', type=float,
+                        default=0,
+                        help='sample the children not walked yet once the '
+                             'walk took this long and estimate their stats, '
+                             'default: 0, no limit')
+    parser.add_argument('--budget-nodes', metavar='contexts', type=int,
+                        default=0,
+                        help='like --budget-ms, after this many contexts')
+    parser.add_argument('--budget-bytes', metavar='bytes', type=int,
+                        default=0,
+                        help='like --budget-ms, after reading this many '
+                             'bytes of target memory')
+    parser.add_argument('--sample-size', type=int, default=30,
+                        help='number of children sampled per context once '
+                             'the budget is used up, default: 30')
+    parser.add_argument('--sample-nodes', metavar='contexts', type=int,
+                        default=0,
+                        help='walk at most this many more contexts once the '
+                             'budget is used up, then only the sampled '
+                             'contexts themselves, default: 10 times '
+                             '--sample-size')
+    parser.add_argument('--sample-depth', metavar='levels', type=int,
+                        default=8,
+                        help='sample within sampled subtrees this many '
+                             'levels deep, default: 8')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of the sampling')
+    parser.add_argument('-w', '--watch', metavar='seconds', type=float,
+                        help='sample the contexts every given seconds, '
+                             'letting the process run in between, and append '
+                             'their counters to the --series file')
+    parser.add_argument('--samples', type=int, default=0,
+                        help='number of --watch samples, default: until '
+                             'interrupted')
+    parser.add_argument('--pause-budget', metavar='ms', type=float,
+                        default=50,
+                        help='back off --watch sampling while the process is '
+                             'paused longer than this per sample, '
+                             'default: 50')
+    parser.add_argument('--series', metavar='file',
+                        default='_pgmem.watch.csv',
+                        help='time series file of --watch, '
+                             'default: _pgmem.watch.csv')
+    parser.add_argument('--profile', action='store_true',
+                        help='report the time, debugger calls and bytes '
+                             'read per phase and per context kind')
+    parser.add_argument('--refresh', action='store_true',
+                        help='read the contexts from the target again '
+                             'instead of reusing the walk of an earlier '
+                             'pgmem at the same stop')
+    parser.add_argument('-g', '--group-by', choices=['name', 'ident', 'kind'],
+                        help='instead of the tree, report the contexts '
+                             'it would show grouped by name, ident or kind, '
+                             'and the largest of them')
+    parser.add_argument('-t', '--top', type=int, default=20,
+                        help='number of groups and of largest contexts '
+                             'reported by -g, default: 20')
 
     global Args
     args_list = shlex.split(raw_args)
     Args = parser.parse_args(args_list)
-
-
-def pgmem(debugger, raw_args, result, internal_dict):
-    if lldb_target.GetProcess().GetState() == lldb.eStateRunning:
+    if Args.sample_size < 1:
+        parser.error("--sample-size must be at least 1")
+    if Args.sample_nodes < 0:
+        parser.error("--sample-nodes must not be negative")
+    if Args.sample_depth < 0:
+        parser.error("--sample-depth must not be negative")
+    if Args.max_children is None:
+        Args.max_children = sys.maxsize if Args.group_by else 100
+
+
+def pgmem(debugger, raw_args, exe_ctx, result, internal_dict):
+    target = exe_ctx.GetTarget()
+    if not target.IsValid():
+        print("No target.  Create one with 'target create' or 'attach'.")
+        return
+    use_target(target)
+    if target.GetProcess().GetState() == lldb.eStateRunning:
         print("Process is running.  Use 'process interrupt' to pause execution.")
         return
 
+    args_list = shlex.split(raw_args)
+    if args_list[:1] == ["find"]:
+        try:
+            pgmem_find(exe_ctx.GetFrame(), args_list[1:])
+        finally:
+            end_tree_model()
+        return
+
     global Args
-    global Newdumpfile
-    Newdumpfile = None
     _handle_args(raw_args)
+    start_profile(Args.profile)
+    try:
+        _pgmem(debugger, exe_ctx.GetFrame())
+    finally:
+        end_tree_model()
+        end_profile()
+
+
+def _pgmem(debugger, frame):
+    global Snapshot
+    global _report
+    Snapshot = None
 
     dump_mode = 'a'
     if Args.overwrite:
@@ -195,13 +1103,7 @@ def pgmem(debugger, raw_args, result, internal_dict):
     if Args.output:
         sys.stdout = open(Args.output, dump_mode)
     if Args.diff:
-        # copy new file to old file if it exists
-        if os.path.isfile('_pgmem.dump.new'):
-            shutil.copyfile('_pgmem.dump.new', '_pgmem.dump.old')
-        Newdumpfile = open('_pgmem.dump.new', 'w')
-
-    process = debugger.GetSelectedTarget().GetProcess()
-    frame = process.GetSelectedThread().GetSelectedFrame()
+        Snapshot = []
 
     if Args.all_contexts:
         Args.memory_context_var = "TopMemoryContext"
@@ -210,26 +1112,320 @@ def pgmem(debugger, raw_args, result, internal_dict):
         for i in range(Args.parent):
             Args.memory_context_var += "->parent"
 
-    memcxt = frame.EvaluateExpression(Args.memory_context_var)
+    with profile_phase("resolve"):
+        memcxt = resolve_memory_context(frame, Args.memory_context_var)
     if not memcxt.GetError().Success():
         print("expression `{}` is not valid"
               .format(Args.memory_context_var))
         return
 
-    memcxt = MemoryContext(memcxt)
+    assert memcxt.GetType().IsPointerType(), "memcxt is not a pointer type"
+    reset_walk_caches()
+    if Args.watch:
+        memcxt = MemoryContext(memcxt.GetValueAsUnsigned())
+    else:
+        model = start_tree_model(Args.refresh)
+        # -g streams the contexts into its report and keeps none of them,
+        # unless an earlier walk at this stop has them all already
+        if Args.group_by and memcxt.GetValueAsUnsigned() not in \
+                model.complete:
+            end_tree_model()
+        memcxt = context_at(memcxt.GetValueAsUnsigned())
     assert memcxt.typcxt in CONTEXT_KINDS, \
         f"{Args.memory_context_var} is not an MemoryContext"
 
+    if Args.watch:
+        pgmem_watch(debugger, Args.memory_context_var)
+        return
+
     grand_totals = MemoryContextCounters()
     begin_print = False if Args.cxtname else True
-    MemoryContextStatsInternal(
-        memcxt, 0, begin_print, True, Args.max_children, grand_totals)
-    print(grand_totals)
+    # a subtree walked before is all in memory, no need to sample it
+    reused = memcxt.addr in model.complete
+    if not reused:
+        start_walk_budget()
+    if Args.group_by:
+        _report = MemoryContextReport(Args.group_by, Args.top)
+    try:
+        MemoryContextStatsInternal(
+            memcxt, 0, begin_print, _report is not None or not Args.diff,
+            Args.max_children, grand_totals)
+    finally:
+        budget = end_walk_budget()
+        report, _report = _report, None
+    with profile_phase("render"):
+        if report is not None:
+            report.print(Args.with_addr)
+        print(grand_totals)
+    if reused:
+        print(f"reused the walk of stop {model.stop_id}, "
+              f"--refresh to read the target again")
+    if budget is not None and budget.exhausted:
+        print(f"walk budget used up after {budget.exhausted_nodes} "
+              f"contexts, the rest was sampled, {budget.nodes} contexts "
+              f"and {budget.nbytes} bytes read in all")
+        if budget.cut:
+            print(f"the subtrees of {budget.cut} sampled contexts were left "
+                  f"out, the totals are low")
+    type_layouts().flush()
     if Args.diff:
-        Newdumpfile.close()
-        os.system("diff -uN --color=always _pgmem.dump.old _pgmem.dump.new")
-        # os.remove('_pgmem.dump.old')
-        # os.remove('_pgmem.dump.new')
+        old = None
+        if os.path.isfile(Args.snapshot):
+            old = read_snapshot(Args.snapshot)
+        write_snapshot(Args.snapshot, Snapshot,
+                       {"root": Args.memory_context_var,
+                        "sampled": grand_totals.estimated})
+        if old is None:
+            print(f"no previous snapshot, saved to {Args.snapshot}")
+        else:
+            if grand_totals.estimated:
+                print("contexts skipped by sampling show as disappeared")
+            with profile_phase("render"):
+                changes = diff_snapshots(old, Snapshot)
+                for line in format_diff(changes, Args.with_addr,
+                                        Args.max_children):
+                    print(line)
+        Snapshot = None
+
+
+def resolve_memory_context(frame, expr):
+    """
+    SBValue of the memory context expression `expr`.  A plain variable name
+    is looked up directly, which is much cheaper than evaluating it.
+    """
+    if expr.isidentifier():
+        value = None
+        if frame.IsValid():
+            if _profile is not None:
+                _profile.count("FindVariable")
+            value = frame.FindVariable(expr)
+        if value is None or not value.IsValid():
+            if _profile is not None:
+                _profile.count("FindFirstGlobalVariable")
+            value = lldb_target.FindFirstGlobalVariable(expr)
+        if value.IsValid():
+            return value
+    if _profile is not None:
+        _profile.count("EvaluateExpression")
+    return frame.EvaluateExpression(expr)
+
+
+def find_contexts(model, pattern, fields, regex):
+    """
+    Addresses of the contexts in model whose name, ident or address, as
+    given by fields, matches the glob pattern, or the regular expression
+    if regex.  Only the distinct names and idents are matched, and an
+    address without wildcards is looked up directly.
+    """
+    if regex:
+        match = re.compile(pattern).search
+    else:
+        match = re.compile(fnmatch.translate(pattern)).match
+    found = set()
+    if "name" in fields:
+        for name, addrs in model.by_name.items():
+            if match(name):
+                found.update(addrs)
+    if "ident" in fields:
+        for ident, addrs in model.by_ident.items():
+            if match(ident):
+                found.update(addrs)
+    if "addr" in fields:
+        try:
+            addr = int(pattern, 16)
+        except ValueError:
+            found.update(addr for addr in model.contexts
+                         if match(f"{addr:#x}"))
+        else:
+            if addr in model.contexts:
+                found.add(addr)
+    return found
+
+
+def pgmem_find(frame, args_list):
+    """
+    pgmem find: the contexts below a root whose name, ident or address
+    matches a pattern, each with the path down to it from the root and
+    the totals of its subtree
+    """
+    parser = argparse.ArgumentParser(
+        prog='pgmem find',
+        description='Find memory contexts by name, ident or address')
+    parser.add_argument('pattern',
+                        help='glob pattern, e.g. "pg_class*" or "0x55d1*"')
+    parser.add_argument('-E', '--regex', action='store_true',
+                        help='the pattern is a regular expression that '
+                             'matches anywhere')
+    parser.add_argument('-f', '--field', action='append',
+                        choices=['name', 'ident', 'addr'],
+                        help='match only this, can be repeated, '
+                             'default: name, ident and addr')
+    parser.add_argument('-R', '--root', default='TopMemoryContext',
+                        metavar='<memory context>',
+                        help='search below this context, '
+                             'default: TopMemoryContext')
+    parser.add_argument('-m', '--max-hits', type=int, default=100,
+                        help='show this many of the largest hits, '
+                             'default: 100')
+    parser.add_argument('--refresh', action='store_true',
+                        help='read the contexts from the target again')
+    args = parser.parse_args(args_list)
+
+    # the walk takes the stats options of pgmem, at their defaults
+    _handle_args("")
+    value = resolve_memory_context(frame, args.root)
+    if not value.GetError().Success():
+        print(f"expression `{args.root}` is not valid")
+        return
+    reset_walk_caches()
+    model = start_tree_model(args.refresh)
+    root = context_at(value.GetValueAsUnsigned())
+    assert root.typcxt in CONTEXT_KINDS, \
+        f"{args.root} is not an MemoryContext"
+    if root.addr not in model.complete:
+        MemoryContextStatsInternal(root, 0, True, False, sys.maxsize,
+                                   MemoryContextCounters())
+    type_layouts().flush()
+
+    hits = []
+    memo = {}
+    fields = args.field or ["name", "ident", "addr"]
+    for addr in find_contexts(model, args.pattern, fields, args.regex):
+        path = model.path(addr, root.addr)
+        if path is not None:
+            hits.append((path, *model.subtree_totals(addr, memo)))
+    hits.sort(key=lambda hit: hit[1].totalspace, reverse=True)
+
+    for path, totals, ncontexts in hits[:args.max_hits]:
+        memcxt = path[-1]
+        ident = f": {memcxt.ident}" if memcxt.ident else ""
+        counters = model.stats[memcxt.addr][0]
+        print(f"{memcxt.addr:#x} {memcxt.name}: "
+              f"{counters.stats_string()}{ident}")
+        print("  " + " > ".join(m.name for m in path))
+        if ncontexts > 1:
+            print(f"  {ncontexts} contexts below and including it: "
+                  f"{totals.stats_string()}")
+    if len(hits) > args.max_hits:
+        print(f"{len(hits) - args.max_hits} smaller hits not shown")
+    print(f"{len(hits)} of {len(model.contexts)} contexts match "
+          f"`{args.pattern}`")
+
+
+WATCH_FIELDS = ("time", "sample", "pause_ms") + ContextRecord._fields
+
+
+def WatchSample(root):
+    """
+    Counters of the contexts below root that pass the -n, -i and -x
+    filters.  Only the headers of the other contexts are read, so watching
+    a small subtree is cheap.
+    """
+    records = []
+    totals = MemoryContextCounters()
+    stack = [(root, Args.cxtname is None)]
+    while stack:
+        addr, in_scope = stack.pop()
+        memcxt = MemoryContext(addr)
+        in_scope = in_scope or memcxt.name == Args.cxtname
+        wanted = in_scope and \
+            not (Args.include and memcxt.name not in Args.include) and \
+            not (Args.exclude and memcxt.name in Args.exclude)
+        if wanted:
+            counters = MemoryContextCounters()
+            fn_stats = MEMORY_CONTEXT_STATS_IMPL[memcxt.typcxt]
+            fn_stats(memcxt, None, 0, counters)
+            totals.add(counters)
+            records.append(memcxt.record(counters))
+        children = []
+        child = memcxt.firstchild
+        while child:
+            children.append((child, in_scope))
+            child = MemoryContext(child).nextchild
+        stack.extend(reversed(children))
+    return records, totals
+
+
+def _wait_until_stopped(process, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while process.GetState() == lldb.eStateRunning:
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.001)
+    return process.GetState() == lldb.eStateStopped
+
+
+def pgmem_watch(debugger, expr):
+    """
+    pgmem --watch: sample the contexts, let the process run for the
+    interval, interrupt it and sample again.  Each sample appends one row
+    per context to the --series file.  The time the process is paused per
+    sample is reported, and the interval doubles while it is over the
+    --pause-budget.
+    """
+    process = lldb_target.GetProcess()
+    base_interval = interval = Args.watch
+    budget = Args.pause_budget / 1000
+
+    new_series = not os.path.isfile(Args.series)
+    series = open(Args.series, "a", newline="")
+    writer = csv.writer(series)
+    if new_series:
+        writer.writerow(WATCH_FIELDS)
+
+    was_async = debugger.GetAsync()
+    debugger.SetAsync(True)
+    sample = 0
+    try:
+        paused_at = time.perf_counter()
+        while True:
+            frame = process.GetSelectedThread().GetSelectedFrame()
+            with profile_phase("resolve"):
+                root = resolve_memory_context(frame, expr) \
+                    .GetValueAsUnsigned()
+            reset_walk_caches()
+            records, totals = WatchSample(root)
+            pause = time.perf_counter() - paused_at
+            if _profile is not None:
+                _profile.stopped = (_profile.stopped or 0) + pause
+
+            now = f"{time.time():.3f}"
+            for r in records:
+                writer.writerow((now, sample, f"{pause * 1000:.3f}") + r)
+            series.flush()
+            print("sample {}: {} contexts; {} total; {} used; "
+                  "paused {:.1f} ms".format(
+                      sample, len(records), totals.totalspace,
+                      totals.totalspace - totals.freespace, pause * 1000),
+                  flush=True)
+
+            sample += 1
+            if Args.samples and sample >= Args.samples:
+                break
+            if pause > budget:
+                interval = min(interval * 2, base_interval * 64)
+                print(f"pause over {Args.pause_budget:g} ms budget, "
+                      f"sampling every {interval:g}s", flush=True)
+            elif interval > base_interval and pause < budget / 2:
+                interval = max(interval / 2, base_interval)
+
+            process.Continue()
+            time.sleep(interval)
+            paused_at = time.perf_counter()
+            if process.GetState() == lldb.eStateRunning:
+                process.Stop()
+            if not _wait_until_stopped(process):
+                print("process did not stop, watch ends")
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if process.GetState() == lldb.eStateRunning:
+            process.Stop()
+            _wait_until_stopped(process)
+        debugger.SetAsync(was_async)
+        series.close()
+        type_layouts().flush()
 
 
 def maxalign(len):
@@ -241,30 +1437,51 @@ def AllocSetStats(context: MemoryContext, printfunc, passthru, totals):
     nblocks = 0
     freespace = 0
     freechunks = 0
-    aset = AllocSetContext(context.CastAs("AllocSetContext"))
+    aset = AllocSetContext(context.addr)
 
-    block = AllocBlock(aset.blocks)
-    while block:
+    blkaddr = aset.blocks
+    while blkaddr:
+        block = AllocBlock(blkaddr)
         nblocks += 1
         totalspace += len(block)
         freespace += block.available()
-        block = AllocBlock(block.next)
-
+        blkaddr = block.next
+
+    # GetFreeListLink(chunk) is the AllocFreeListLink right after the
+    # chunk header, follow its `next` with raw reads
+    chunkhdrsz = sizeof("MemoryChunk")
+    chaser = PointerChaser(
+        page_cache(),
+        chunkhdrsz + type_layouts().offsetof("AllocFreeListLink", "next"),
+        Args.freelist_cap)
+    fcounts = []
+    estimated = []
     for fidx in range(ALLOCSET_NUM_FREELISTS):
         chksz = GetChunkSizeFromFreeListIdx(fidx)
-        chunk = aset.freelist[fidx]
-
-        while chunk.is_not_null():
-            link = chunk.GetFreeListLink()
-            freechunks += 1
-            freespace += chksz + sizeof("MemoryChunk")
-            chunk = MemoryChunk(link.next)
+        with profile_phase("AllocSet freelists"):
+            nchunks, status = chaser.count(aset.freelist[fidx])
+        fcounts.append(nchunks)
+        if status == "capped":
+            estimated.append(f"freelist[{fidx}] capped at {nchunks} chunks")
+        elif status == "cycle":
+            estimated.append(f"freelist[{fidx}] loops after {nchunks} chunks")
+        elif status == "unreadable":
+            estimated.append(
+                f"freelist[{fidx}] unreadable after {nchunks} chunks")
+        freechunks += nchunks
+        freespace += nchunks * (chksz + chunkhdrsz)
 
     if printfunc:
         stats_string = \
             "{} total in {} blocks; {} free ({} chunks); {} used" \
             .format(totalspace, nblocks, freespace, freechunks,
                     totalspace - freespace)
+        if Args.freelist_stats:
+            stats_string += "; freelists: " + ", ".join(
+                f"{GetChunkSizeFromFreeListIdx(fidx)}B x {n}"
+                for fidx, n in enumerate(fcounts) if n)
+        if estimated:
+            stats_string += " (estimated: {})".format(", ".join(estimated))
         printfunc(context, passthru, stats_string)
 
     if totals:
@@ -272,63 +1489,51 @@ def AllocSetStats(context: MemoryContext, printfunc, passthru, totals):
         totals.freechunks += freechunks
         totals.totalspace += totalspace
         totals.freespace += freespace
+        totals.estimated = totals.estimated or bool(estimated)
 
 
 class dlist_node:
-    def __init__(self, node: lldb.SBValue):
-        assert not node.GetType().IsPointerType(), "node is a pointer type"
-        self._c_node = node
-        self.next = node.GetChildMemberWithName("next")
-        assert self.next.GetType().IsPointerType(), "next is not a pointer type"
-        self.prev = node.GetChildMemberWithName("prev")
-        assert self.prev.GetType().IsPointerType(), "prev is not a pointer type"
+    decoder = LazyDecoder("dlist_node", ["next", "prev"])
+
+    def __init__(self, addr):
+        """
+        addr is the address of a dlist_node
+        """
+        self.addr = addr
+        node = self.decoder.decode(addr)
+        self.next = node.next
+        self.prev = node.prev
 
     def Next(self):
-        if self.next.GetValueAsUnsigned() == 0:
+        if self.next == 0:
             return None
-        return dlist_node(self.next.Dereference())
+        return dlist_node(self.next)
 
     def Prev(self):
-        if self.prev.GetValueAsUnsigned() == 0:
+        if self.prev == 0:
             return None
-        return dlist_node(self.prev.Dereference())
+        return dlist_node(self.prev)
 
     def _is_empty(self):
-        next_ptr = self.next.GetValueAsUnsigned()
-        prev_ptr = self.prev.GetValueAsUnsigned()
-        node_ptr = self._c_node.AddressOf().GetValueAsUnsigned()
-        return (next_ptr == 0 and prev_ptr == 0) or \
-            (next_ptr == node_ptr and prev_ptr == node_ptr)
+        return (self.next == 0 and self.prev == 0) or \
+            (self.next == self.addr and self.prev == self.addr)
 
     def is_valid(self):
         return not self._is_empty()
 
-    def CastAs(self, typname):
-        """
-        dlist_node* -> typname*
-        """
-        target_typ = lldb_target.FindFirstType(typname)
-        target_typ_ptr = target_typ.GetPointerType()  # typname*
-        generic_ptr = self._c_node.AddressOf()  # char*
-        target_ptr = generic_ptr.Cast(target_typ_ptr)
-        return target_ptr
-
     def __eq__(self, other):
-        next_ptr = self.next.GetValueAsUnsigned()
-        other_next_ptr = other.next.GetValueAsUnsigned()
-        prev_ptr = self.prev.GetValueAsUnsigned()
-        other_prev_ptr = other.prev.GetValueAsUnsigned()
-        return next_ptr == other_next_ptr and prev_ptr == other_prev_ptr
+        return self.next == other.next and self.prev == other.prev
 
     def __str__(self):
-        return "<dlist_node: {{next: {}, prev: {}}}>".format(
-            self.next.GetValue(), self.prev.GetValue())
+        return "<dlist_node: {{next: {:#x}, prev: {:#x}}}>".format(
+            self.next, self.prev)
 
 
 class dlist_head:
-    def __init__(self, blocks: lldb.SBValue):
-        assert not blocks.GetType().IsPointerType(), "blocks is a pointer type"
-        self._c_head = blocks.GetChildMemberWithName("head")
+    def __init__(self, addr):
+        """
+        addr is the address of a dlist_head
+        """
         #
         # head.next either points to the first element of the list; to &head if
         # it's a circular empty list; or to NULL if empty and not circular.
@@ -336,7 +1541,7 @@ class dlist_head:
         # head.prev either points to the last element of the list; to &head if
         # it's a circular empty list; or to NULL if empty and not circular.
         #
-        self.head = dlist_node(self._c_head)
+        self.head = dlist_node(addr)
 
     def is_empty(self):
         return self.head._is_empty()
@@ -348,6 +1553,25 @@ class dlist_head:
             yield cur
             cur = cur.Next()
 
+    def foreach(self, decoder, member):
+        """
+        Like dlist_foreach + dlist_container: decode each element of the list
+        as the struct whose dlist_node `member` links it into the list.  The
+        node is decoded along with its container, so that is one memory read
+        per element.
+        """
+        link = member.replace(".", "_") + "_next"
+        offset = decoder.offsetof(member)
+        end = self.head.addr
+        cur = self.head.next
+        while cur != 0 and cur != end:
+            elem = decoder.decode(cur - offset)
+            yield cur - offset, elem
+            nxt = getattr(elem, link)
+            if nxt == cur:
+                break
+            cur = nxt
+
 
 #
 # GenerationBlock
@@ -362,40 +1586,35 @@ class dlist_head:
 #  	within the block begins at the next alignment boundary.
 #
 class GenerationBlock:
-    def __init__(self, blk: lldb.SBValue):
+    decoder = LazyDecoder("GenerationBlock", [
+        "node.next", "blksize", "nchunks", "nfree", "freeptr", "endptr",
+    ])
+
+    def __init__(self, blk):
         """
-        blk is a pointer to a GenerationBlock
+        blk is a decoded GenerationBlock
         """
-        self._c_blk = blk
-        self.node = dlist_node(blk.GetChildMemberWithName("node"))
-        self.context = blk.GetChildMemberWithName("context")
-
-        blksize = blk.GetChildMemberWithName("blksize")
-        self.blksize = blksize.GetValueAsUnsigned()
-        nchunks = blk.GetChildMemberWithName("nchunks")
-        self.nchunks = nchunks.GetValueAsUnsigned()
-        nfree = blk.GetChildMemberWithName("nfree")
-        self.nfree = nfree.GetValueAsUnsigned()
-        freeptr = blk.GetChildMemberWithName("freeptr")
-        self.freeptr = freeptr.GetValueAsUnsigned()
-        endptr = blk.GetChildMemberWithName("endptr")
-        self.endptr = endptr.GetValueAsUnsigned()
+        self.blksize = blk.blksize
+        self.nchunks = blk.nchunks
+        self.nfree = blk.nfree
+        self.freeptr = blk.freeptr
+        self.endptr = blk.endptr
 
     def available(self):
         return self.endptr - self.freeptr
 
 
 class GenerationContext:
-    def __init__(self, gen: lldb.SBValue):
-        self._c_gen = gen
+    decoder = LazyDecoder("GenerationContext", [])
+
+    def __init__(self, addr):
         # list of blocks
         # same: &gen.blocks, &gen.blocks.head, &gen.blocks.head.prev
-        blocks = gen.GetChildMemberWithName("blocks")
-        self.blocks = dlist_head(blocks)
+        self.blocks = dlist_head(addr + self.decoder.offsetof("blocks.head"))
 
 
 def GenerationStats(context: MemoryContext, printfunc, passthru, totals):
-    gen = GenerationContext(context.CastAs("GenerationContext"))
+    gen = GenerationContext(context.addr)
 
     totalspace = maxalign(sizeof("GenerationContext"))
     nblocks = 0
@@ -403,8 +1622,8 @@ def GenerationStats(context: MemoryContext, printfunc, passthru, totals):
     nfreechunks = 0
     freespace = 0
 
-    for node in gen.blocks:
-        block = GenerationBlock(node.CastAs("GenerationBlock"))
+    for _, blk in gen.blocks.foreach(GenerationBlock.decoder, "node"):
+        block = GenerationBlock(blk)
         nblocks += 1
         nchunks += block.nchunks
         nfreechunks += block.nfree
@@ -425,46 +1644,249 @@ def GenerationStats(context: MemoryContext, printfunc, passthru, totals):
         totals.freespace += freespace
 
 
-def SlabStats(context, printfunc, passthru, totals):
-    pass
+#
+# SlabBlock
+#	Structure of a single slab block.
+#
+#	nfree is the number of chunks on the block which are unallocated, the
+#	block is linked by `node` into one of the blocklist[] of its context, or
+#	into emptyblocks if all of its chunks are free.
+#
+class SlabBlock:
+    decoder = LazyDecoder("SlabBlock", ["node.next", "nfree"])
+
+
+class SlabContext:
+    decoder = LazyDecoder("SlabContext", [
+        "fullChunkSize", "blockSize", "chunksPerBlock", "emptyblocks.count",
+    ])
+
+    def __init__(self, addr):
+        slab = self.decoder.decode(addr)
+        self.fullChunkSize = slab.fullChunkSize
+        self.blockSize = slab.blockSize
+        self.chunksPerBlock = slab.chunksPerBlock
+        # dclist_count(&slab->emptyblocks)
+        self.nemptyblocks = slab.emptyblocks_count
+        blocklist = addr + self.decoder.offsetof("blocklist")
+        self.blocklist = [
+            dlist_head(blocklist + i * sizeof("dlist_head"))
+            for i in range(SLAB_BLOCKLIST_COUNT)
+        ]
+
+    def header_size(self):
+        """
+        Slab_CONTEXT_HDRSZ(chunksPerBlock)
+        """
+        hdrsz = sizeof("SlabContext")
+        # isChunkFree[] follows the context with MEMORY_CONTEXT_CHECKING
+        if type_layouts().has_member("SlabContext", "isChunkFree"):
+            hdrsz += self.chunksPerBlock * sizeof("bool")
+        return hdrsz
+
+
+def SlabStats(context: MemoryContext, printfunc, passthru, totals):
+    slab = SlabContext(context.addr)
+    nblocks = 0
+    freechunks = 0
+    freespace = 0
+
+    # Include context header in totalspace
+    totalspace = slab.header_size()
+
+    # Add the space consumed by blocks in the emptyblocks list
+    totalspace += slab.nemptyblocks * slab.blockSize
+
+    for blocklist in slab.blocklist:
+        for _, block in blocklist.foreach(SlabBlock.decoder, "node"):
+            nblocks += 1
+            totalspace += slab.blockSize
+            freespace += slab.fullChunkSize * block.nfree
+            freechunks += block.nfree
+
+    if printfunc:
+        stats_string = \
+            "{} total in {} blocks; {} empty blocks; {} free ({} chunks); " \
+            "{} used" \
+            .format(totalspace, nblocks, slab.nemptyblocks, freespace,
+                    freechunks, totalspace - freespace)
+        printfunc(context, passthru, stats_string)
+
+    if totals:
+        totals.nblocks += nblocks
+        totals.freechunks += freechunks
+        totals.totalspace += totalspace
+        totals.freespace += freespace
+
+
+#
+# BumpBlock
+#	BumpBlock is the unit of memory that is obtained by bump.c from
+#	malloc().  Chunks are never freed individually, so the free space of a
+#	block is what lies between freeptr and endptr.
+#
+class BumpBlock:
+    decoder = LazyDecoder("BumpBlock", ["node.next", "freeptr", "endptr"])
+
+
+class BumpContext:
+    decoder = LazyDecoder("BumpContext", [])
+
+    def __init__(self, addr):
+        # list of blocks with the block currently being filled at the head
+        self.blocks = dlist_head(addr + self.decoder.offsetof("blocks.head"))
+
+
+def BumpStats(context: MemoryContext, printfunc, passthru, totals):
+    bump = BumpContext(context.addr)
+    nblocks = 0
+    totalspace = 0
+    freespace = 0
+
+    for blkaddr, block in bump.blocks.foreach(BumpBlock.decoder, "node"):
+        nblocks += 1
+        totalspace += block.endptr - blkaddr
+        freespace += block.endptr - block.freeptr
+
+    if printfunc:
+        stats_string = \
+            "{} total in {} blocks; {} free; {} used" \
+            .format(totalspace, nblocks, freespace, totalspace - freespace)
+        printfunc(context, passthru, stats_string)
+
+    if totals:
+        totals.nblocks += nblocks
+        totals.totalspace += totalspace
+        totals.freespace += freespace
 
 
 MEMORY_CONTEXT_STATS_IMPL = {
     "T_AllocSetContext": AllocSetStats,
     "T_SlabContext": SlabStats,
     "T_GenerationContext": GenerationStats,
+    "T_BumpContext": BumpStats,
 }
 
 
+def SampleSiblings(first, level, begin_print, max_children, totals):
+    """
+    Estimate the stats of the sibling list starting at context `first`
+    into totals: follow just the nextchild links to count the siblings and
+    pick a uniform random sample of them, walk the subtrees of the sample
+    and extrapolate.  totals.variance is that of the estimated totalspace,
+    including the variance of subtrees that were sampled themselves.
+    Returns the number of siblings and of sampled ones.
+    """
+    k = _budget.current_sample_size()
+    rng = _budget.rng
+    sample = []
+    seen = 0
+
+    def reservoir(addr):
+        nonlocal seen
+        seen += 1
+        if len(sample) < k:
+            sample.append(addr)
+        else:
+            j = rng.randrange(seen)
+            if j < k:
+                sample[j] = addr
+
+    chaser = PointerChaser(page_cache(),
+                           MemoryContext.decoder.offsetof("nextchild"))
+    with profile_phase("sampling"):
+        n, _ = chaser.count(first, reservoir)
+    sample = sorted(set(sample))
+
+    stats = []
+    for addr in sample:
+        counters = MemoryContextCounters()
+        memcxt = context_at(addr)
+        if _budget.may_descend():
+            _budget.depth += 1
+            try:
+                MemoryContextStatsInternal(memcxt, level, begin_print,
+                                           False, max_children, counters)
+            finally:
+                _budget.depth -= 1
+        else:
+            # only the context itself, its subtree is left out
+            _budget.nodes += 1
+            own = context_stats(memcxt)[0]
+            counters.add(own)
+            if Snapshot is not None:
+                Snapshot.append(memcxt.record(own))
+            if memcxt.firstchild:
+                _budget.cut += 1
+                counters.estimated = True
+        stats.append(counters)
+
+    k = len(stats)
+    scale = n / k
+    totals.nblocks = round(sum(c.nblocks for c in stats) * scale)
+    totals.freechunks = round(sum(c.freechunks for c in stats) * scale)
+    totals.totalspace = round(sum(c.totalspace for c in stats) * scale)
+    totals.freespace = round(sum(c.freespace for c in stats) * scale)
+    totals.estimated = n > k or any(c.estimated for c in stats)
+    # two-stage sampling: between the sampled subtrees, with the finite
+    # population correction, plus within them
+    between = 0.0
+    if k > 1:
+        between = n * n * (1 - k / n) * \
+            statistics.variance([c.totalspace for c in stats]) / k
+    totals.variance = between + scale * sum(c.variance for c in stats)
+    return n, k
+
+
 def MemoryContextStatsInternal(memcxt, level, begin_print, printit,
                                max_children, totals):
     local_totals = MemoryContextCounters()
+    if _budget is not None:
+        _budget.nodes += 1
 
     if not begin_print:
         begin_print = Args.cxtname == memcxt.name
         level = 0
 
     # Examine the context itself
-    fn_stats = MEMORY_CONTEXT_STATS_IMPL[memcxt.typcxt]
-    fn_print = MemoryContextStatsPrint if begin_print and printit else None
-    fn_stats(memcxt, fn_print, level, totals)
+    counters, stats_string = context_stats(memcxt)
+    if begin_print and printit:
+        if _report is None:
+            MemoryContextStatsPrint(memcxt, level, stats_string)
+        elif not filtered_out(memcxt.name):
+            _report.add(memcxt, counters)
+    totals.add(counters)
+    if Snapshot is not None:
+        Snapshot.append(memcxt.record(counters))
 
     ichild = 0
-    child = MemoryContext(memcxt.firstchild)
-    while child.is_not_null():
+    sampled_totals = None
+    complete = True
+    child_addr = memcxt.firstchild
+    while child_addr:
+        if _budget is not None and _budget.check():
+            sampled_totals = MemoryContextCounters()
+            nrest, nsampled = SampleSiblings(
+                child_addr, level + 1, begin_print, max_children,
+                sampled_totals)
+            complete = False
+            break
+        child = context_at(child_addr)
         if ichild < max_children:
-            MemoryContextStatsInternal(
+            complete = MemoryContextStatsInternal(
                 child, level + 1, begin_print,
-                printit, max_children, totals)
+                printit, max_children, totals) and complete
         else:
-            MemoryContextStatsInternal(
+            complete = MemoryContextStatsInternal(
                 child, level + 1, begin_print,
-                False, max_children, local_totals)
-        child = MemoryContext(child.nextchild)
+                False, max_children, local_totals) and complete
+        child_addr = child.nextchild
         ichild += 1
+    if complete and _model is not None:
+        _model.complete.add(memcxt.addr)
 
     if ichild > max_children:
-        if printit:
+        if printit and _report is None:
             for i in range(level + 1):
                 print("  ", end="")
             print("\
@@ -480,32 +1902,50 @@ def MemoryContextStatsInternal(memcxt, level, begin_print, printit,
                   ))
 
         if totals:
-            totals.nblocks += local_totals.nblocks
-            totals.freechunks += local_totals.freechunks
-            totals.totalspace += local_totals.totalspace
-            totals.freespace += local_totals.freespace
+            totals.add(local_totals)
+
+    if sampled_totals is not None:
+        if printit and _report is None:
+            for i in range(level + 1):
+                print("  ", end="")
+            print("\
+{} more child contexts containing {} total in {} blocks;  \
+{} free ({} chunks); {} used{}, from {} sampled"
+                  .format(
+                      nrest,
+                      sampled_totals.totalspace,
+                      sampled_totals.nblocks,
+                      sampled_totals.freespace,
+                      sampled_totals.freechunks,
+                      sampled_totals.totalspace - sampled_totals.freespace,
+                      sampled_totals.estimate_string(),
+                      nsampled
+                  ))
+        totals.add(sampled_totals)
+    return complete
+
+
+def filtered_out(name):
+    """
+    Whether -i or -x leave out the contexts called name
+    """
+    if Args.include and name not in Args.include:
+        return True
+    return bool(Args.exclude) and name in Args.exclude
 
 
 def MemoryContextStatsPrint(context: MemoryContext, passthru, stats_string):
+    with profile_phase("render"):
+        _print_context(context, passthru, stats_string)
+
+
+def _print_context(context: MemoryContext, passthru, stats_string):
     level = passthru
     name = context.name
     ident = context.ident
 
-    if Args.include:
-        if name not in Args.include:
-            return
-
-    if Args.exclude:
-        if name in Args.exclude:
-            return
-
-    def dprint(*args, **kwargs):
-        if Newdumpfile:
-            Newdumpfile.write(*args)
-            if kwargs.get("end", None) is None:
-                Newdumpfile.write("\n")
-        else:
-            print(*args, **kwargs)
+    if filtered_out(name):
+        return
 
     #
     # It seems preferable to label dynahash contexts with just the hash table
@@ -516,18 +1956,18 @@ def MemoryContextStatsPrint(context: MemoryContext, passthru, stats_string):
         name = ident
         ident = ""
 
-    addr = context._c_memcxt.GetValueAsUnsigned()
+    addr = context.addr
     if Args.with_addr:
         name = f"{addr:#x} {name}"
     for i in range(level):
-        dprint("  ", end="")
+        print("  ", end="")
     ident = f": {ident}" if len(ident) > 0 else ""
-    if context == GlobalMemoryContext.current:
+    if addr == current_memory_context():
         name = f"*{name}"
-    dprint(f"{name}: {stats_string}{ident}")
+    print(f"{name}: {stats_string}{ident}")
 
 
-def sbt(debugger, raw_args, result, internal_dict):
+def sbt(debugger, raw_args, exe_ctx, result, internal_dict):
     parser = argparse.ArgumentParser(description='Dump memory context stats')
     parser.add_argument('-N', '--overwrite', action='store_true',
                         help='overwrite the dump file')
@@ -538,9 +1978,22 @@ def sbt(debugger, raw_args, result, internal_dict):
     parser.add_argument('num_frames', metavar='num-frames',
                         nargs='?', type=int, default=0,
                         help='number of frames to dump')
+    parser.add_argument('--profile', action='store_true',
+                        help='report the time and debugger calls of '
+                             'unwinding and printing')
     args_list = shlex.split(raw_args)
     args = parser.parse_args(args_list)
+    target = exe_ctx.GetTarget()
+    if target.IsValid():
+        use_target(target)
+    start_profile(args.profile)
+    try:
+        _sbt(exe_ctx.GetFrame(), args)
+    finally:
+        end_profile()
 
+
+def _sbt(frame, args):
     out_mode = "a"
     if args.overwrite:
         out_mode = "w"
@@ -548,33 +2001,132 @@ def sbt(debugger, raw_args, result, internal_dict):
         sys.stdout = open(args.output, out_mode)
     num_frames_out = args.num_frames
 
-    routput = None
-    if args.output_reversly:
-        routput = []
+    names = []
+    with profile_phase("unwind"):
+        while frame.IsValid():
+            if _profile is not None:
+                _profile.count("GetFunctionName")
+                _profile.count("get_parent_frame")
+            names.append(frame.GetFunctionName())
+            frame = frame.get_parent_frame()
+            if len(names) == num_frames_out:
+                break
 
-    process = debugger.GetSelectedTarget().GetProcess()
-    frame = process.GetSelectedThread().GetSelectedFrame()
+    with profile_phase("render"):
+        if args.output_reversly:
+            names.reverse()
+        for name in names:
+            print(name)
+
+
+class AncestorFilter:
+    """
+    Decide whether a thread should stop by the functions on its stack: not
+    if any function of exclude is on it, and only if some function of
+    include is, when include is given.  At most depth frames are looked at,
+    0 meaning all of them.
+
+    The functions are resolved once to the address ranges of their code,
+    so each frame costs a bisect of its pc instead of a function name
+    lookup.  The ranges are resolved again when modules were loaded.
+    """
+
+    INCLUDE = 1
+    EXCLUDE = 2
+
+    def __init__(self, target: lldb.SBTarget, include, exclude, depth=0):
+        self.target = target
+        self.include = include or []
+        self.exclude = exclude or []
+        self.depth = depth
+        self._nmodules = -1
+        self._starts = []
+        self._ranges = []
+
+    def _function_ranges(self, name):
+        contexts = self.target.FindFunctions(name, lldb.eFunctionNameTypeFull)
+        for i in range(contexts.GetSize()):
+            sc = contexts.GetContextAtIndex(i)
+            func = sc.GetFunction()
+            if func.IsValid():
+                # a function may have cold parts apart from its entry
+                block = func.GetBlock()
+                for j in range(block.GetNumRanges()):
+                    yield (block.GetRangeStartAddress(j),
+                           block.GetRangeEndAddress(j))
+            elif sc.GetSymbol().IsValid():
+                yield (sc.GetSymbol().GetStartAddress(),
+                       sc.GetSymbol().GetEndAddress())
+
+    def _resolve(self):
+        ranges = []
+        for kind, names in ((self.INCLUDE, self.include),
+                            (self.EXCLUDE, self.exclude)):
+            for name in names:
+                for start, end in self._function_ranges(name):
+                    start = start.GetLoadAddress(self.target)
+                    end = end.GetLoadAddress(self.target)
+                    if start != lldb.LLDB_INVALID_ADDRESS and end > start:
+                        ranges.append((start, end, kind))
+        ranges.sort()
+        self._starts = [r[0] for r in ranges]
+        self._ranges = ranges
+        self._nmodules = self.target.GetNumModules()
+
+    def _kind(self, pc):
+        i = bisect.bisect_right(self._starts, pc) - 1
+        if i >= 0 and pc < self._ranges[i][1]:
+            return self._ranges[i][2]
+        return 0
+
+    def should_stop(self, thread: lldb.SBThread):
+        if self.target.GetNumModules() != self._nmodules:
+            self._resolve()
+        included = not self.include
+        i = 0
+        while self.depth == 0 or i < self.depth:
+            frame = thread.GetFrameAtIndex(i)
+            if not frame.IsValid():
+                break
+            # the pc of a caller is the return address, which may be past
+            # the end of the function when the call is its last instruction
+            pc = frame.GetPC() if i == 0 else frame.GetPC() - 1
+            kind = self._kind(pc)
+            if kind == self.EXCLUDE:
+                return False
+            if kind == self.INCLUDE:
+                included = True
+                if not self.exclude:
+                    break
+            i += 1
+        return included
 
-    i = 1
-    while frame.IsValid():
-        if routput is not None:
-            routput.append(frame.GetFunctionName())
-        else:
-            print(f"{frame.GetFunctionName()}")
-        frame = frame.get_parent_frame()
-        if i == num_frames_out:
-            break
-        i += 1
 
-    if routput is not None:
-        for i in range(len(routput) - 1, -1, -1):
-            print(routput[i])
+# AncestorFilter of each breakpoint set up by cc
+_ancestor_filters = {}
+
+
+def _breakpoint_commands(bp):
+    """
+    The commands of bp, a script callback being listed as the line that
+    calls it, empty if it has none
+    """
+    commands = lldb.SBStringList()
+    bp.GetCommandLineCommands(commands)
+    return [commands.GetStringAtIndex(i) for i in range(commands.GetSize())]
+
+
+def _ancestor_filter_hit(frame, bp_loc, internal_dict):
+    bp = bp_loc.GetBreakpoint()
+    f = _ancestor_filters.get((target_key(bp.GetTarget()), bp.GetID()))
+    return f is None or f.should_stop(frame.GetThread())
 
 
 class StopHookContIfHasNot:
     """
     StopHookIfHasNot is a stop hook that can be used to continue execution
-    if the current frame call stack has the given name.
+    if the current frame call stack has the given name.  It runs on every
+    stop of the target, `cc` filters just the hits of given breakpoints.
 
     (lldb) command script import pg_memcxt_stats.py
     (lldb) target stop-hook add -P pg_memcxt_stats.StopHookContIfHasNot -k fn -v foo
@@ -588,41 +2140,77 @@ class StopHookContIfHasNot:
         stream = lldb.SBStream()
         extra_args.GetAsJSON(stream)
         self.args = json.loads(stream.GetData())
+        self.filter = AncestorFilter(target, None, [self.args["fn"]])
 
     def handle_stop(self,
                     exe_ctx: lldb.SBExecutionContext,
                     stream: lldb.SBStream):
-        frame = exe_ctx.GetFrame()
-        should_stop = True
-        fname = self.args["fn"]
-        while frame.IsValid():
-            if frame.GetFunctionName() == fname:
-                should_stop = False
-                break
-            frame = frame.get_parent_frame()
-        return should_stop
+        return self.filter.should_stop(exe_ctx.GetThread())
 
 
-#
-# Too slow to use
-#
-def cc(debugger, raw_args, result, internal_dict):
+def cc(debugger, raw_args, exe_ctx, result, internal_dict):
     """
     cc is a command that can be used to continue execution if the current frame
-    call stack has the given name.
+    call stack has the given name.  The check runs as a callback of the
+    breakpoints, so breakpoints that have commands or a callback of their
+    own, or continue anyway, are left alone.
     """
-    if lldb_target.GetProcess().GetState() == lldb.eStateRunning:
-        print("Process is running.  Use 'process interrupt' to pause execution.")
-        return
-
-    parser = argparse.ArgumentParser(description='conditionally continue')
-    parser.add_argument('fn', metavar='<function name>',
+    parser = argparse.ArgumentParser(
+        prog='cc', description='conditionally continue')
+    parser.add_argument('fn', metavar='<function name>', nargs='*',
                         help='function name to continue execution')
+    parser.add_argument('-i', '--include', nargs='+', default=[],
+                        metavar='function',
+                        help='only stop if one of these is on the stack')
+    parser.add_argument('-x', '--exclude', nargs='+', default=[],
+                        metavar='function',
+                        help='continue if one of these is on the stack, '
+                             'same as <function name>')
+    parser.add_argument('-d', '--depth', type=int, default=0,
+                        help='only look at this many frames, default: all')
+    parser.add_argument('-b', '--breakpoint', type=int, nargs='+',
+                        metavar='id',
+                        help='breakpoints to filter, default: all')
+    parser.add_argument('-D', '--delete', action='store_true',
+                        help='remove the filter from the breakpoints')
     args_list = shlex.split(raw_args)
     args = parser.parse_args(args_list)
 
-    add_stop_hook = "target stop-hook add -P pg_memcxt_stats.StopHookContIfHasNot"
-    debugger.HandleCommand(f"{add_stop_hook} -k fn -v {args.fn}")
+    target = exe_ctx.GetTarget()
+    if args.breakpoint:
+        bps = [target.FindBreakpointByID(i) for i in args.breakpoint]
+    else:
+        bps = [target.GetBreakpointAtIndex(i)
+               for i in range(target.GetNumBreakpoints())]
+    bps = [bp for bp in bps if bp.IsValid()]
+
+    key = target_key(target)
+    if args.delete:
+        for bp in bps:
+            if _ancestor_filters.pop((key, bp.GetID()), None) is not None:
+                # a filtered breakpoint had no commands before
+                bp.SetCommandLineCommands(lldb.SBStringList())
+        return
+
+    exclude = args.fn + args.exclude
+    if not exclude and not args.include:
+        parser.error("no function given")
+    skipped = [bp for bp in bps
+               if (key, bp.GetID()) not in _ancestor_filters and
+               (bp.GetAutoContinue() or _breakpoint_commands(bp))]
+    bps = [bp for bp in bps if bp not in skipped]
+    if skipped:
+        print("not filtering breakpoints {}: they continue anyway or have "
+              "commands of their own, e.g. of trace_pg_mem".format(
+                  ", ".join(str(bp.GetID()) for bp in skipped)))
+    if not bps:
+        return
+    f = AncestorFilter(target, args.include, exclude, args.depth)
+    for bp in bps:
+        _ancestor_filters[(key, bp.GetID())] = f
+        bp.SetScriptCallbackFunction("pg_memcxt_stats._ancestor_filter_hit")
+    print("filtering breakpoints {}".format(
+        ", ".join(str(bp.GetID()) for bp in bps)))
 
 
 def __lldb_init_module(debugger, internal_dict):
@@ -0,0 +1,168 @@
+#
+# Memory census of many PostgreSQL backends: attach to each of them in a
+# pool of worker processes, walk the memory contexts and detach again.
+#
+#   $ python3 pgmem_census.py -P $(head -1 $PGDATA/postmaster.pid)
+#   $ python3 pgmem_census.py 12345 12346 12347
+#
+# The backends are ranked by the memory their contexts hold, the contexts
+# are summed up by name across backends, and with --baseline, a census.json
+# of an earlier run, the backends are also ranked by how much they grew.
+#
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+import pgmem_cores
+from pgmem_cores import init_worker, walk_process, merge_by_name, \
+    print_summary, print_by_name
+from pgmem_snapshot import write_snapshot
+
+
+def list_processes():
+    """
+    pid -> (ppid, start time, command) of all processes
+    """
+    out = subprocess.run(
+        ["ps", "-A", "-o", "pid=", "-o", "ppid=", "-o", "lstart=",
+         "-o", "command="],
+        capture_output=True, text=True, check=True).stdout
+    procs = {}
+    for line in out.splitlines():
+        fields = line.split(None, 7)
+        if len(fields) < 7:
+            continue
+        # lstart is always five words, e.g. "Sat Oct 17 10:00:00 2026"
+        procs[int(fields[0])] = (int(fields[1]), " ".join(fields[2:7]),
+                                 fields[7] if len(fields) > 7 else "")
+    return procs
+
+
+def census_backend(job):
+    pid, outdir, root, walk_args, ntop = job
+    import lldb
+
+    summary = {"pid": pid, "error": None}
+    debugger = pgmem_cores._debugger
+    target = debugger.CreateTarget("")
+    started = time.time()
+    process = None
+    try:
+        error = lldb.SBError()
+        process = target.AttachToProcessWithID(
+            debugger.GetListener(), pid, error)
+        if not error.Success() or not process.IsValid():
+            raise RuntimeError(f"cannot attach: {error.GetCString()}")
+        records, walked = walk_process(target, process, root, walk_args,
+                                       ntop)
+        summary.update(walked)
+    except Exception as e:
+        records = None
+        summary["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if process is not None and process.IsValid():
+            process.Detach()
+        summary["seconds"] = round(time.time() - started, 3)
+        debugger.DeleteTarget(target)
+    if records is not None and outdir:
+        summary["report"] = os.path.join(outdir, f"{pid}.pgmem.json")
+        write_snapshot(summary["report"], records, {"pid": pid, "root": root})
+    return summary
+
+
+def add_growth(summaries, baseline):
+    """
+    Set the growth of each backend since the baseline census, backends are
+    told apart from a reused pid by their start time
+    """
+    before = {(s["pid"], s.get("started")): s for s in baseline
+              if not s.get("error")}
+    for s in summaries:
+        if s["error"]:
+            continue
+        b = before.get((s["pid"], s.get("started")))
+        s["growth"] = s["totalspace"] - b["totalspace"] if b else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Dump memory context stats of many PostgreSQL backends')
+    parser.add_argument('pids', nargs='*', type=int, metavar='pid',
+                        help='backend pids')
+    parser.add_argument('-P', '--postmaster', type=int, metavar='pid',
+                        help='survey all children of this postmaster')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('-o', '--output', default='census.json',
+                        help='census file, default: census.json')
+    parser.add_argument('-d', '--outdir',
+                        help='also write a snapshot of each backend here')
+    parser.add_argument('-b', '--baseline', metavar='census.json',
+                        help='earlier census to rank backends by growth')
+    parser.add_argument('-r', '--root', default='TopMemoryContext',
+                        metavar='variable',
+                        help='global memory context to walk, '
+                             'default: TopMemoryContext')
+    parser.add_argument('-c', '--freelist-cap', type=int, default=10000,
+                        metavar='chunks',
+                        help='AllocSet freelist walk cap, default: 10000')
+    parser.add_argument('-B', '--budget-ms', type=float, default=250,
+                        metavar='ms',
+                        help='sample the contexts of a backend not walked '
+                             'after this long, 0 for no limit, default: 250')
+    parser.add_argument('-t', '--top', type=int, default=20,
+                        help='number of rows to rank, default: 20')
+    args = parser.parse_args(argv)
+
+    procs = list_processes()
+    pids = list(args.pids)
+    if args.postmaster:
+        pids += sorted(pid for pid, (ppid, _, _) in procs.items()
+                       if ppid == args.postmaster)
+    if not pids:
+        parser.error("no backend pids given")
+    if args.outdir:
+        os.makedirs(args.outdir, exist_ok=True)
+
+    walk_args = f"-c {args.freelist_cap} -B {args.budget_ms}"
+    jobs = [(pid, args.outdir, args.root, walk_args, args.top)
+            for pid in pids]
+
+    started = time.time()
+    summaries = []
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(min(args.jobs, len(jobs)), initializer=init_worker) as pool:
+        for s in pool.imap_unordered(census_backend, jobs):
+            _, s["started"], s["command"] = procs.get(s["pid"], (0, "", ""))
+            summaries.append(s)
+    elapsed = time.time() - started
+
+    by_name = merge_by_name(summaries, args.top)
+    if args.baseline:
+        with open(args.baseline) as f:
+            add_growth(summaries, json.load(f)["backends"])
+    summaries.sort(key=lambda s: s.get("totalspace", -1), reverse=True)
+    with open(args.output, "w") as f:
+        json.dump({"time": time.time(), "backends": summaries,
+                   "by_name": by_name}, f, indent=1)
+
+    print_summary(summaries[:args.top], "command", label=str.strip)
+    if args.baseline:
+        grown = sorted((s for s in summaries if s.get("growth") is not None),
+                       key=lambda s: s["growth"], reverse=True)
+        print(f"\n{'pid':>8} {'growth':>14} {'total':>14}  command")
+        for s in grown[:args.top]:
+            print(f"{s['pid']:>8} {s['growth']:>+14} {s['totalspace']:>14}  "
+                  f"{s['command']}")
+    print_by_name(by_name)
+    paused = sum(s["seconds"] for s in summaries)
+    print(f"\n{len(jobs)} backends in {elapsed:.1f}s, "
+          f"{paused / len(jobs):.3f}s attached per backend on average")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+#
+# Run the pgmem memory context walk over PostgreSQL core files, without an
+# interactive lldb session.
+#
+#   $ python3 pgmem_cores.py -b /usr/local/pgsql/bin/postgres core.*
+#
+# The cores are spread over a pool of worker processes, each with its own
+# lldb debugger.  Every core gets a snapshot report (see pgmem_snapshot.py)
+# in the output directory, and summary.json ranks the cores by the memory
+# their contexts hold and sums the contexts up by name across all cores.
+#
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+from pgmem_snapshot import write_snapshot, name_paths, totals_by_name
+
+
+def import_lldb():
+    """
+    Import the lldb module, asking `lldb -P` where it is if it is not on
+    sys.path already
+    """
+    try:
+        import lldb
+    except ImportError:
+        path = subprocess.run(["lldb", "-P"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+        sys.path.append(path)
+        import lldb
+    return lldb
+
+
+# the lldb debugger of a worker process
+_debugger = None
+
+
+def init_worker():
+    global _debugger
+    lldb = import_lldb()
+    _debugger = lldb.SBDebugger.Create(False)
+    _debugger.SetAsync(False)
+
+
+def summarize(records, totals, ntop):
+    """
+    The summary of one walk: grand totals, the largest contexts and the
+    per-name totals
+    """
+    paths = name_paths(records)
+    largest = sorted(records, key=lambda r: r.totalspace, reverse=True)
+    return {
+        "contexts": len(records),
+        "totalspace": totals.totalspace,
+        "freespace": totals.freespace,
+        "nblocks": totals.nblocks,
+        "freechunks": totals.freechunks,
+        "estimated": totals.estimated,
+        "largest": [[paths[r.addr], r.totalspace, r.freespace]
+                    for r in largest[:ntop]],
+        "by_name": totals_by_name(records),
+    }
+
+
+def walk_process(target, process, root, walk_args, ntop):
+    """
+    Walk the memory contexts below the global `root` of a stopped process
+    or a core.  Returns the ContextRecords and their summary.
+    """
+    import pg_memcxt_stats
+
+    pg_memcxt_stats.use_target(target)
+    root_addr = target.FindFirstGlobalVariable(root).GetValueAsUnsigned()
+    if root_addr == 0:
+        raise RuntimeError(f"{root} is NULL or not found")
+    records, totals = pg_memcxt_stats.collect_snapshot(root_addr, walk_args)
+    summary = summarize(records, totals, ntop)
+    summary["pid"] = process.GetProcessID()
+    return records, summary
+
+
+def analyze_core(job):
+    binary, core, outdir, root, walk_args, ntop = job
+    started = time.time()
+    summary = {"core": core, "error": None}
+    target = _debugger.CreateTarget(binary)
+    try:
+        if not target.IsValid():
+            raise RuntimeError(f"cannot load {binary}")
+        process = target.LoadCore(core)
+        if not process.IsValid():
+            raise RuntimeError(f"cannot load core {core}")
+        records, walked = walk_process(target, process, root, walk_args,
+                                       ntop)
+        summary.update(walked)
+        summary["report"] = os.path.join(
+            outdir, os.path.basename(core) + ".pgmem.json")
+        write_snapshot(summary["report"], records, {
+            "core": core, "binary": binary, "root": root,
+            "pid": summary["pid"],
+        })
+    except Exception as e:
+        summary["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        _debugger.DeleteTarget(target)
+    summary["seconds"] = round(time.time() - started, 3)
+    return summary
+
+
+def merge_by_name(summaries, ntop):
+    """
+    Per-name totals across summaries as rows of
+    [name, contexts, totalspace, freespace, number of summaries]
+    """
+    merged = {}
+    for s in summaries:
+        for name, (n, total, free) in s.pop("by_name", {}).items():
+            m = merged.setdefault(name, [name, 0, 0, 0, 0])
+            m[1] += n
+            m[2] += total
+            m[3] += free
+            m[4] += 1
+    rows = sorted(merged.values(), key=lambda m: m[2], reverse=True)
+    return rows[:ntop] if ntop else rows
+
+
+def print_summary(rows, key, label=os.path.basename):
+    print(f"{key:<32} {'pid':>8} {'contexts':>9} {'total':>14} "
+          f"{'used':>14} {'seconds':>8}")
+    for s in rows:
+        if s["error"]:
+            print(f"{label(str(s[key]))[:32]:<32} error: {s['error']}")
+            continue
+        print(f"{label(str(s[key]))[:32]:<32} {s['pid']:>8} "
+              f"{s['contexts']:>9} {s['totalspace']:>14} "
+              f"{s['totalspace'] - s['freespace']:>14} {s['seconds']:>8}"
+              + (" (estimated)" if s["estimated"] else ""))
+        if s["largest"]:
+            path, total, _ = s["largest"][0]
+            print(f"    largest: {path}: {total} total")
+
+
+def print_by_name(rows):
+    print(f"\n{'context':<40} {'count':>9} {'total':>14} {'used':>14}")
+    for name, n, total, free, _ in rows:
+        print(f"{name[:40]:<40} {n:>9} {total:>14} {total - free:>14}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Dump memory context stats of PostgreSQL core files')
+    parser.add_argument('cores', nargs='+', metavar='core',
+                        help='core files')
+    parser.add_argument('-b', '--binary', required=True,
+                        help='postgres binary the cores were dumped from')
+    parser.add_argument('-o', '--outdir', default='pgmem-reports',
+                        help='directory of the reports, '
+                             'default: pgmem-reports')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('-r', '--root', default='TopMemoryContext',
+                        metavar='variable',
+                        help='global memory context to walk, '
+                             'default: TopMemoryContext')
+    parser.add_argument('-c', '--freelist-cap', type=int, default=100000,
+                        metavar='chunks',
+                        help='AllocSet freelist walk cap, default: 100000')
+    parser.add_argument('-t', '--top', type=int, default=20,
+                        help='number of contexts to rank, default: 20')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    walk_args = f"-c {args.freelist_cap}"
+    jobs = [(args.binary, core, args.outdir, args.root, walk_args, args.top)
+            for core in args.cores]
+
+    started = time.time()
+    summaries = []
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(min(args.jobs, len(jobs)), initializer=init_worker) as pool:
+        for i, s in enumerate(pool.imap_unordered(analyze_core, jobs), 1):
+            status = s["error"] or f"{s.get('totalspace')} bytes"
+            print(f"[{i}/{len(jobs)}] {s['core']}: {status}",
+                  file=sys.stderr)
+            summaries.append(s)
+
+    by_name = merge_by_name(summaries, args.top)
+    summaries.sort(key=lambda s: s.get("totalspace", -1), reverse=True)
+    with open(os.path.join(args.outdir, "summary.json"), "w") as f:
+        json.dump({"binary": args.binary, "cores": summaries,
+                   "by_name": by_name}, f, indent=1)
+
+    print_summary(summaries, "core")
+    print_by_name(by_name)
+    print(f"\n{len(jobs)} cores in {time.time() - started:.1f}s, "
+          f"reports in {args.outdir}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#
+# Structured pgmem snapshots and the diff between two of them.
+#
+# A snapshot has one record per memory context: its address, the address
+# of its parent, name, ident, kind and counters.  The diff matches the
+# contexts of two snapshots by address, falling back to their name path
+# for contexts that were recreated at another address, and reports only
+# what changed, largest byte delta first.
+#
+# Nothing here needs lldb, so two saved snapshots can be compared offline:
+#
+#   $ python3 pgmem_snapshot.py old.json new.json
+#
+import sys
+import json
+import argparse
+import collections
+
+
+SNAPSHOT_VERSION = 1
+
+ContextRecord = collections.namedtuple("ContextRecord", [
+    "addr", "parent", "name", "ident", "kind",
+    "nblocks", "freechunks", "totalspace", "freespace",
+])
+
+ContextChange = collections.namedtuple("ContextChange", [
+    "status", "path", "old", "new", "delta",
+])
+
+
+def write_snapshot(path, records, meta=None):
+    with open(path, "w") as f:
+        json.dump({
+            "version": SNAPSHOT_VERSION,
+            "meta": meta or {},
+            "fields": ContextRecord._fields,
+            "contexts": [list(r) for r in records],
+        }, f, separators=(",", ":"))
+
+
+def read_snapshot(path):
+    with open(path) as f:
+        data = json.load(f)
+    assert data.get("version") == SNAPSHOT_VERSION, \
+        f"{path} is not a pgmem snapshot"
+    return [ContextRecord(*r) for r in data["contexts"]]
+
+
+def context_label(record):
+    if record.ident:
+        return f"{record.name}: {record.ident}"
+    return record.name
+
+
+def group_name(record):
+    # dynahash contexts go by their hash table name, as pgmem prints them
+    if record.name == "dynahash" and record.ident:
+        return record.ident
+    return record.name
+
+
+def totals_by_name(records, totals=None):
+    """
+    Add the counters of records up per context name into totals, a dict
+    of name -> [contexts, totalspace, freespace], and return it.
+    """
+    if totals is None:
+        totals = {}
+    for r in records:
+        name = group_name(r)
+        t = totals.get(name)
+        if t is None:
+            totals[name] = [1, r.totalspace, r.freespace]
+        else:
+            t[0] += 1
+            t[1] += r.totalspace
+            t[2] += r.freespace
+    return totals
+
+
+def name_paths(records):
+    """
+    Map each record's address to its name path from the root of the
+    snapshot.  Siblings with the same label get an occurrence number so
+    every path is unique.
+    """
+    paths = {}
+    seen = collections.Counter()
+    for r in records:
+        path = context_label(r)
+        parent = paths.get(r.parent)
+        if parent is not None:
+            path = f"{parent}/{path}"
+        seen[path] += 1
+        if seen[path] > 1:
+            path = f"{path}#{seen[path]}"
+        paths[r.addr] = path
+    return paths
+
+
+def _same_context(old, new):
+    return old.kind == new.kind and old.name == new.name
+
+
+def diff_snapshots(old, new):
+    """
+    Contexts that grew, shrank, appeared or disappeared between two
+    snapshots, sorted by the absolute change of totalspace, or of the used
+    bytes for contexts whose totalspace did not change.
+    """
+    old_paths = name_paths(old)
+    new_paths = name_paths(new)
+    old_by_addr = {r.addr: r for r in old}
+    old_by_path = {old_paths[r.addr]: r for r in old}
+
+    matched = set()
+    pairs = []
+    unmatched = []
+    for r in new:
+        o = old_by_addr.get(r.addr)
+        if o is None or not _same_context(o, r):
+            unmatched.append(r)
+            continue
+        matched.add(o.addr)
+        pairs.append((o, r))
+
+    # contexts recreated at another address, e.g. after a reset of a parent
+    for r in unmatched:
+        o = old_by_path.get(new_paths[r.addr])
+        if o is not None and o.addr not in matched:
+            matched.add(o.addr)
+            pairs.append((o, r))
+        else:
+            pairs.append((None, r))
+
+    changes = []
+    for o, r in pairs:
+        if o is None:
+            changes.append(ContextChange(
+                "appeared", new_paths[r.addr], None, r, r.totalspace))
+        elif o.totalspace != r.totalspace or o.freespace != r.freespace:
+            delta = r.totalspace - o.totalspace
+            if delta == 0:
+                # same footprint, compare what is in use
+                delta = o.freespace - r.freespace
+            status = "grew" if delta > 0 else "shrank"
+            changes.append(ContextChange(
+                status, new_paths[r.addr], o, r, delta))
+    for o in old:
+        if o.addr not in matched:
+            changes.append(ContextChange(
+                "disappeared", old_paths[o.addr], o, None, -o.totalspace))
+
+    changes.sort(key=lambda c: abs(c.delta), reverse=True)
+    return changes
+
+
+def format_diff(changes, with_addr=False, limit=0):
+    lines = []
+    counts = collections.Counter(c.status for c in changes)
+    lines.append(
+        "{} grew, {} shrank, {} appeared, {} disappeared; {:+d} bytes"
+        .format(counts["grew"], counts["shrank"], counts["appeared"],
+                counts["disappeared"], sum(c.delta for c in changes)))
+    for c in changes[:limit] if limit else changes:
+        old = c.old.totalspace if c.old else 0
+        new = c.new.totalspace if c.new else 0
+        path = c.path
+        if with_addr:
+            path = f"{(c.new or c.old).addr:#x} {path}"
+        lines.append(f"{c.delta:+12d} {c.status:<11} {path}: "
+                     f"{old} -> {new} total")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Diff two pgmem snapshots')
+    parser.add_argument('old', help='older snapshot')
+    parser.add_argument('new', help='newer snapshot')
+    parser.add_argument('-r', '--with-addr', action='store_true',
+                        help='show memory context address')
+    parser.add_argument('-l', '--limit', type=int, default=0,
+                        help='only show the largest N changes')
+    args = parser.parse_args(argv)
+
+    changes = diff_snapshots(read_snapshot(args.old), read_snapshot(args.new))
+    for line in format_diff(changes, args.with_addr, args.limit):
+        print(line)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
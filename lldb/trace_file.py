@@ -0,0 +1,238 @@
+#
+# Binary trace of the breakpoint hits recorded by trace_pg_mem.py, and the
+# offline step that symbolizes it back into the text of `bt`.
+#
+# A trace starts with MAGIC and is a sequence of chunks, each a type byte
+# and a 32 bit length followed by the payload:
+#
+#   M  JSON list of the loaded modules with their path, build-id, load
+#      address and size, written first and again whenever modules were
+#      loaded
+#   H  hit records, each a HIT header followed by nframes raw PCs
+#
+# Recording a hit packs it into a preallocated buffer that is written out in
+# large chunks.  Function names, files and lines are looked up afterwards,
+# once per distinct PC, in a target created from the recorded modules:
+#
+#   $ python3 trace_file.py trace_pg_mem.bin -o trace_pg_mem.txt
+#
+import os
+import sys
+import json
+import time
+import bisect
+import struct
+import argparse
+
+
+MAGIC = b"PGMTRACE1\n"
+CHUNK = struct.Struct("<cI")
+# time in ns, thread id, thread index, breakpoint id, location id, nframes
+HIT = struct.Struct("<QQIIIH")
+
+_pc_structs = {}
+
+
+def _pcs(n):
+    s = _pc_structs.get(n)
+    if s is None:
+        s = _pc_structs[n] = struct.Struct(f"<{n}Q")
+    return s
+
+
+class TraceWriter:
+    """
+    Buffer hit records and write them to path in chunks of buffer_size
+    bytes.  modules is called before each chunk is written and returns the
+    loaded modules, which are written as well if they changed.
+    """
+
+    def __init__(self, path, modules, buffer_size=1 << 20):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.modules = modules
+        self._modules = None
+        self.buffer = bytearray(buffer_size)
+        self.used = 0
+        self.nhits = 0
+
+    def hit(self, tid, index, bp_id, loc_id, pcs):
+        size = HIT.size + 8 * len(pcs)
+        if self.used + size > len(self.buffer):
+            self.flush()
+            if size > len(self.buffer):
+                # larger than the whole buffer, written as a chunk of its own
+                self._chunk(b"H", HIT.pack(time.monotonic_ns(), tid, index,
+                                           bp_id, loc_id, len(pcs)) +
+                            _pcs(len(pcs)).pack(*pcs))
+                self.nhits += 1
+                return
+        HIT.pack_into(self.buffer, self.used, time.monotonic_ns(), tid,
+                      index, bp_id, loc_id, len(pcs))
+        _pcs(len(pcs)).pack_into(self.buffer, self.used + HIT.size, *pcs)
+        self.used += size
+        self.nhits += 1
+
+    def _chunk(self, kind, payload):
+        self.file.write(CHUNK.pack(kind, len(payload)))
+        self.file.write(payload)
+
+    def flush(self):
+        modules = self.modules()
+        if modules != self._modules:
+            self._modules = modules
+            self._chunk(b"M", json.dumps(modules).encode())
+        if self.used:
+            self._chunk(b"H", memoryview(self.buffer)[:self.used])
+            self.used = 0
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_trace(path):
+    """
+    Yield ("modules", list) and ("hit", (time, tid, index, bp_id, loc_id,
+    pcs)) events of a trace in the order they were recorded
+    """
+    with open(path, "rb") as f:
+        assert f.read(len(MAGIC)) == MAGIC, f"{path} is not a trace"
+        while True:
+            header = f.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return
+            kind, size = CHUNK.unpack(header)
+            payload = f.read(size)
+            if kind == b"M":
+                yield "modules", json.loads(payload)
+                continue
+            offset = 0
+            while offset < size:
+                hit = HIT.unpack_from(payload, offset)
+                offset += HIT.size
+                pcs = _pcs(hit[5]).unpack_from(payload, offset)
+                offset += 8 * hit[5]
+                yield "hit", hit[:5] + (pcs,)
+
+
+class Symbolizer:
+    """
+    Turn PCs of the recorded process into `bt` frame descriptions, using
+    the binaries of the recorded modules at their link-time addresses
+    """
+
+    def __init__(self, lldb):
+        self.lldb = lldb
+        self.debugger = lldb.SBDebugger.Create(False)
+        self.target = self.debugger.CreateTarget("")
+        self._loads = []
+        self._modules = []
+        self._sbmodules = {}
+        self._frames = {}
+        self.npcs = 0
+
+    def set_modules(self, modules):
+        modules = sorted(modules, key=lambda m: m["load"])
+        self._loads = [m["load"] for m in modules]
+        self._modules = modules
+        self._frames.clear()
+
+    def _sbmodule(self, module):
+        key = (module["path"], module["uuid"])
+        sbmodule = self._sbmodules.get(key)
+        if sbmodule is None:
+            sbmodule = self.target.AddModule(module["path"], None,
+                                             module["uuid"] or None)
+            self._sbmodules[key] = sbmodule
+        return sbmodule
+
+    def describe(self, pc, caller=False):
+        """
+        "0x... postgres`palloc + 20 at mcxt.c:1300:9" as in `bt`.  The pc
+        of a caller is a return address, which may already belong to the
+        next line or function, so like `bt` the instruction before it is
+        looked up.
+        """
+        text = self._frames.get((pc, caller))
+        if text is not None:
+            return text
+        text = f"{pc:#018x}"
+        i = bisect.bisect_right(self._loads, pc) - 1
+        if i >= 0 and pc < self._loads[i] + self._modules[i]["size"]:
+            module = self._modules[i]
+            sbmodule = self._sbmodule(module)
+            if sbmodule.IsValid():
+                text += " " + self._symbolize(sbmodule, pc - module["load"],
+                                              caller)
+        self._frames[(pc, caller)] = text
+        self.npcs += 1
+        return text
+
+    def _symbolize(self, sbmodule, offset, caller):
+        lldb = self.lldb
+        file_addr = sbmodule.GetObjectFileHeaderAddress().GetFileAddress()
+        addr = sbmodule.ResolveFileAddress(
+            file_addr + offset - 1 if caller else file_addr + offset)
+        sc = sbmodule.ResolveSymbolContextForAddress(
+            addr, lldb.eSymbolContextEverything)
+        text = sbmodule.GetFileSpec().GetFilename() + "`"
+        if sc.GetFunction().IsValid():
+            func = sc.GetFunction()
+            text += func.GetName()
+            start = func.GetStartAddress()
+        elif sc.GetSymbol().IsValid():
+            text += sc.GetSymbol().GetName()
+            start = sc.GetSymbol().GetStartAddress()
+        else:
+            return text + f"{offset:#x}"
+        delta = file_addr + offset - start.GetFileAddress()
+        if delta:
+            text += f" + {delta}"
+        line = sc.GetLineEntry()
+        if line.IsValid():
+            text += " at {}:{}".format(line.GetFileSpec().GetFilename(),
+                                       line.GetLine())
+            if line.GetColumn():
+                text += f":{line.GetColumn()}"
+        return text
+
+
+def symbolize(lldb, path, out):
+    symbolizer = Symbolizer(lldb)
+    nhits = 0
+    for kind, event in read_trace(path):
+        if kind == "modules":
+            symbolizer.set_modules(event)
+            continue
+        _, tid, index, bp_id, loc_id, pcs = event
+        out.write(f"* thread #{index}, tid = {tid:#x}, "
+                  f"stop reason = breakpoint {bp_id}.{loc_id}\n")
+        for i, pc in enumerate(pcs):
+            mark = "*" if i == 0 else " "
+            out.write(f"  {mark} frame #{i}: "
+                      f"{symbolizer.describe(pc, i > 0)}\n")
+        nhits += 1
+    return nhits, symbolizer.npcs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Symbolize a trace recorded by trace_record')
+    parser.add_argument('trace', help='binary trace file')
+    parser.add_argument('-o', '--output',
+                        help='text file, default: the trace with .txt')
+    args = parser.parse_args(argv)
+
+    from pgmem_cores import import_lldb
+    lldb = import_lldb()
+    output = args.output or os.path.splitext(args.trace)[0] + ".txt"
+    with open(output, "w") as out:
+        nhits, npcs = symbolize(lldb, args.trace, out)
+    print(f"{nhits} hits, {npcs} distinct PCs symbolized to {output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
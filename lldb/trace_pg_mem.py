@@ -1,5 +1,15 @@
 import lldb
 import re
+import atexit
+import hashlib
+import argparse
+import shlex
+import struct
+import collections
+
+from trace_file import TraceWriter
+from type_layout import TypeLayoutCache, module_build_id, cache_path, \
+    load_cache, save_cache
 
 g_bin_name = "postgres"
 
@@ -12,32 +22,55 @@ g_bin_name = "postgres"
 # `MemoryContextCheck` or `MemoryContextSwitchTo`
 br_regexes = [r'\bMemoryContext(?!Check|SwitchTo)\w+']
 
-br_exprs = [
-    "mcxt_methods[3].alloc",
-    "mcxt_methods[3].free_p",
-    "mcxt_methods[3].realloc",
-    "mcxt_methods[3].reset",
-    "mcxt_methods[3].delete_context",
-    "mcxt_methods[3].get_chunk_context",
-    "mcxt_methods[3].get_chunk_space",
-    "mcxt_methods[3].is_empty",
-    "mcxt_methods[4].alloc",
-    "mcxt_methods[4].free_p",
-    "mcxt_methods[4].realloc",
-    "mcxt_methods[4].reset",
-    "mcxt_methods[4].delete_context",
-    "mcxt_methods[4].get_chunk_context",
-    "mcxt_methods[4].get_chunk_space",
-    "mcxt_methods[4].is_empty",
-    "mcxt_methods[5].alloc",
-    "mcxt_methods[5].free_p",
-    "mcxt_methods[5].realloc",
-    "mcxt_methods[5].reset",
-    "mcxt_methods[5].delete_context",
-    "mcxt_methods[5].get_chunk_context",
-    "mcxt_methods[5].get_chunk_space",
-    "mcxt_methods[5].is_empty",
-]
+# the methods of the memory context kinds, indexed by MemoryContextMethodID
+mcxt_methods_var = "mcxt_methods"
+
+
+# build-id -> [(name, offset)] of the symbols of a module
+_symbol_index = {}
+
+
+def _module_symbols(module, key):
+    symbols = _symbol_index.get(key)
+    if symbols is None:
+        base = module.GetObjectFileHeaderAddress().GetFileAddress()
+        symbols = []
+        for symbol in module:
+            name = symbol.GetName()
+            start = symbol.GetStartAddress()
+            if name and start.IsValid():
+                symbols.append((name, start.GetFileAddress() - base))
+        _symbol_index[key] = symbols
+    return symbols
+
+
+def find_symbol_offsets(module, regexes):
+    """
+    Offsets from the start of module of the symbols whose name matches one
+    of regexes.  They are saved keyed by the build-id of the module and the
+    patterns, and being module relative they hold wherever the module is
+    loaded.
+    """
+    build_id = module_build_id(module)
+    digest = hashlib.sha1("\n".join(regexes).encode()).hexdigest()[:16]
+    path = cache_path(f"symbols-{digest}", build_id)
+    cached = load_cache(path)
+    if cached is not None and cached.get("patterns") == regexes:
+        return cached["offsets"]
+
+    matcher = re.compile("|".join(f"(?:{regex})" for regex in regexes))
+    key = build_id or module.GetFileSpec().fullpath
+    offsets = []
+    seen = set()
+    for name, offset in _module_symbols(module, key):
+        if offset not in seen and matcher.search(name):
+            seen.add(offset)
+            offsets.append(offset)
+    try:
+        save_cache(path, {"patterns": regexes, "offsets": offsets})
+    except OSError:
+        pass
+    return offsets
 
 
 class BreakpointResolver:
@@ -46,18 +79,14 @@ class BreakpointResolver:
         _configure_breakpoint(bkpt)
 
     def __callback__(self, sym_ctx):
+        # lldb builds the resolver before giving the breakpoint its ID
+        _breakpoint_ids.add(self.bkpt.GetID())
         module = sym_ctx.GetModule()
         filename = module.GetFileSpec().GetFilename()
         if filename == g_bin_name:
-            br_symbols = []
-            for symbol in module:
-                name = symbol.GetName()
-                for regex in br_regexes:
-                    if re.search(regex, name):
-                        br_symbols.append(symbol.GetStartAddress())
-                        break
-            for symaddr in br_symbols:
-                self.bkpt.AddLocation(symaddr)
+            base = module.GetObjectFileHeaderAddress().GetFileAddress()
+            for offset in find_symbol_offsets(module, br_regexes):
+                self.bkpt.AddLocation(module.ResolveFileAddress(base + offset))
 
     def __get_depth__(self):
         return lldb.eSearchDepthModule
@@ -67,20 +96,40 @@ def trace_custom_api(debugger, command, result, internal_dict):
     debugger.HandleCommand("breakpoint set -P trace_pg_mem.BreakpointResolver")
 
 
+# called with the frame and SBBreakpointLocation of each hit instead of
+# running dump_bt, see trace_record
+_hit_handler = None
+# breakpoints set up by _configure_breakpoint
+_breakpoint_ids = set()
+
+
 def _configure_breakpoint(bp):
     bp.SetAutoContinue(True)
+    if bp.GetID() != lldb.LLDB_INVALID_BREAK_ID:
+        _breakpoint_ids.add(bp.GetID())
     commands = lldb.SBStringList()
-    commands.AppendString("dump_bt")
-    bp.SetCommandLineCommands(commands)
+    if _hit_handler is not None:
+        bp.SetCommandLineCommands(commands)
+        bp.SetScriptCallbackFunction("trace_pg_mem._on_hit")
+    else:
+        commands.AppendString("dump_bt")
+        bp.SetCommandLineCommands(commands)
 
 
-def _get_expression_address(frame, expression):
-    result = frame.EvaluateExpression(expression)
-    if result.GetError().Success():
-        return result.GetValueAsUnsigned()
-    else:
-        print(f"Failed to evaluate '{expression}': {result.GetError()}")
-        return None
+def _reconfigure_breakpoints(target):
+    for bp_id in list(_breakpoint_ids):
+        bp = target.FindBreakpointByID(bp_id)
+        if bp.IsValid():
+            _configure_breakpoint(bp)
+        else:
+            _breakpoint_ids.discard(bp_id)
+
+
+def _on_hit(frame, bp_loc, internal_dict):
+    if _hit_handler is not None:
+        _hit_handler(frame, bp_loc)
+    # keep the target running
+    return False
 
 
 def _breakpoint_set_by_regex(target, regexes):
@@ -95,15 +144,51 @@ def _breakpoint_set_by_address(target, addresses):
         _configure_breakpoint(bp)
 
 
-def _breakpoint_set_by_expr(target, exprs):
-    process = target.GetProcess()
-    frame = process.GetSelectedThread().GetSelectedFrame()
-    addrs = []
-    for expr in exprs:
-        addr = _get_expression_address(frame, expr)
-        if addr is not None:
-            addrs.append(addr)
-    _breakpoint_set_by_address(target, addrs)
+def mcxt_method_addresses(target):
+    """
+    [(name, address)] of the distinct functions in the mcxt_methods array,
+    named by MemoryContextMethodID and member, e.g. "MCTX_ASET_ID.alloc".
+    The array is read in one go through the target, so this works on a
+    stopped process or a core without a frame.  Reserved and unused IDs
+    and NULL members are skipped.
+    """
+    var = target.FindFirstGlobalVariable(mcxt_methods_var)
+    if not var.IsValid():
+        print(f"{mcxt_methods_var} not found")
+        return []
+    typ = var.GetType().GetCanonicalType()
+    elem = typ.GetArrayElementType().GetCanonicalType()
+    error = lldb.SBError()
+    data = target.ReadMemory(var.GetAddress(), typ.GetByteSize(), error)
+    if not error.Success():
+        print(f"cannot read {mcxt_methods_var}: {error.GetCString()}")
+        return []
+
+    ids = {}
+    members = target.FindFirstType("MemoryContextMethodID").GetEnumMembers()
+    for i in range(members.GetSize()):
+        member = members.GetTypeEnumMemberAtIndex(i)
+        ids[member.GetValueAsUnsigned()] = member.GetName()
+    fields = [(elem.GetFieldAtIndex(i).GetName(),
+               elem.GetFieldAtIndex(i).GetOffsetInBytes())
+              for i in range(elem.GetNumberOfFields())]
+    big = target.GetByteOrder() == lldb.eByteOrderBig
+    pointer = struct.Struct((">" if big else "<") +
+                            ("Q" if target.GetAddressByteSize() == 8 else "I"))
+
+    methods = []
+    seen = set()
+    size = elem.GetByteSize()
+    for i in range(typ.GetByteSize() // size):
+        kind = ids.get(i, str(i))
+        if "RESERVED" in kind or "UNUSED" in kind:
+            continue
+        for name, offset in fields:
+            addr = pointer.unpack_from(data, i * size + offset)[0]
+            if addr and addr not in seen:
+                seen.add(addr)
+                methods.append((f"{kind}.{name}", addr))
+    return methods
 
 
 def dump_bt(debugger, command, result, internal_dict):
@@ -114,6 +199,457 @@ def dump_bt(debugger, command, result, internal_dict):
     debugger.HandleCommand(command)
 
 
+def _loaded_modules(target):
+    modules = []
+    for module in target.module_iter():
+        load = module.GetObjectFileHeaderAddress().GetLoadAddress(target)
+        if load == lldb.LLDB_INVALID_ADDRESS:
+            continue
+        end = load
+        for section in module.section_iter():
+            addr = section.GetLoadAddress(target)
+            if addr != lldb.LLDB_INVALID_ADDRESS:
+                end = max(end, addr + section.GetByteSize())
+        modules.append({"path": module.GetFileSpec().fullpath,
+                        "uuid": module.GetUUIDString(), "load": load,
+                        "size": end - load})
+    return modules
+
+
+def _frame_pcs(thread, depth):
+    pcs = []
+    for i in range(depth):
+        frame = thread.GetFrameAtIndex(i)
+        if not frame.IsValid():
+            break
+        pcs.append(frame.GetPC())
+    return pcs
+
+
+class TraceRecorder:
+    """
+    Record the thread, a timestamp and the raw PCs of at most depth frames
+    per hit into a binary trace, see trace_file.py.  Nothing is symbolized
+    while the target runs.
+    """
+
+    def __init__(self, target, path, depth, buffer_size):
+        self.depth = depth
+        self.writer = TraceWriter(path, lambda: _loaded_modules(target),
+                                  buffer_size)
+
+    def __call__(self, frame, bp_loc):
+        thread = frame.GetThread()
+        self.writer.hit(thread.GetThreadID(), thread.GetIndexID(),
+                        bp_loc.GetBreakpoint().GetID(), bp_loc.GetID(),
+                        _frame_pcs(thread, self.depth))
+
+    def close(self):
+        self.writer.close()
+        return f"{self.writer.nhits} hits recorded to {self.writer.path}"
+
+
+def _function_names(target, pc, caller):
+    """
+    Names of the function at pc, the innermost inlined function first.  The
+    pc of a caller is a return address, which may already belong to the
+    next line or function, so the instruction before it is looked up.
+    """
+    addr = target.ResolveLoadAddress(pc - 1 if caller else pc)
+    sc = target.ResolveSymbolContextForAddress(
+        addr, lldb.eSymbolContextFunction | lldb.eSymbolContextBlock |
+        lldb.eSymbolContextSymbol)
+    names = []
+    block = sc.GetBlock()
+    if block.IsValid():
+        block = block.GetContainingInlinedBlock()
+    while block.IsValid():
+        names.append(block.GetInlinedName())
+        block = block.GetParent().GetContainingInlinedBlock()
+    if sc.GetFunction().IsValid():
+        names.append(sc.GetFunction().GetName())
+    elif sc.GetSymbol().IsValid():
+        names.append(sc.GetSymbol().GetName())
+    else:
+        names.append(f"{pc:#x}")
+    return names
+
+
+class StackAggregator:
+    """
+    Count the distinct call stacks of the hits, one dict increment per hit,
+    and write them in the collapsed format of flamegraph.pl when closed.
+
+    Inlined frames share the pc of the frame they are inlined into, so the
+    stacks are counted without repeated pcs, and each pc is expanded into
+    its inlined functions when the stacks are symbolized at the end.
+    """
+
+    def __init__(self, target, path, depth):
+        self.target = target
+        self.path = path
+        self.depth = depth
+        self.stacks = {}
+
+    def __call__(self, frame, bp_loc):
+        stack = []
+        last = None
+        for pc in _frame_pcs(frame.GetThread(), self.depth):
+            if pc != last:
+                stack.append(pc)
+                last = pc
+        stack = tuple(stack)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def folded(self):
+        """
+        (count, "outermost;...;innermost") of each stack, most hits first
+        """
+        names = {}
+        lines = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = []
+            for i, pc in enumerate(stack):
+                key = (pc, i > 0)
+                if key not in names:
+                    names[key] = _function_names(self.target, pc, i > 0)
+                frames.extend(names[key])
+            lines[";".join(reversed(frames))] += count
+        return [(count, line) for line, count in lines.most_common()]
+
+    def close(self):
+        folded = self.folded()
+        with open(self.path, "w") as f:
+            for count, line in folded:
+                f.write(f"{line} {count}\n")
+        nhits = sum(count for count, _ in folded)
+        return f"{nhits} hits in {len(folded)} stacks written to {self.path}"
+
+
+def _stop_hit_handler():
+    global _hit_handler
+    if _hit_handler is not None:
+        print(_hit_handler.close())
+        _hit_handler = None
+
+
+def _start_hit_handler(target, handler):
+    global _hit_handler
+    _stop_hit_handler()
+    _hit_handler = handler
+    _reconfigure_breakpoints(target)
+
+
+def trace_record(debugger, command, result, internal_dict):
+    parser = argparse.ArgumentParser(
+        prog="trace_record",
+        description='Record breakpoint hits into a binary trace instead of '
+                    'running dump_bt, `trace_record stop` ends it')
+    parser.add_argument('action', nargs='?', choices=['start', 'stop'],
+                        default='start')
+    parser.add_argument('-o', '--output', default='trace_pg_mem.bin',
+                        help='trace file, default: trace_pg_mem.bin')
+    parser.add_argument('-d', '--depth', type=int, default=64,
+                        help='max number of frames per hit, default: 64')
+    parser.add_argument('-b', '--buffer-kb', type=int, default=1024,
+                        help='size of the chunks written, default: 1024')
+    args = parser.parse_args(shlex.split(command))
+
+    target = debugger.GetSelectedTarget()
+    if args.action == 'stop':
+        _stop_hit_handler()
+        _reconfigure_breakpoints(target)
+        return
+    _start_hit_handler(target, TraceRecorder(
+        target, args.output, args.depth, args.buffer_kb * 1024))
+    print(f"recording to {args.output}, symbolize it with "
+          f"`python3 trace_file.py {args.output}`")
+
+
+def trace_stacks(debugger, command, result, internal_dict):
+    parser = argparse.ArgumentParser(
+        prog="trace_stacks",
+        description='Count the distinct call stacks of the breakpoint hits '
+                    'instead of running dump_bt, `trace_stacks stop` writes '
+                    'them in the folded format of flamegraph.pl')
+    parser.add_argument('action', nargs='?', choices=['start', 'stop'],
+                        default='start')
+    parser.add_argument('-o', '--output', default='trace_pg_mem.folded',
+                        help='folded stacks file, '
+                             'default: trace_pg_mem.folded')
+    parser.add_argument('-d', '--depth', type=int, default=64,
+                        help='max number of frames per hit, default: 64')
+    args = parser.parse_args(shlex.split(command))
+
+    target = debugger.GetSelectedTarget()
+    if args.action == 'stop':
+        _stop_hit_handler()
+        _reconfigure_breakpoints(target)
+        return
+    _start_hit_handler(target, StackAggregator(
+        target, args.output, args.depth))
+    print(f"counting stacks, `trace_stacks stop` writes {args.output}")
+
+
+@atexit.register
+def _close_hit_handler():
+    if _hit_handler is not None:
+        _hit_handler.close()
+
+
+# registers of the first two arguments and of the return value of a call
+CALL_REGISTERS = {
+    "x86_64": (("rdi", "rsi"), "rax"),
+    "aarch64": (("x0", "x1"), "x0"),
+    "arm64": (("x0", "x1"), "x0"),
+}
+
+# a live chunk is kept as size << STACK_BITS | stack id
+STACK_BITS = 32
+
+
+def _context_name(target, layouts, context):
+    process = target.GetProcess()
+    error = lldb.SBError()
+    name = process.ReadPointerFromMemory(
+        context + layouts.offsetof("MemoryContextData", "name"), error)
+    if error.Success() and name:
+        name = process.ReadCStringFromMemory(name, 256, error)
+        if error.Success():
+            return name
+    return f"{context:#x}"
+
+
+class AllocationTracker:
+    """
+    Track the chunks allocated through the mcxt_methods of all context
+    kinds while the target runs, and report the ones still alive grouped
+    by call stack and by context.
+
+    The entry of alloc and realloc records the context, size and the id of
+    the calling stack per thread, and a breakpoint on the return address,
+    set once per call site, picks up the chunk from the return value.
+    free_p forgets a chunk, reset and delete_context all chunks of the
+    context.  A realloc of a chunk allocated before tracking started is
+    only tracked if the alloc it makes for the new chunk was.  Live chunks are kept in a dict per context with the size and
+    stack id packed into one int, and a dict from chunk to context.
+    """
+
+    TRACKED = ("alloc", "free_p", "realloc", "reset", "delete_context")
+
+    def __init__(self, target, depth, report_on_reset, top):
+        arch = target.GetTriple().split("-")[0]
+        assert arch in CALL_REGISTERS, f"{arch} is not supported"
+        self.args, self.retval = CALL_REGISTERS[arch]
+        self.target = target
+        self.layouts = TypeLayoutCache(target)
+        self.depth = max(depth, 1)
+        self.report_on_reset = report_on_reset
+        self.top = top
+        # context -> {chunk: size << STACK_BITS | stack id}
+        self.by_context = {}
+        # chunk -> context
+        self.owner = {}
+        # callers' pcs -> stack id, and back
+        self.stacks = {}
+        self.stack_pcs = []
+        # thread id -> [(return address, context, size, stack id)]
+        self.pending = {}
+        # breakpoint id -> tracked method
+        self.methods = {}
+        # return address -> breakpoint id
+        self.returns = {}
+
+    def start(self):
+        for name, addr in mcxt_method_addresses(self.target):
+            method = name.split(".")[1]
+            if method not in self.TRACKED:
+                continue
+            bp = self.target.BreakpointCreateByAddress(addr)
+            bp.SetScriptCallbackFunction("trace_pg_mem._on_track_entry")
+            self.methods[bp.GetID()] = method
+
+    def stop(self):
+        for bp_id in list(self.methods) + list(self.returns.values()):
+            self.target.BreakpointDelete(bp_id)
+        self.methods.clear()
+        self.returns.clear()
+        self.pending.clear()
+
+    def _stack_id(self, pcs):
+        pcs = tuple(pcs)
+        stack = self.stacks.get(pcs)
+        if stack is None:
+            stack = self.stacks[pcs] = len(self.stack_pcs)
+            self.stack_pcs.append(pcs)
+        return stack
+
+    def _remember(self, chunk, context, size, stack):
+        self._forget(chunk)
+        self.owner[chunk] = context
+        chunks = self.by_context.get(context)
+        if chunks is None:
+            chunks = self.by_context[context] = {}
+        chunks[chunk] = size << STACK_BITS | stack
+
+    def _forget(self, chunk):
+        context = self.owner.pop(chunk, None)
+        if context is not None:
+            chunks = self.by_context[context]
+            del chunks[chunk]
+            if not chunks:
+                del self.by_context[context]
+
+    def _drop_context(self, context, method):
+        chunks = self.by_context.pop(context, None)
+        if not chunks:
+            return
+        if self.report_on_reset and len(chunks) >= self.report_on_reset:
+            name = _context_name(self.target, self.layouts, context)
+            print(f"{method} of {name} drops {len(chunks)} chunks")
+            self.report({context: chunks}, by_context=False)
+        for chunk in chunks:
+            del self.owner[chunk]
+
+    def _register(self, frame, name):
+        return frame.FindRegister(name).GetValueAsUnsigned()
+
+    def entry(self, frame, bp_loc):
+        method = self.methods.get(bp_loc.GetBreakpoint().GetID())
+        arg = self._register(frame, self.args[0])
+        if method == "free_p":
+            self._forget(arg)
+            return
+        if method in ("reset", "delete_context"):
+            self._drop_context(arg, method)
+            return
+        thread = frame.GetThread()
+        pcs = _frame_pcs(thread, self.depth + 1)[1:]
+        if not pcs:
+            return
+        if method == "realloc":
+            # None for a chunk allocated before tracking started
+            context = self.owner.get(arg)
+            self._forget(arg)
+        else:
+            context = arg
+        size = self._register(frame, self.args[1])
+        retaddr = pcs[0]
+        if retaddr not in self.returns:
+            bp = self.target.BreakpointCreateByAddress(retaddr)
+            bp.SetScriptCallbackFunction("trace_pg_mem._on_track_return")
+            self.returns[retaddr] = bp.GetID()
+        self.pending.setdefault(thread.GetThreadID(), []).append(
+            (retaddr, context, size, self._stack_id(pcs)))
+
+    def returned(self, frame):
+        pending = self.pending.get(frame.GetThread().GetThreadID())
+        pc = frame.GetPC()
+        # calls that never returned, e.g. on an ERROR, are dropped here
+        while pending and pending[-1][0] != pc:
+            pending.pop()
+        if not pending:
+            return
+        _, context, size, stack = pending.pop()
+        chunk = self._register(frame, self.retval)
+        if context is None:
+            # a realloc of an unknown chunk, its owner is only known if
+            # the alloc it made returned first
+            context = self.owner.get(chunk)
+        if chunk and context is not None:
+            self._remember(chunk, context, size, stack)
+
+    def _describe_stack(self, stack, nframes=4):
+        names = []
+        for i, pc in enumerate(self.stack_pcs[stack]):
+            names.extend(_function_names(self.target, pc, True))
+            if len(names) >= nframes:
+                break
+        return " < ".join(names[:nframes])
+
+    def report(self, contexts=None, by_context=True):
+        contexts = self.by_context if contexts is None else contexts
+        mask = (1 << STACK_BITS) - 1
+        stacks = collections.defaultdict(lambda: [0, 0])
+        sizes = {}
+        for context, chunks in contexts.items():
+            total = 0
+            for v in chunks.values():
+                t = stacks[v & mask]
+                t[0] += 1
+                t[1] += v >> STACK_BITS
+                total += v >> STACK_BITS
+            sizes[context] = (len(chunks), total)
+
+        nchunks = sum(n for n, _ in sizes.values())
+        nbytes = sum(b for _, b in sizes.values())
+        print(f"{nchunks} live chunks, {nbytes} bytes in {len(sizes)} "
+              f"contexts, from {len(stacks)} stacks")
+        print(f"{'bytes':>14} {'chunks':>9}  stack")
+        ranked = sorted(stacks.items(), key=lambda s: s[1][1], reverse=True)
+        for stack, (n, b) in ranked[:self.top]:
+            print(f"{b:>14} {n:>9}  {self._describe_stack(stack)}")
+        if not by_context:
+            return
+        print(f"{'bytes':>14} {'chunks':>9}  context")
+        ranked = sorted(sizes.items(), key=lambda s: s[1][1], reverse=True)
+        for context, (n, b) in ranked[:self.top]:
+            name = _context_name(self.target, self.layouts, context)
+            print(f"{b:>14} {n:>9}  {name} ({context:#x})")
+
+
+_tracker = None
+
+
+def _on_track_entry(frame, bp_loc, internal_dict):
+    _tracker.entry(frame, bp_loc)
+    return False
+
+
+def _on_track_return(frame, bp_loc, internal_dict):
+    _tracker.returned(frame)
+    return False
+
+
+def trace_alloc(debugger, command, result, internal_dict):
+    global _tracker
+    parser = argparse.ArgumentParser(
+        prog="trace_alloc",
+        description='Track live allocations through the mcxt_methods and '
+                    'report the outstanding ones by stack and context')
+    parser.add_argument('action', nargs='?', default='start',
+                        choices=['start', 'report', 'stop'])
+    parser.add_argument('-d', '--depth', type=int, default=16,
+                        help='frames of the stack of an allocation, '
+                             'default: 16')
+    parser.add_argument('-n', '--top', type=int, default=20,
+                        help='number of stacks and contexts to report, '
+                             'default: 20')
+    parser.add_argument('-R', '--report-on-reset', type=int, default=0,
+                        metavar='chunks',
+                        help='report the chunks a reset or delete of a '
+                             'context drops if there are at least this many')
+    args = parser.parse_args(shlex.split(command))
+
+    target = debugger.GetSelectedTarget()
+    if args.action == 'start':
+        if _tracker is not None:
+            _tracker.stop()
+        _tracker = AllocationTracker(target, args.depth,
+                                     args.report_on_reset, args.top)
+        _tracker.start()
+        print(f"tracking allocations of {len(_tracker.methods)} methods")
+        return
+    if _tracker is None:
+        print("not tracking, run `trace_alloc start` first")
+        return
+    _tracker.top = args.top
+    _tracker.report()
+    if args.action == 'stop':
+        _tracker.stop()
+        _tracker = None
+
+
 def trace_memory_context_api(debugger, command, result, internal_dict):
     target = debugger.GetSelectedTarget()
     _breakpoint_set_by_regex(target, br_regexes)
@@ -121,7 +657,11 @@ def trace_memory_context_api(debugger, command, result, internal_dict):
 
 def trace_mcxt_methods(debugger, command, result, internal_dict):
     target = debugger.GetSelectedTarget()
-    _breakpoint_set_by_expr(target, br_exprs)
+    methods = mcxt_method_addresses(target)
+    for name, addr in methods:
+        symbol = target.ResolveLoadAddress(addr).GetSymbol()
+        print(f"{name}: {symbol.GetName()} ({addr:#x})")
+    _breakpoint_set_by_address(target, [addr for _, addr in methods])
 
 
 def trace_mem_api(debugger, command, result, internal_dict):
@@ -133,6 +673,9 @@ def __lldb_init_module(debugger, internal_dict):
     add_cmd = "command script add -f trace_pg_mem"
     exported_cmd = [
         "dump_bt",
+        "trace_record",
+        "trace_stacks",
+        "trace_alloc",
         "trace_mem_api",
         "trace_mcxt_methods",
         "trace_memory_context_api",
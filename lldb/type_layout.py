@@ -0,0 +1,278 @@
+import lldb  # type ignore
+import os
+import json
+import hashlib
+
+
+# where caches keyed by build-id are kept, override with $LLDB_SNIPPETS_CACHE
+CACHE_DIR = os.environ.get(
+    "LLDB_SNIPPETS_CACHE",
+    os.path.join(os.environ.get("XDG_CACHE_HOME", "~/.cache"),
+                 "snippets-debugger"))
+
+
+def module_build_id(module: lldb.SBModule):
+    """
+    The build-id of a module, or a digest of its path, size and mtime if
+    the binary was linked without one.
+    """
+    uuid = module.GetUUIDString()
+    if uuid:
+        return uuid.replace("-", "").lower()
+    path = module.GetFileSpec().fullpath
+    if not path or not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    key = f"{path}:{st.st_size}:{st.st_mtime_ns}"
+    return "path-" + hashlib.sha1(key.encode()).hexdigest()
+
+
+def executable_module(target: lldb.SBTarget):
+    return target.FindModule(target.GetExecutable())
+
+
+def cache_path(kind, build_id):
+    if not build_id:
+        return None
+    return os.path.join(os.path.expanduser(CACHE_DIR),
+                        f"{kind}-{build_id}.json")
+
+
+def load_cache(path):
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cache(path, data):
+    if path is None:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _find_field(typ: lldb.SBType, name):
+    typ = typ.GetCanonicalType()
+    for i in range(typ.GetNumberOfFields()):
+        field = typ.GetFieldAtIndex(i)
+        if field.GetName() == name:
+            return field
+    return None
+
+
+def _scalar_format(typ: lldb.SBType):
+    """
+    struct format character of a scalar C type
+    """
+    typ = typ.GetCanonicalType()
+    size = typ.GetByteSize()
+    if typ.IsPointerType():
+        return "Q" if size == 8 else "I"
+    if typ.GetBasicType() == lldb.eBasicTypeBool:
+        return "?"
+    if typ.GetBasicType() == lldb.eBasicTypeFloat:
+        return "f"
+    if typ.GetBasicType() == lldb.eBasicTypeDouble:
+        return "d"
+    fmt = {1: "B", 2: "H", 4: "I", 8: "Q"}.get(size)
+    if fmt is None:
+        return None
+    if typ.GetBasicType() in (lldb.eBasicTypeSignedChar,
+                              lldb.eBasicTypeShort,
+                              lldb.eBasicTypeInt,
+                              lldb.eBasicTypeLong,
+                              lldb.eBasicTypeLongLong):
+        fmt = fmt.lower()
+    return fmt
+
+
+def _enum_names(typ: lldb.SBType):
+    typ = typ.GetCanonicalType()
+    if typ.GetTypeClass() != lldb.eTypeClassEnumeration:
+        return None
+    names = {}
+    members = typ.GetEnumMembers()
+    for i in range(members.GetSize()):
+        member = members.GetTypeEnumMemberAtIndex(i)
+        names[str(member.GetValueAsUnsigned())] = member.GetName()
+    return names
+
+
+def _leaf_kind(typ: lldb.SBType):
+    if typ.IsPointerType():
+        return "pointer"
+    if typ.GetBasicType() in (lldb.eBasicTypeChar,
+                              lldb.eBasicTypeSignedChar):
+        return "char"
+    return None
+
+
+def _flatten(typ: lldb.SBType, path, offset, leaves):
+    """
+    Append the scalar leaves of typ at offset to leaves
+    """
+    typ = typ.GetCanonicalType()
+    if typ.IsArrayType():
+        elem = typ.GetArrayElementType().GetCanonicalType()
+        size = elem.GetByteSize()
+        count = typ.GetByteSize() // size if size else 0
+        if elem.GetNumberOfFields() and not elem.IsPointerType():
+            for i in range(count):
+                _flatten(elem, f"{path}[{i}]", offset + i * size, leaves)
+        else:
+            leaves.append([path, offset, _scalar_format(elem), count,
+                           _enum_names(elem), size, _leaf_kind(elem)])
+        return
+    if typ.IsPointerType() or not typ.GetNumberOfFields():
+        leaves.append([path, offset, _scalar_format(typ), 0,
+                       _enum_names(typ), typ.GetByteSize(),
+                       _leaf_kind(typ)])
+        return
+    for i in range(typ.GetNumberOfFields()):
+        field = typ.GetFieldAtIndex(i)
+        name = field.GetName() or f"<{i}>"
+        name = f"{path}.{name}" if path else name
+        if field.IsBitfield():
+            bits = field.GetOffsetInBits()
+            leaves.append([name, offset + bits // 8, None, bits % 8, None,
+                           field.GetBitfieldSizeInBits(), "bits"])
+            continue
+        _flatten(field.GetType(), name, offset + field.GetOffsetInBytes(),
+                 leaves)
+
+
+class TypeLayoutCache:
+    """
+    Sizes, member offsets and scalar formats of the types of one target.
+
+    Every layout is looked up in the DWARF once and then saved to
+    CACHE_DIR keyed by the build-id of the executable, so a later lldb
+    session on the same build does not look up any type at all.  SBType
+    objects, which are needed to build SBValues, are only kept in memory.
+
+    A member is given as a path, e.g. "blocks.head.next".  Its layout is
+    [offset, format, count, enumerators, size], where format is a struct
+    format character, count is the number of elements of an array member
+    (0 for scalars), enumerators maps the values of an enum to their names
+    and size is the size of the member or of one array element.  Members
+    missing from a build are cached as null.
+    """
+
+    def __init__(self, target: lldb.SBTarget):
+        self.target = target
+        self.build_id = module_build_id(executable_module(target))
+        self.path = cache_path("layout", self.build_id)
+        data = load_cache(self.path) or {}
+        self._layouts = data.get("types", {})
+        self.byteorder = data.get("byteorder")
+        self.pointer_size = data.get("pointer_size")
+        if self.byteorder is None:
+            big = target.GetByteOrder() == lldb.eByteOrderBig
+            self.byteorder = ">" if big else "<"
+            self.pointer_size = target.GetAddressByteSize()
+        self._sbtypes = {}
+        self._dirty = False
+        # called with the name of every type looked up in the debug info
+        self.on_lookup = None
+
+    def sbtype(self, typname):
+        typ = self._sbtypes.get(typname)
+        if typ is None:
+            if self.on_lookup is not None:
+                self.on_lookup(typname)
+            typ = self.target.FindFirstType(typname)
+            assert typ.IsValid(), f"type {typname} not found"
+            self._sbtypes[typname] = typ
+        return typ
+
+    def _layout(self, typname):
+        layout = self._layouts.get(typname)
+        if layout is None:
+            layout = {"size": self.sbtype(typname).GetByteSize(),
+                      "members": {}}
+            self._layouts[typname] = layout
+            self._dirty = True
+        return layout
+
+    def sizeof(self, typname):
+        return self._layout(typname)["size"]
+
+    def _member(self, typname, path):
+        members = self._layout(typname)["members"]
+        if path in members:
+            return members[path]
+        offset = 0
+        typ = self.sbtype(typname)
+        for name in path.split("."):
+            field = _find_field(typ, name)
+            if field is None:
+                members[path] = None
+                self._dirty = True
+                return None
+            offset += field.GetOffsetInBytes()
+            typ = field.GetType()
+        count = 0
+        if typ.GetCanonicalType().IsArrayType():
+            elem = typ.GetCanonicalType().GetArrayElementType()
+            count = typ.GetByteSize() // elem.GetByteSize()
+            typ = elem
+        member = [offset, _scalar_format(typ), count, _enum_names(typ),
+                  typ.GetByteSize()]
+        members[path] = member
+        self._dirty = True
+        return member
+
+    def member(self, typname, path):
+        member = self._member(typname, path)
+        assert member is not None, f"{typname} has no field {path}"
+        return member
+
+    def has_member(self, typname, path):
+        return self._member(typname, path) is not None
+
+    def offsetof(self, typname, path):
+        return self.member(typname, path)[0]
+
+    def leaves(self, typname, typ=None):
+        """
+        The scalar members of typname with nested structs and arrays of
+        structs flattened, as [path, offset, format, count, enumerators,
+        size, kind] sorted by offset.  kind is "pointer", "char" or None,
+        or "bits" for a bitfield of size bits starting count bits into the
+        byte at offset.  typ is used for types FindFirstType cannot find
+        by name.
+        """
+        layout = self._layouts.get(typname)
+        if layout is None or "leaves" not in layout:
+            if typ is not None:
+                self._sbtypes.setdefault(typname, typ)
+            layout = self._layout(typname)
+            leaves = []
+            _flatten(self.sbtype(typname), "", 0, leaves)
+            leaves.sort(key=lambda leaf: leaf[1])
+            layout["leaves"] = leaves
+            self._dirty = True
+        return layout["leaves"]
+
+    def flush(self):
+        """
+        Save newly resolved layouts
+        """
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            save_cache(self.path, {
+                "byteorder": self.byteorder,
+                "pointer_size": self.pointer_size,
+                "types": self._layouts,
+            })
+        except OSError:
+            pass